@@ -1,19 +1,54 @@
-from typing import Type
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Type
 
 from dotenv import load_dotenv
+
+# settings are read from the environment as the modules below are imported,
+# under `textual run` too, which does not run the __main__ block
+load_dotenv()
+
+from rich.console import RenderableType
+from telegram.client import AuthorizationState
 from textual.app import App, ComposeResult, CSSPathType
 from textual.containers import Horizontal
 from textual.driver import Driver
+from textual.screen import Screen
 from textual.widgets import Footer, Header
 
-from client import Client
-from utils import notify
-from widgets import ChatListView, DetailsPane, MainPane, MessageInput
+from client import AsyncClient, Client
+from metrics import METRICS_DUMP_INTERVAL, METRICS_PATH, metrics
+from models import (
+    ChatUpdate,
+    UpdateDeleteMessages,
+    UpdateMessageContent,
+    UpdateMessageInteractionInfo,
+    UpdateNewMessage,
+    User,
+)
+from navigation import NavigationScheduler
+from notifications import Notifier
+from outbox import OutgoingMessage
+from snapshot import SNAPSHOT_PATH, Snapshot
+from widgets import (
+    ChatListView,
+    DetailsPane,
+    MainPane,
+    MessageInput,
+    MessageListView,
+    SearchPane,
+    StatsPane,
+    thumbnail_cache,
+)
 
 
 class TelegramClient(App):
     CSS_PATH = "main.css"
-    BINDINGS = [("d", "toggle_dark", "Toggle dark mode")]
+    BINDINGS = [
+        ("d", "toggle_dark", "Toggle dark mode"),
+        ("slash", "search", "Search"),
+        ("p", "toggle_stats", "Stats"),
+    ]
 
     def __init__(
         self,
@@ -23,47 +58,228 @@ class TelegramClient(App):
     ):
         super().__init__(driver_class, css_path, watch_css)
         self.tg = Client()
-        self.tg.login()
-        self.tg.add_message_handler(self.new_message_handler)
+        self.snapshot_path = SNAPSHOT_PATH or os.path.join(
+            self.tg.files_directory, "snapshot.bin"
+        )
+        # with a snapshot the app paints right away and logs in behind it
+        self.snapshot = Snapshot.load(self.snapshot_path)
+        if self.snapshot is None:
+            self.tg.login()
+        else:
+            self.snapshot.restore(self.tg)
+        self.async_tg = AsyncClient(self.tg)
         self.current_chat_id = 0
-        self.me = self.tg.get_me()
+        self.notifier = Notifier()
+        self._login_task: Optional[asyncio.Task] = None
+
+    def on_mount(self) -> None:
+        updates = self.async_tg.updates
+        updates.add_handler("updateNewMessage", self.new_messages_handler)
+        updates.add_handler("updateMessageContent", self.message_contents_handler)
+        updates.add_handler(
+            "updateMessageInteractionInfo", self.message_interaction_infos_handler
+        )
+        updates.add_handler("updateDeleteMessages", self.delete_messages_handler)
+        for update_type in (
+            "updateChatPosition",
+            "updateChatLastMessage",
+            "updateChatReadInbox",
+            "updateChatTitle",
+        ):
+            updates.add_handler(update_type, self.chats_handler)
+        updates.start()
+        self.async_tg.outbox.subscribe(self.outgoing_message_handler)
+        if not self.async_tg.authorized.is_set():
+            self._login_task = asyncio.create_task(self.login())
+        if metrics.enabled:
+            self.time_frames()
+        if METRICS_PATH:
+            self.set_interval(METRICS_DUMP_INTERVAL, self.dump_metrics)
+
+    async def login(self):
+        state = await self.async_tg.login()
+        if state != AuthorizationState.READY:
+            Snapshot.delete(self.snapshot_path)
+            self.exit(message="Logged out, restart to log in again")
+            return
+        await self.chat_list_view.load_chats()
+
+    def on_unmount(self) -> None:
+        self.async_tg.updates.stop()
+        self.async_tg.index.close()
+        self.notifier.close()
+        self.navigation.cancel()
+        if self.async_tg.prefetcher.enabled:
+            self.log(prefetch=self.async_tg.prefetcher.stats())
+        self.log(navigation=self.navigation.stats())
+        if METRICS_PATH:
+            self.dump_metrics()
+        if self.async_tg.authorized.is_set():
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        self.main_pane.chat_pane.cache_history()
+        snapshot = Snapshot.capture(self.tg, self.chat_list_view.chats)
+        if snapshot is None:
+            return
+        try:
+            snapshot.save(self.snapshot_path)
+        except OSError as e:
+            self.log(snapshot_error=e)
+
+    def performance_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            "navigation": self.navigation.stats(),
+            "updates": self.async_tg.updates.stats(),
+            "history_cache": self.tg.history_cache.stats(),
+            "user_cache": self.tg.users.stats(),
+            "thumbnail_cache": thumbnail_cache.stats(),
+            "downloads": self.async_tg.downloads.stats(),
+            "prefetch": self.async_tg.prefetcher.stats(),
+            "outbox": self.async_tg.outbox.stats(),
+            "notifications": self.notifier.stats(),
+        }
+
+    def dump_metrics(self):
+        try:
+            metrics.dump(METRICS_PATH, self.performance_stats())
+        except OSError as e:
+            self.log(metrics_error=e)
+
+    def time_frames(self):
+        # textual has no hook around a frame, the compositor renders the
+        # widgets' lines into an update that `_display` then writes out
+        compositor = self.screen._compositor
+        if not hasattr(compositor.render_update, "__wrapped__"):
+            compositor.render_update = metrics.timed("frame_seconds", "render")(
+                compositor.render_update
+            )
+
+    def _display(self, screen: Screen, renderable: RenderableType | None) -> None:
+        with metrics.timer("frame_seconds", "write"):
+            super()._display(screen, renderable)
 
     def compose(self) -> ComposeResult:
         """Create child widgets for the app."""
         yield Header()
         with Horizontal(id="app-grid"):
-            self.chat_list_view = ChatListView(self.tg, id="chat-list-pane")
+            self.chat_list_view = ChatListView(
+                self.async_tg,
+                chats=self.snapshot.chats if self.snapshot else None,
+                id="chat-list-pane",
+            )
             self.details_pane = DetailsPane()
             yield self.chat_list_view
-            yield MainPane(id="main-pane", tg=self.tg)
+            self.main_pane = MainPane(id="main-pane", tg=self.async_tg)
+            self.navigation = NavigationScheduler(
+                self.async_tg,
+                self.main_pane.load_messages,
+                self.chat_list_view.neighbours,
+            )
+            yield self.main_pane
             yield self.details_pane
+            self.search_pane = SearchPane(self.async_tg)
+            yield self.search_pane
+            self.stats_pane = StatsPane(self.performance_stats)
+            yield self.stats_pane
         yield Footer()
         self.chat_list_view.focus()
 
-    async def on_chat_list_view_highlighted(self, message: ChatListView.Selected):
+    def on_chat_list_view_highlighted(self, message: ChatListView.Highlighted):
+        if message.item is None:
+            return
         self.current_chat_id = message.item.chat_id
-        main_pane = self.query_one(MainPane)
-        await main_pane.load_messages(message.item.chat_id)
+        self.notifier.clear(message.item.chat_id)
+        self.navigation.go(message.item.chat_id)
 
-    async def on_message_input_submitted(self, message: MessageInput.Submitted):
+    def on_message_list_view_shown(self, message: MessageListView.Shown):
+        self.navigation.shown(message.chat_id, message.shown_at)
+
+    def action_search(self) -> None:
+        self.search_pane.open()
+
+    def action_toggle_stats(self) -> None:
+        # timings are recorded from the first time the panel is opened
+        if not metrics.enabled:
+            metrics.enabled = True
+            self.time_frames()
+        self.stats_pane.toggle()
+
+    def on_search_pane_selected(self, message: SearchPane.Selected):
+        result = message.result
+        self.current_chat_id = result.chat_id
+        self.notifier.clear(result.chat_id)
+        self.navigation.go(result.chat_id, around=result.message_id)
+
+    def on_message_input_submitted(self, message: MessageInput.Submitted):
         if not self.current_chat_id:
-            notify("Info", "No chat selected")
+            self.notifier.notify("Info", "No chat selected")
             return
-        self.tg.send_message(self.current_chat_id, message.value)
+        self.async_tg.outbox.send(self.current_chat_id, message.value)
+
+    def outgoing_message_handler(
+        self, outgoing: OutgoingMessage, old_id: Optional[int]
+    ):
+        # queued on the list so it never interleaves with its other changes
+        chat_pane = self.main_pane.chat_pane
+        chat_pane.call_later(chat_pane.add_message, outgoing.message, old_id)
 
     def action_toggledark(self) -> None:
         """An action to toggle dark mode."""
         self.dark = not self.dark
 
-    def new_message_handler(self, update):
-        message_content = update["message"]["content"].get("text", {})
-        user_id = update["message"]["sender_id"].get("user_id", 0)
-        user = self.tg.get_user(user_id)
-        message_text = message_content.get("text", "")
-        notify(f"From: {user.full_name}", message_text)
+    async def new_messages_handler(self, updates: List[UpdateNewMessage]):
+        messages = [u.message for u in updates]
+        sender_ids = list(set(m.sender_id.user_id for m in messages))
+        names = await asyncio.gather(*(self._author_name(i) for i in sender_ids))
+        authors = dict(zip(sender_ids, names))
+        for message in messages:
+            chat = self.tg.chats.get(message.chat_id, {})
+            self.notifier.notify_message(
+                message.chat_id,
+                chat.get("title", ""),
+                authors[message.sender_id.user_id],
+                message.content.renderable_text,
+            )
+            if message.chat_id == self.current_chat_id:
+                try:
+                    await self.main_pane.chat_pane.add_message(message)
+                except User.NotFound:
+                    # it is shown with the next page of the chat instead
+                    self.log(unknown_author=message.sender_id.user_id)
+
+    async def _author_name(self, user_id: int) -> str:
+        # one author that cannot be looked up must not lose the other messages
+        try:
+            return (await self.async_tg.get_user(user_id)).full_name
+        except User.NotFound:
+            return "Unknown user"
+
+    def message_contents_handler(self, updates: List[UpdateMessageContent]):
+        for update in updates:
+            if update.chat_id == self.current_chat_id:
+                self.main_pane.chat_pane.update_message_content(
+                    update.message_id, update.new_content
+                )
+
+    def message_interaction_infos_handler(
+        self, updates: List[UpdateMessageInteractionInfo]
+    ):
+        for update in updates:
+            if update.chat_id == self.current_chat_id:
+                self.main_pane.chat_pane.update_interaction_info(
+                    update.message_id, update.interaction_info
+                )
+
+    async def chats_handler(self, updates: List[ChatUpdate]):
+        await self.chat_list_view.refresh_chats(u.chat_id for u in updates)
+
+    async def delete_messages_handler(self, updates: List[UpdateDeleteMessages]):
+        for update in updates:
+            if update.chat_id == self.current_chat_id and not update.from_cache:
+                await self.main_pane.chat_pane.remove_messages(update.message_ids)
 
 
 if __name__ == "__main__":
-    load_dotenv()
     app = TelegramClient()
     app.run()
@@ -0,0 +1,254 @@
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Tuple
+
+import telegram.client
+
+# a recording made with TELEGRAM_RECORD_PATH, replayed instead of TDLib
+REPLAY_PATH = os.getenv("TELEGRAM_REPLAY_PATH", "")
+# time a replayed request takes to answer
+REPLAY_LATENCY = int(os.getenv("TELEGRAM_REPLAY_LATENCY_MS", 0)) / 1000
+# record the session with TDLib as JSON lines, it holds chats and messages
+RECORD_PATH = os.getenv("TELEGRAM_RECORD_PATH", "")
+RECEIVE_TIMEOUT = 1.0  # as TDLib's td_json_client_receive is called
+
+# not recorded, a replay answers them itself and logs in without credentials
+PRIVATE_REQUESTS = {
+    "setTdlibParameters",
+    "checkDatabaseEncryptionKey",
+    "setDatabaseEncryptionKey",
+    "setAuthenticationPhoneNumber",
+    "checkAuthenticationCode",
+    "checkAuthenticationPassword",
+    "checkAuthenticationBotToken",
+    "registerUser",
+}
+# answered by the replay from its own authorization state
+STATE_REQUESTS = {"getAuthorizationState", "close"}
+
+
+class Backend(Protocol):
+    """What the client needs of TDJson."""
+
+    def send(self, query: Dict[Any, Any]) -> None: ...
+
+    def receive(self) -> Optional[Dict[Any, Any]]: ...
+
+    def stop(self) -> None: ...
+
+
+class RecordingBackend:
+    """
+    Passes everything through to `backend` and writes it to `path`.
+
+    Each line is a request and its result, or an update with the seconds
+    since the first request it came at.
+    """
+
+    def __init__(self, backend: Backend, path: str) -> None:
+        self.backend = backend
+        self._file = open(path, "w")
+        self._lock = threading.Lock()
+        # by request id, as sent
+        self._requests: Dict[str, str] = {}
+        self._started: Optional[float] = None
+
+    def send(self, query: Dict[Any, Any]) -> None:
+        request_id = (query.get("@extra") or {}).get("request_id")
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            method = query["@type"]
+            if (
+                request_id is not None
+                and method not in PRIVATE_REQUESTS
+                and method not in STATE_REQUESTS
+            ):
+                self._requests[request_id] = json.dumps(_without_extra(query))
+        self.backend.send(query)
+
+    def receive(self) -> Optional[Dict[Any, Any]]:
+        result = self.backend.receive()
+        if result is not None:
+            self._record(result)
+        return result
+
+    def stop(self) -> None:
+        self.backend.stop()
+        with self._lock:
+            self._file.close()
+
+    def _record(self, result: Dict[Any, Any]):
+        request_id = (result.get("@extra") or {}).get("request_id")
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+            if request is not None:
+                line = (
+                    f'{{"request": {request}, '
+                    f'"response": {json.dumps(_without_extra(result))}}}'
+                )
+            elif request_id is None and result["@type"] != "updateAuthorizationState":
+                # the replay keeps its own authorization state
+                started = self._started or time.monotonic()
+                at = round(max(time.monotonic() - started, 0), 3)
+                line = json.dumps({"at": at, "update": result})
+            else:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+class ReplayBackend:
+    """
+    An in-process TDLib that answers from a recording.
+
+    A request gets the response recorded for the same request, the same one
+    again once they run out, `latency` seconds after it was sent. Updates come
+    at the pace they were recorded at, from the first request on, when the
+    client has its handlers in place. Responses are kept as JSON and parsed
+    when received, like TDLib's.
+
+    The replay is logged in as the recorded account already. The client gets
+    made up credentials and a files directory of its own, so no snapshot or
+    index of a real account is read.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        latency: float = REPLAY_LATENCY,
+        files_directory: Optional[str] = None,
+    ) -> None:
+        self.latency = latency
+        self.files_directory = files_directory or tempfile.mkdtemp(
+            prefix="telegram-replay-"
+        )
+        self.authorization_state = "authorizationStateReady"
+        # by request, minus @extra
+        self._responses: Dict[str, List[str]] = {}
+        # seconds since the first request, JSON
+        self._updates: List[Tuple[float, str]] = []
+        # due time, order sent, JSON
+        self._queue: List[Tuple[float, int, str]] = []
+        self._order = itertools.count()
+        self._ready = threading.Condition()
+        self._stopped = False
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if "update" in entry:
+                    self._updates.append((entry["at"], json.dumps(entry["update"])))
+                else:
+                    key = _request_key(entry["request"])
+                    response = json.dumps(entry["response"])
+                    self._responses.setdefault(key, []).append(response)
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Arguments for the client in place of the account's."""
+        return {
+            "api_id": 0,
+            "api_hash": "",
+            "phone": "replay",
+            "database_encryption_key": "",
+            "files_directory": self.files_directory,
+        }
+
+    def send(self, query: Dict[Any, Any]) -> None:
+        if self._updates:
+            started = time.monotonic()
+            for at, update in self._updates:
+                self._push(started + at, update)
+            self._updates = []
+        responses = self._responses.get(_request_key(query))
+        if responses:
+            response = json.loads(
+                responses.pop(0) if len(responses) > 1 else responses[0]
+            )
+        else:
+            response = self._answer(query)
+        if "@extra" in query:
+            response["@extra"] = query["@extra"]
+        due = time.monotonic() + self.latency
+        self._push(due, json.dumps(response))
+        if query["@type"] == "close":
+            self.authorization_state = "authorizationStateClosed"
+            update = {
+                "@type": "updateAuthorizationState",
+                "authorization_state": {"@type": self.authorization_state},
+            }
+            self._push(due, json.dumps(update))
+
+    def receive(self) -> Optional[Dict[Any, Any]]:
+        deadline = time.monotonic() + RECEIVE_TIMEOUT
+        with self._ready:
+            while not self._stopped:
+                now = time.monotonic()
+                if self._queue and self._queue[0][0] <= now:
+                    return json.loads(heapq.heappop(self._queue)[2])
+                wake = min(self._queue[0][0], deadline) if self._queue else deadline
+                if wake <= now:
+                    return None
+                self._ready.wait(wake - now)
+        return None
+
+    def stop(self) -> None:
+        with self._ready:
+            self._stopped = True
+            self._ready.notify_all()
+
+    def _answer(self, query: Dict[Any, Any]) -> Dict[Any, Any]:
+        """The response to a request the recording has none for."""
+        method = query["@type"]
+        if method == "getAuthorizationState":
+            return {"@type": self.authorization_state}
+        if method in PRIVATE_REQUESTS or method == "close":
+            return {"@type": "ok"}
+        return {"@type": "error", "code": 404, "message": f"{method} not recorded"}
+
+    def _push(self, due: float, text: str):
+        with self._ready:
+            heapq.heappush(self._queue, (due, next(self._order), text))
+            self._ready.notify()
+
+
+def _without_extra(data: Dict[Any, Any]) -> Dict[Any, Any]:
+    return {k: v for k, v in data.items() if k != "@extra"}
+
+
+def _request_key(query: Dict[Any, Any]) -> str:
+    return json.dumps(_without_extra(query), sort_keys=True)
+
+
+def default_backend() -> Optional[Backend]:
+    """The backend the settings ask for, None for TDLib itself."""
+    if REPLAY_PATH:
+        return ReplayBackend(REPLAY_PATH)
+    if RECORD_PATH:
+        return RecordingBackend(telegram.client.TDJson(), RECORD_PATH)
+    return None
+
+
+@contextmanager
+def using_backend(backend: Optional[Backend]) -> Iterator[None]:
+    """
+    Have the clients created within talk to `backend`.
+
+    python-telegram builds its TDJson in `Telegram.__init__` and takes no
+    other, so the name it is looked up under is swapped meanwhile.
+    """
+    if backend is None:
+        yield
+        return
+    original = telegram.client.TDJson
+    telegram.client.TDJson = lambda **kwargs: backend  # type: ignore
+    try:
+        yield
+    finally:
+        telegram.client.TDJson = original  # type: ignore
@@ -0,0 +1,327 @@
+import bisect
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from models import (
+    AnyMessageContent,
+    HasImage,
+    Message,
+    MessageInteractionInfo,
+    MessageSender,
+    MessageSendingState,
+)
+
+T = TypeVar("T")
+
+
+class LRUCache(Generic[T]):
+    """
+    Thread-safe LRU cache with an optional time to live.
+
+    Entries older than `ttl` seconds are treated as misses and dropped.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, Tuple[float, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, count: bool = True) -> Optional[T]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._data[key]
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: T) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[T]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry is not None else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+
+class ThumbnailStore:
+    """
+    Content-addressed thumbnail bytes, shared by the messages holding them.
+
+    Entries are reference counted and dropped with their last message.
+    """
+
+    def __init__(self) -> None:
+        self._data: Dict[bytes, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def put(self, data: bytes) -> bytes:
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._data[key] = [data, 1]
+            else:
+                entry[1] += 1
+        return key
+
+    def get(self, key: bytes) -> bytes:
+        return self._data[key][0]
+
+    def release(self, key: bytes) -> None:
+        with self._lock:
+            entry = self._data[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._data[key]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(data) for data, _ in self._data.values())
+
+
+# the boolean fields of Message, packed into CompactMessage.flags
+_FLAGS = tuple(
+    name for name, field in Message.__fields__.items() if field.type_ is bool
+)
+
+
+class CompactMessage:
+    """
+    Storage form of a message kept off screen.
+
+    The boolean fields are packed into a bitfield and the minithumbnail is
+    moved to a `ThumbnailStore`, the rest of the fields are shared with the
+    `Message` it was packed from.
+    """
+
+    __slots__ = (
+        "id",
+        "chat_id",
+        "user_id",
+        "flags",
+        "date",
+        "edit_date",
+        "interaction_info",
+        "sending_state",
+        "content",
+        "thumbnail",
+    )
+
+    def __init__(self, msg: Message, thumbnails: ThumbnailStore) -> None:
+        values = msg.__dict__
+        self.id: int = msg.id
+        self.chat_id: int = msg.chat_id
+        self.user_id: int = msg.sender_id.user_id
+        self.flags = sum(1 << bit for bit, name in enumerate(_FLAGS) if values[name])
+        self.date = int(msg.date.timestamp())
+        self.edit_date: int = msg.edit_date
+        self.interaction_info: Optional[MessageInteractionInfo] = msg.interaction_info
+        # pending and failed outgoing messages keep their marker
+        self.sending_state: Optional[MessageSendingState] = msg.sending_state
+        content = msg.content
+        self.thumbnail: Optional[bytes] = None
+        if isinstance(content, HasImage) and content.image_data:
+            self.thumbnail = thumbnails.put(content.image_data)
+            content = content.with_image_data(b"")
+        self.content: AnyMessageContent = content
+
+    def unpack(self, thumbnails: ThumbnailStore) -> Message:
+        content = self.content
+        if self.thumbnail is not None:
+            content = content.with_image_data(thumbnails.get(self.thumbnail))
+        flags = self.flags
+        return Message.construct(
+            id=self.id,
+            chat_id=self.chat_id,
+            sender_id=MessageSender.construct(user_id=self.user_id),
+            date=datetime.fromtimestamp(self.date, timezone.utc),
+            edit_date=self.edit_date,
+            interaction_info=self.interaction_info,
+            sending_state=self.sending_state,
+            content=content,
+            **{name: bool(flags >> bit & 1) for bit, name in enumerate(_FLAGS)},
+        )
+
+    def release(self, thumbnails: ThumbnailStore) -> None:
+        if self.thumbnail is not None:
+            thumbnails.release(self.thumbnail)
+
+
+class HistoryCache:
+    """
+    Messages of recently opened chats, ordered by id.
+
+    The cache is bounded by the total number of messages it holds, whole
+    chats are evicted least recently used first. Messages are kept as
+    `CompactMessage` and unpacked when a chat is read back.
+    """
+
+    def __init__(self, max_messages: int = 10000) -> None:
+        self.max_messages = max_messages
+        self.hits = 0
+        self.misses = 0
+        self.thumbnails = ThumbnailStore()
+        self._chats: OrderedDict[int, List[CompactMessage]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._chats
+
+    def get(self, chat_id: int) -> Optional[List[Message]]:
+        with self._lock:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                self.misses += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            return [m.unpack(self.thumbnails) for m in messages]
+
+    def set(self, chat_id: int, messages: List[Message]) -> None:
+        with self._lock:
+            self._release(self._chats.pop(chat_id, []))
+            # a single chat never takes more than the whole budget
+            compact = [
+                CompactMessage(m, self.thumbnails)
+                for m in messages[-self.max_messages :]
+            ]
+            self._chats[chat_id] = compact
+            self._size += len(compact)
+            self._evict()
+
+    def add_message(self, message: Message) -> None:
+        with self._lock:
+            messages = self._chats.get(message.chat_id)
+            if messages is None:
+                return
+            # cached ranges reach the latest message, a new one goes in before
+            # any outgoing message still under a placeholder id
+            ids = [m.id for m in messages]
+            position = bisect.bisect_left(ids, message.id)
+            if position < len(ids) and ids[position] == message.id:
+                return
+            messages.insert(position, CompactMessage(message, self.thumbnails))
+            self._size += 1
+            self._evict()
+
+    def update_message(self, chat_id: int, message_id: int, **changes: Any) -> None:
+        with self._lock:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                return
+            ids = [m.id for m in messages]
+            position = bisect.bisect_left(ids, message_id)
+            if position < len(ids) and ids[position] == message_id:
+                old = messages[position]
+                message = old.unpack(self.thumbnails).copy(update=changes)
+                messages[position] = CompactMessage(message, self.thumbnails)
+                old.release(self.thumbnails)
+
+    def replace_message(self, chat_id: int, old_id: int, message: Message) -> None:
+        """Put `message` in place of `old_id`, as when a sent message gets its id."""
+        with self._lock:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                return
+            ids = [m.id for m in messages]
+            position = bisect.bisect_left(ids, old_id)
+            if position == len(ids) or ids[position] != old_id:
+                return
+            messages.pop(position).release(self.thumbnails)
+            del ids[position]
+            position = bisect.bisect_left(ids, message.id)
+            messages.insert(position, CompactMessage(message, self.thumbnails))
+
+    def remove_messages(self, chat_id: int, message_ids: List[int]) -> None:
+        with self._lock:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                return
+            removed = set(message_ids)
+            self._release([m for m in messages if m.id in removed])
+            self._chats[chat_id] = [m for m in messages if m.id not in removed]
+
+    def recent(self, chats: int, limit: int) -> List[Tuple[int, List[Message]]]:
+        """
+        The last `limit` messages of the `chats` most recently used chats,
+        newest first. Unlike `get` this does not count as a read.
+        """
+        with self._lock:
+            recent = itertools.islice(reversed(self._chats.items()), chats)
+            return [
+                (chat_id, [m.unpack(self.thumbnails) for m in messages[-limit:]])
+                for chat_id, messages in recent
+            ]
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "chats": len(self._chats),
+            "messages": self._size,
+            "thumbnails": len(self.thumbnails),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _evict(self) -> None:
+        while self._size > self.max_messages and len(self._chats) > 1:
+            _, messages = self._chats.popitem(last=False)
+            self._release(messages)
+
+    def _release(self, messages: List[CompactMessage]) -> None:
+        self._size -= len(messages)
+        for m in messages:
+            m.release(self.thumbnails)
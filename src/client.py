@@ -1,21 +1,183 @@
+import asyncio
 import os
-from typing import Any, Dict
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Union
 
 from telegram.client import AuthorizationState, Telegram
+from telegram.utils import AsyncResult
 
-from models import Chat, File, Message, User
+from backends import Backend, ReplayBackend, default_backend, using_backend
+from cache import HistoryCache, LRUCache
+from downloads import DownloadManager, PhotoPrefetcher
+from metrics import metrics
+from models import (
+    Chat,
+    Message,
+    UpdateDeleteMessages,
+    UpdateMessageContent,
+    UpdateMessageInteractionInfo,
+    UpdateMessageSendFailed,
+    UpdateMessageSendSucceeded,
+    UpdateNewMessage,
+    User,
+)
+from outbox import Outbox
+from search import MessageIndex
+from updates import UpdateDispatcher
+
+USER_CACHE_SIZE = int(os.getenv("TELEGRAM_USER_CACHE_SIZE", 4096))
+USER_CACHE_TTL = float(os.getenv("TELEGRAM_USER_CACHE_TTL", 3600))
+HISTORY_PAGE_SIZE = int(os.getenv("TELEGRAM_HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGES = int(os.getenv("TELEGRAM_HISTORY_MAX_PAGES", 20))
+HISTORY_CACHE_SIZE = int(os.getenv("TELEGRAM_HISTORY_CACHE_SIZE", 10000))
+INDEX_PATH = os.getenv("TELEGRAM_INDEX_PATH", "")
+MAX_HISTORY_PAGE_SIZE = 100  # TDLib caps getChatHistory at 100 messages
+# authorization states in which the logged in user is gone
+LOGGED_OUT_STATES = {
+    "authorizationStateLoggingOut",
+    "authorizationStateClosed",
+    "authorizationStateWaitPhoneNumber",
+}
+
+ResultCallback = Callable[[AsyncResult], None]
+
+
+class History(List[Message]):
+    """Messages of a chat in id order."""
+
+    def __init__(self, messages: Iterable[Message] = (), has_older: bool = True):
+        super().__init__(messages)
+        # False once TDLib had nothing older than the first message
+        self.has_older = has_older
 
 
 class Client(Telegram):
-    def __init__(self) -> None:
-        super().__init__(
-            api_id=int(os.getenv("TELEGRAM_API_ID", 0)),
-            api_hash=os.getenv("TELEGRAM_API_HASH", ""),
-            phone=os.getenv("TELEGRAM_PHONE", ""),
-            database_encryption_key=os.getenv("TELEGRAM_DATABASE_ENCRYPTION_KEY", ""),
-            device_model="project_telegram",
-            application_version="1.0",
-        )
+    def __init__(self, backend: Optional[Backend] = None) -> None:
+        backend = backend or default_backend()
+        settings: Dict[str, Any] = {
+            "api_id": int(os.getenv("TELEGRAM_API_ID", 0)),
+            "api_hash": os.getenv("TELEGRAM_API_HASH", ""),
+            "phone": os.getenv("TELEGRAM_PHONE", ""),
+            "database_encryption_key": os.getenv(
+                "TELEGRAM_DATABASE_ENCRYPTION_KEY", ""
+            ),
+        }
+        if isinstance(backend, ReplayBackend):
+            settings.update(backend.settings)
+        with using_backend(backend):
+            super().__init__(
+                **settings, device_model="project_telegram", application_version="1.0"
+            )
+        self.chats: Dict[int, Dict[Any, Any]] = {}
+        self.users: LRUCache[User] = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.history_cache = HistoryCache(HISTORY_CACHE_SIZE)
+        self._pending_users: Dict[int, AsyncResult] = {}
+        self._pending_users_lock = threading.Lock()
+        self._me: Optional[User] = None
+        self._result_callbacks: Dict[str, List[ResultCallback]] = {}
+        self._result_callbacks_lock = threading.Lock()
+        self.add_update_handler("updateNewChat", self._on_new_chat)
+        self.add_update_handler("updateUser", self._on_user)
+        self.add_update_handler("updateAuthorizationState", self._on_authorization)
+        self.add_update_handler("updateChatTitle", self._on_chat_title)
+        self.add_update_handler("updateChatPosition", self._on_chat_position)
+        self.add_update_handler("updateChatLastMessage", self._on_chat_last_message)
+        self.add_update_handler("updateChatReadInbox", self._on_chat_read_inbox)
+
+    def _on_new_chat(self, update):
+        chat = update["chat"]
+        self.chats[chat["id"]] = chat
+
+    def _on_chat_title(self, update):
+        chat = self.chats.get(update["chat_id"])
+        if chat is not None:
+            chat["title"] = update["title"]
+
+    def _on_chat_position(self, update):
+        chat = self.chats.get(update["chat_id"])
+        if chat is not None:
+            position = update["position"]
+            positions = [
+                p for p in chat.get("positions", []) if p["list"] != position["list"]
+            ]
+            # an order of 0 takes the chat out of the list
+            if int(position["order"]):
+                positions.append(position)
+            chat["positions"] = positions
+
+    def _on_chat_last_message(self, update):
+        chat = self.chats.get(update["chat_id"])
+        if chat is not None:
+            chat["last_message"] = update.get("last_message")
+            chat["positions"] = update["positions"]
+
+    def _on_chat_read_inbox(self, update):
+        chat = self.chats.get(update["chat_id"])
+        if chat is not None:
+            chat["last_read_inbox_message_id"] = update["last_read_inbox_message_id"]
+            chat["unread_count"] = update["unread_count"]
+
+    def _on_user(self, update):
+        user = update["user"]
+        self.users.set(user["id"], User(**user))
+        if self._me is not None and self._me.id == user["id"]:
+            self._me = User(**user)
+
+    def _on_authorization(self, update):
+        if update["authorization_state"]["@type"] in LOGGED_OUT_STATES:
+            self._me = None
+
+    def _send_data(
+        self,
+        data: Dict[Any, Any],
+        result_id: Optional[str] = None,
+        block: bool = False,
+    ) -> AsyncResult:
+        if metrics.enabled:
+            # TDLib hands @extra back with the result
+            extra = data.setdefault("@extra", {})
+            extra["method"] = data["@type"]
+            extra["sent_at"] = time.perf_counter()
+        return super()._send_data(data, result_id, block)
+
+    def _update_async_result(self, update: Dict[Any, Any]) -> Optional[AsyncResult]:
+        r = super()._update_async_result(update)
+        if r is not None and r._ready.is_set():
+            extra = update.get("@extra")
+            if extra and "sent_at" in extra:
+                metrics.observe(
+                    "tdlib_request_seconds",
+                    time.perf_counter() - extra["sent_at"],
+                    extra["method"],
+                )
+            self._run_result_callbacks(r)
+        return r
+
+    def _run_result_callbacks(self, r: AsyncResult):
+        with self._result_callbacks_lock:
+            callbacks = self._result_callbacks.pop(r.id, [])
+        for callback in callbacks:
+            callback(r)
+
+    def add_done_callback(self, r: AsyncResult, callback: ResultCallback):
+        """
+        Call `callback` from the TDLib listener thread once `r` is ready,
+        or right away if it already is.
+        """
+        with self._result_callbacks_lock:
+            self._result_callbacks.setdefault(r.id, []).append(callback)
+        if r._ready.is_set():
+            self._run_result_callbacks(r)
+
+    def remove_done_callback(self, r: AsyncResult, callback: ResultCallback):
+        with self._result_callbacks_lock:
+            callbacks = self._result_callbacks.get(r.id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._result_callbacks.pop(r.id, None)
 
     def login(self):
         state = super().login(blocking=False)
@@ -30,61 +192,195 @@ class Client(Telegram):
             super().send_password(password)
             state = super().login(blocking=False)
 
-    def download_file(self, file_id: int):
-        r = super().call_method(
+        self._me = None
+        self.get_me()
+
+    def request_download(self, file_id: int, priority: int) -> AsyncResult:
+        """
+        Start or reprioritize an asynchronous download, progress is reported
+        through `updateFile`.
+        """
+        return super().call_method(
             "downloadFile",
             {
                 "file_id": file_id,
-                "priority": 32,
+                "priority": priority,
                 "offset": 0,
                 "limit": 0,
-                "synchronous": True,
+                "synchronous": False,
             },
-            block=True,
         )
-        if r.update is None:
-            raise ValueError("No download response")
-        result: Dict[Any, Any] = r.update
-        return File(**result)
 
-    def get_me(self):
+    def cancel_download(self, file_id: int) -> AsyncResult:
+        return super().call_method(
+            "cancelDownloadFile", {"file_id": file_id, "only_if_pending": False}
+        )
+
+    def delete_file(self, file_id: int) -> AsyncResult:
+        return super().call_method("deleteFile", {"file_id": file_id})
+
+    @property
+    def me(self) -> Optional[User]:
+        """The logged in user, None until it is known."""
+        return self._me
+
+    @me.setter
+    def me(self, user: Optional[User]):
+        self._me = user
+
+    def _parse_me(self, r: AsyncResult) -> int:
+        if not r.update:
+            return 0
+        self._me = User(**r.update)
+        self.users.set(self._me.id, self._me)
+        return self._me.id
+
+    def get_me(self) -> int:
+        if self._me is not None:
+            return self._me.id
         r = super().get_me()
         r.wait()
+        return self._parse_me(r)
+
+    def _request_user(self, user_id: int) -> AsyncResult:
+        # concurrent misses for the same id share a single request
+        with self._pending_users_lock:
+            r = self._pending_users.get(user_id)
+            if r is None:
+                r = super().get_user(user_id)
+                self._pending_users[user_id] = r
+            return r
+
+    def _parse_user(self, user_id: int, r: AsyncResult) -> User:
+        with self._pending_users_lock:
+            if self._pending_users.get(user_id) is r:
+                del self._pending_users[user_id]
+
         if not r.update:
-            return 0
-        return r.update.get("id", 0)
+            raise User.NotFound
+        user = User(**r.update)
+        self.users.set(user_id, user)
+        return user
 
     def get_user(self, user_id: int) -> User:
-        r = super().get_user(user_id)
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
+        r = self._request_user(user_id)
         r.wait()
+        return self._parse_user(user_id, r)
+
+    def _parse_chat(self, r: AsyncResult) -> Chat:
         if not r.update:
-            raise User.NotFound
-        return User(**r.update)
+            raise Chat.NotFound
+        return Chat(**r.update)
 
     def get_chat(self, chat_id: int):
+        if chat_id in self.chats:
+            return Chat(**self.chats[chat_id])
         r = super().get_chat(chat_id)
         r.wait()
+        return self._parse_chat(r)
+
+    def _parse_chat_ids(self, r: AsyncResult) -> List[int]:
         if not r.update:
             raise Chat.NotFound
-        return Chat(**r.update)
+        return r.update.get("chat_ids", [])
 
-    def get_chats(self):
+    def get_chats(self) -> List[Chat]:
         r = super().get_chats()
         r.wait()
-        if not r.update:
-            raise Chat.NotFound
-        chat_ids = r.update.get("chat_ids", [])
+        return self.get_chats_many(self._parse_chat_ids(r))
+
+    def _request_chats(self, chat_ids: List[int]) -> Dict[int, AsyncResult]:
+        pending = {}
         for chat_id in chat_ids:
-            yield self.get_chat(chat_id)
+            if chat_id not in self.chats:
+                pending[chat_id] = super().get_chat(chat_id)
+        return pending
 
-    def get_chat_history(self, chat_id: int):
-        r = super().get_chat_history(chat_id)
-        r.wait()
+    def _parse_chats(
+        self, chat_ids: List[int], pending: Dict[int, AsyncResult]
+    ) -> List[Chat]:
+        chats: List[Chat] = []
+        with metrics.timer("parse_seconds", "Chat"):
+            for chat_id in chat_ids:
+                r = pending.get(chat_id)
+                if r is None:
+                    chats.append(Chat(**self.chats[chat_id]))
+                else:
+                    chats.append(self._parse_chat(r))
+        return chats
+
+    def get_chats_many(self, chat_ids: List[int]) -> List[Chat]:
+        """
+        Chats already announced by TDLib through `updateNewChat` are read
+        locally, the remaining `getChat` requests are sent at once and
+        awaited together.
+        """
+        pending = self._request_chats(chat_ids)
+        for r in pending.values():
+            r.wait()
+        return self._parse_chats(chat_ids, pending)
+
+    def _request_history_page(
+        self, chat_id: int, from_message_id: int, limit: int, offset: int
+    ) -> AsyncResult:
+        return Telegram.get_chat_history(
+            self,
+            chat_id,
+            limit=min(limit, MAX_HISTORY_PAGE_SIZE),
+            from_message_id=from_message_id,
+            offset=offset,
+        )
+
+    def _parse_history_page(
+        self, r: AsyncResult, seen: Set[int]
+    ) -> Optional[List[dict]]:
+        """The messages not received before, None if the request failed."""
         if not r.update:
-            return []
-        messages = r.update.get("messages", [])
-        messages.reverse()
-        return [Message(**m) for m in messages]
+            return None
+        page = [m for m in r.update.get("messages", []) if m["id"] not in seen]
+        seen.update(m["id"] for m in page)
+        return page
+
+    def _parse_history(self, messages: List[dict], has_older: bool) -> History:
+        messages.sort(key=lambda m: m["id"])
+        with metrics.timer("parse_seconds", "Message"):
+            return History((Message.from_tdlib(m) for m in messages), has_older)
+
+    def get_chat_history(
+        self,
+        chat_id: int,
+        from_message_id: int = 0,
+        limit: int = HISTORY_PAGE_SIZE,
+        offset: int = 0,
+    ) -> History:
+        """
+        TDLib may answer with fewer messages than asked for even when more
+        are available, so keep asking from the oldest message received until
+        `limit` messages arrived or the history is exhausted.
+        """
+        messages: List[dict] = []
+        seen: Set[int] = set()
+        has_older = True
+        while len(messages) < limit:
+            r = self._request_history_page(
+                chat_id,
+                from_message_id,
+                _page_limit(messages, limit, from_message_id),
+                offset,
+            )
+            r.wait()
+            page = self._parse_history_page(r, seen)
+            if page is None:
+                break
+            if not page:
+                has_older = False
+                break
+            messages.extend(page)
+            from_message_id, offset = page[-1]["id"], 0
+        return self._parse_history(messages, has_older)
 
     def send_message(self, chat_id: int, text: str):
         r = super().send_message(chat_id, text)
@@ -92,3 +388,200 @@ class Client(Telegram):
         if not r.update:
             return "no update"
         return r
+
+
+class AsyncClient:
+    """
+    Awaitable facade over `Client`.
+
+    Requests are sent once the client is logged in and their futures are
+    completed from python-telegram's listener thread, so awaiting never
+    blocks the event loop. Cancelling an awaiting task drops the result once
+    it arrives.
+    """
+
+    def __init__(self, client: Client) -> None:
+        self.client = client
+        self.authorized = asyncio.Event()
+        if client.authorization_state == AuthorizationState.READY:
+            self.authorized.set()
+        self.downloads = DownloadManager(client)
+        self.prefetcher = PhotoPrefetcher(self.downloads)
+        self.index = MessageIndex(
+            INDEX_PATH or os.path.join(client.files_directory, "index.sqlite3")
+        )
+        self.updates = UpdateDispatcher(client)
+        self.updates.add_handler("updateNewMessage", self._on_new_messages)
+        self.updates.add_handler("updateMessageContent", self._on_message_contents)
+        self.updates.add_handler(
+            "updateMessageInteractionInfo", self._on_message_interaction_infos
+        )
+        self.updates.add_handler("updateDeleteMessages", self._on_delete_messages)
+        self.updates.add_handler("updateMessageSendSucceeded", self._on_messages_sent)
+        self.updates.add_handler("updateMessageSendFailed", self._on_messages_sent)
+        self.outbox = Outbox(self)
+
+    def _on_new_messages(self, updates: List[UpdateNewMessage]):
+        for update in updates:
+            self.client.history_cache.add_message(update.message)
+        self.index.add(update.message for update in updates)
+
+    def _on_message_contents(self, updates: List[UpdateMessageContent]):
+        for update in updates:
+            self.client.history_cache.update_message(
+                update.chat_id, update.message_id, content=update.new_content
+            )
+            self.index.update_text(
+                update.chat_id,
+                update.message_id,
+                update.new_content.searchable_text,
+            )
+
+    def _on_message_interaction_infos(
+        self, updates: List[UpdateMessageInteractionInfo]
+    ):
+        for update in updates:
+            self.client.history_cache.update_message(
+                update.chat_id,
+                update.message_id,
+                interaction_info=update.interaction_info,
+            )
+
+    def _on_delete_messages(self, updates: List[UpdateDeleteMessages]):
+        for update in updates:
+            if update.is_permanent:
+                self.client.history_cache.remove_messages(
+                    update.chat_id, update.message_ids
+                )
+                self.index.remove(update.chat_id, update.message_ids)
+
+    def _on_messages_sent(
+        self, updates: List[Union[UpdateMessageSendSucceeded, UpdateMessageSendFailed]]
+    ):
+        # the message leaves its temporary id for the server one, or a failed one
+        for update in updates:
+            message = update.message
+            self.client.history_cache.replace_message(
+                message.chat_id, update.old_message_id, message
+            )
+            self.index.remove(message.chat_id, [update.old_message_id])
+        self.index.add(update.message for update in updates)
+
+    async def login(self) -> AuthorizationState:
+        """
+        Log in with the session TDLib already holds, without prompting. Any
+        other state than `READY` means the user has to log in again.
+        """
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(
+            None, partial(Telegram.login, self.client, blocking=False)
+        )
+        if state == AuthorizationState.READY:
+            self.authorized.set()
+        return state
+
+    async def _request(
+        self, method: Callable[..., AsyncResult], *args: Any
+    ) -> AsyncResult:
+        await self.authorized.wait()
+        return await self._wait(method(*args))
+
+    async def _wait(self, r: AsyncResult) -> AsyncResult:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[AsyncResult] = loop.create_future()
+
+        def resolve(result: AsyncResult):
+            loop.call_soon_threadsafe(_set_result, future, result)
+
+        self.client.add_done_callback(r, resolve)
+        try:
+            return await future
+        finally:
+            self.client.remove_done_callback(r, resolve)
+
+    async def get_me(self) -> int:
+        if self.client.me is not None:
+            return self.client.me.id
+        r = await self._request(Telegram.get_me, self.client)
+        return self.client._parse_me(r)
+
+    async def get_user(self, user_id: int) -> User:
+        user = self.client.users.get(user_id)
+        if user is not None:
+            return user
+        r = await self._request(self.client._request_user, user_id)
+        return self.client._parse_user(user_id, r)
+
+    async def get_users(self, user_ids: List[int]) -> Dict[int, User]:
+        unique_ids = list(dict.fromkeys(user_ids))
+        users = await asyncio.gather(*(self.get_user(i) for i in unique_ids))
+        return dict(zip(unique_ids, users))
+
+    async def get_chat(self, chat_id: int) -> Chat:
+        if chat_id in self.client.chats:
+            return Chat(**self.client.chats[chat_id])
+        r = await self._request(Telegram.get_chat, self.client, chat_id)
+        return self.client._parse_chat(r)
+
+    async def get_chats(self) -> List[Chat]:
+        r = await self._request(Telegram.get_chats, self.client)
+        return await self.get_chats_many(self.client._parse_chat_ids(r))
+
+    async def get_chats_many(self, chat_ids: List[int]) -> List[Chat]:
+        await self.authorized.wait()
+        pending = self.client._request_chats(chat_ids)
+        await asyncio.gather(*(self._wait(r) for r in pending.values()))
+        return self.client._parse_chats(chat_ids, pending)
+
+    async def get_chat_history(
+        self,
+        chat_id: int,
+        from_message_id: int = 0,
+        limit: int = HISTORY_PAGE_SIZE,
+        offset: int = 0,
+    ) -> History:
+        messages: List[dict] = []
+        seen: Set[int] = set()
+        has_older = True
+        while len(messages) < limit:
+            r = await self._request(
+                self.client._request_history_page,
+                chat_id,
+                from_message_id,
+                _page_limit(messages, limit, from_message_id),
+                offset,
+            )
+            page = self.client._parse_history_page(r, seen)
+            if page is None:
+                break
+            if not page:
+                has_older = False
+                break
+            messages.extend(page)
+            from_message_id, offset = page[-1]["id"], 0
+        parsed = self.client._parse_history(messages, has_older)
+        self.index.add(parsed)
+        return parsed
+
+    async def send_message(self, chat_id: int, text: str) -> AsyncResult:
+        """Hand a message to TDLib, `Outbox.send` also shows it right away."""
+        return await self._request(Telegram.send_message, self.client, chat_id, text)
+
+    async def resend_messages(
+        self, chat_id: int, message_ids: List[int]
+    ) -> AsyncResult:
+        return await self._request(
+            self.client.call_method,
+            "resendMessages",
+            {"chat_id": chat_id, "message_ids": message_ids},
+        )
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _page_limit(messages: List[dict], limit: int, from_message_id: int) -> int:
+    # a page from a message can start with that message, which is not new
+    return limit - len(messages) + (1 if from_message_id else 0)
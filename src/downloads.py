@@ -0,0 +1,345 @@
+import asyncio
+import heapq
+import itertools
+import os
+from collections import OrderedDict
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from telegram.utils import AsyncResult
+
+from models import File, HasDownloadableImage, Message
+
+if TYPE_CHECKING:
+    from client import Client
+
+# TDLib download priorities go from 1 (lowest) to 32 (highest)
+PRIORITY_SELECTED = 32
+PRIORITY_DEFAULT = 16
+PRIORITY_PREFETCH = 1
+
+MAX_PARALLEL_DOWNLOADS = 3
+
+# photos within this many messages of the cursor are prefetched, 0 disables it
+PREFETCH_RADIUS = int(os.getenv("TELEGRAM_PREFETCH_RADIUS", 0))
+PREFETCH_BUDGET = int(os.getenv("TELEGRAM_PREFETCH_BUDGET_MB", 200)) * 1024 * 1024
+
+
+class Download:
+    def __init__(self, file_id: int, priority: int, future: asyncio.Future) -> None:
+        self.file_id = file_id
+        self.priority = priority
+        self.future: asyncio.Future[File] = future
+        self.file: Optional[File] = None
+        self.started = False
+
+    @property
+    def done(self) -> bool:
+        return self.future.done()
+
+    @property
+    def failed(self) -> bool:
+        return self.done and (self.future.cancelled() or bool(self.future.exception()))
+
+    @property
+    def progress(self) -> float:
+        if self.file is None:
+            return 0.0
+        if self.file.local.is_downloading_completed:
+            return 1.0
+        size = self.file.size or self.file.expected_size
+        return self.file.local.downloaded_size / size if size else 0.0
+
+
+ProgressCallback = Callable[[Download], None]
+
+
+class DownloadManager:
+    """
+    Asynchronous TDLib downloads, tracked through `updateFile`.
+
+    Requests for the same file share one download. At most `max_parallel`
+    downloads run at once, the rest wait by priority, except selected ones
+    which start right away.
+    """
+
+    def __init__(self, client: "Client", max_parallel: int = MAX_PARALLEL_DOWNLOADS):
+        self.client = client
+        self.max_parallel = max_parallel
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.downloads: Dict[int, Download] = {}
+        self._listeners: Dict[int, List[ProgressCallback]] = {}
+        self._queue: List[Tuple[int, int, int]] = []
+        self._active: Set[int] = set()
+        self._counter = itertools.count()
+        client.add_update_handler("updateFile", self._on_update_file)
+
+    async def download(self, file_id: int, priority: int = PRIORITY_DEFAULT) -> File:
+        download = self.start(file_id, priority)
+        # one caller giving up must not cancel the download for the others
+        return await asyncio.shield(download.future)
+
+    def start(self, file_id: int, priority: int = PRIORITY_DEFAULT) -> Download:
+        """Request a download without waiting for it."""
+        self.loop = asyncio.get_running_loop()
+        download = self.downloads.get(file_id)
+        if download is None or download.failed:
+            download = Download(file_id, priority, self.loop.create_future())
+            self.downloads[file_id] = download
+            self._enqueue(download)
+        else:
+            self.prioritize(file_id, priority)
+        return download
+
+    def cancel(self, file_id: int):
+        download = self.downloads.get(file_id)
+        if download is None or download.done:
+            return
+        if download.started:
+            self.client.cancel_download(file_id)
+        self._active.discard(file_id)
+        download.future.cancel()
+        self._notify(download)
+        self._pump()
+
+    def delete(self, file_id: int):
+        """Cancel a download and remove the file from disk."""
+        self.cancel(file_id)
+        self.downloads.pop(file_id, None)
+        self.client.delete_file(file_id)
+
+    def prioritize(self, file_id: int, priority: int = PRIORITY_SELECTED):
+        download = self.downloads.get(file_id)
+        if download is None or download.done or priority <= download.priority:
+            return
+        download.priority = priority
+        if file_id in self._active:
+            # asking again is how TDLib changes the priority of a download
+            self._start(download)
+        else:
+            self._enqueue(download)
+
+    def subscribe(self, file_id: int, callback: ProgressCallback):
+        self._listeners.setdefault(file_id, []).append(callback)
+
+    def unsubscribe(self, file_id: int, callback: ProgressCallback):
+        listeners = self._listeners.get(file_id, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners:
+            self._listeners.pop(file_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._active),
+            "queued": sum(1 for d in self.downloads.values() if not d.done)
+            - len(self._active),
+            "completed": sum(1 for d in self.downloads.values() if d.done),
+        }
+
+    def _enqueue(self, download: Download):
+        entry = (-download.priority, next(self._counter), download.file_id)
+        heapq.heappush(self._queue, entry)
+        self._pump()
+
+    def _pump(self):
+        while self._queue:
+            priority, _, file_id = self._queue[0]
+            download = self.downloads.get(file_id)
+            stale = (
+                download is None
+                or download.done
+                or file_id in self._active
+                or -priority != download.priority
+            )
+            if stale:
+                heapq.heappop(self._queue)
+                continue
+            assert download is not None
+            busy = len(self._active) >= self.max_parallel
+            if busy and download.priority < PRIORITY_SELECTED:
+                break
+            heapq.heappop(self._queue)
+            self._start(download)
+
+    def _start(self, download: Download):
+        assert self.loop is not None
+        download.started = True
+        self._active.add(download.file_id)
+        r = self.client.request_download(download.file_id, download.priority)
+        self.client.add_done_callback(
+            r, partial(self.loop.call_soon_threadsafe, self._on_started, download)
+        )
+
+    def _on_started(self, download: Download, r: AsyncResult):
+        if download.done:
+            return
+        if r.error or not r.update:
+            self._finish(
+                download, error=RuntimeError(f"Telegram error: {r.error_info}")
+            )
+            return
+        self._update(download, File.from_tdlib(r.update))
+
+    def _on_update_file(self, update):
+        # runs on python-telegram's worker thread
+        if self.loop is not None and update["file"]["id"] in self.downloads:
+            self.loop.call_soon_threadsafe(self._file_updated, update["file"])
+
+    def _file_updated(self, data: Dict[str, Any]):
+        download = self.downloads.get(data["id"])
+        if download is None or download.done:
+            return
+        file = File.from_tdlib(data)
+        self._update(download, file)
+        local = file.local
+        # a queued file is inactive until it is started, e.g. a prefetched one
+        if (
+            download.started
+            and not local.is_downloading_completed
+            and not local.is_downloading_active
+        ):
+            self._finish(download, error=RuntimeError("Download was interrupted"))
+
+    def _update(self, download: Download, file: File):
+        download.file = file
+        if file.local.is_downloading_completed:
+            self._finish(download, file=file)
+        else:
+            self._notify(download)
+
+    def _finish(
+        self,
+        download: Download,
+        file: Optional[File] = None,
+        error: Optional[Exception] = None,
+    ):
+        self._active.discard(download.file_id)
+        if error is not None:
+            download.future.set_exception(error)
+            # mark the exception as retrieved, callers get it through the shield
+            download.future.exception()
+        else:
+            download.future.set_result(file)
+        self._notify(download)
+        self._pump()
+
+    def _notify(self, download: Download):
+        for callback in list(self._listeners.get(download.file_id, [])):
+            callback(download)
+
+
+class PhotoPrefetcher:
+    """
+    Speculative low priority downloads of full size photos near the cursor.
+
+    Prefetched files that were never opened take at most `budget` bytes of
+    disk, the least recently wanted ones are deleted to make room.
+    """
+
+    def __init__(
+        self,
+        downloads: DownloadManager,
+        radius: int = PREFETCH_RADIUS,
+        budget: int = PREFETCH_BUDGET,
+    ) -> None:
+        self.downloads = downloads
+        self.radius = radius
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._prefetched: OrderedDict[int, int] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.radius > 0
+
+    def update(self, messages: Sequence[Message], cursor: int):
+        if not self.enabled:
+            return
+        nearby = range(
+            max(cursor - self.radius, 0), min(cursor + self.radius + 1, len(messages))
+        )
+        wanted: Dict[int, int] = {}
+        for i in sorted(nearby, key=lambda i: abs(i - cursor)):
+            content = messages[i].content
+            if not isinstance(content, HasDownloadableImage):
+                continue
+            file = content.downloadable_image
+            if not file.local.is_downloading_completed:
+                wanted[file.id] = file.size or file.expected_size
+
+        for file_id in list(self._prefetched):
+            download = self.downloads.downloads.get(file_id)
+            # queued prefetches the cursor moved away from are not worth starting
+            if file_id not in wanted and download is not None and not download.started:
+                self.downloads.cancel(file_id)
+                self.used -= self._prefetched.pop(file_id)
+
+        for file_id, size in wanted.items():
+            if file_id in self._prefetched:
+                self._prefetched.move_to_end(file_id)
+                continue
+            download = self.downloads.downloads.get(file_id)
+            if download is not None and not download.failed:
+                continue
+            if not self._make_room(size, wanted):
+                continue
+            self.downloads.start(file_id, PRIORITY_PREFETCH)
+            self._prefetched[file_id] = size
+            self.used += size
+
+    def opened(self, file: File):
+        """Account for the user opening a file, opened files are kept for good."""
+        if not self.enabled or file.local.is_downloading_completed:
+            return
+        size = self._prefetched.pop(file.id, None)
+        if size is not None:
+            self.used -= size
+        download = self.downloads.downloads.get(file.id)
+        if (
+            size is not None
+            and download is not None
+            and download.done
+            and not download.failed
+        ):
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "prefetched": len(self._prefetched),
+            "used": self.used,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def _make_room(self, size: int, wanted: Dict[int, int]) -> bool:
+        if size > self.budget:
+            return False
+        for file_id in list(self._prefetched):
+            if self.used + size <= self.budget:
+                break
+            if file_id not in wanted:
+                self.used -= self._prefetched.pop(file_id)
+                self.downloads.delete(file_id)
+        return self.used + size <= self.budget
@@ -0,0 +1,249 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Tuple, TypeVar
+
+# set either to record, histograms are also recorded while the stats panel
+# is open
+METRICS_ENABLED = os.getenv("TELEGRAM_METRICS", "") not in ("", "0")
+# .json for JSON, anything else for Prometheus text
+METRICS_PATH = os.getenv("TELEGRAM_METRICS_PATH", "")
+METRICS_DUMP_INTERVAL = float(os.getenv("TELEGRAM_METRICS_DUMP_INTERVAL", 10))
+
+# values are kept in microseconds with 5 significant bits, within 3%
+_SUB_BITS = 5
+_SUB_COUNT = 1 << _SUB_BITS
+_HALF_COUNT = _SUB_COUNT >> 1
+QUANTILES = (0.5, 0.9, 0.99)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Histogram:
+    """
+    HDR style histogram of durations.
+
+    Buckets are linear up to 32µs, then every power of two is split into 16
+    buckets, recording is O(1) and memory grows with the log of the range.
+    """
+
+    def __init__(self) -> None:
+        self.counts: List[int] = []
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        value = int(seconds * 1_000_000)
+        if value < _SUB_COUNT:
+            index = max(value, 0)
+        else:
+            shift = value.bit_length() - _SUB_BITS
+            index = shift * _HALF_COUNT + (value >> shift)
+        with self._lock:
+            if index >= len(self.counts):
+                self.counts.extend([0] * (index + 1 - len(self.counts)))
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """The value in seconds `q` of the recorded values are under."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(_bucket_middle(index), self.max)
+        return self.max
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            **{f"p{q * 100:g}": self.percentile(q) for q in QUANTILES},
+        }
+
+
+def _bucket_middle(index: int) -> float:
+    if index < _SUB_COUNT:
+        return index / 1_000_000
+    shift = index // _HALF_COUNT - 1
+    low = (index - shift * _HALF_COUNT) << shift
+    return (low + (1 << shift) / 2) / 1_000_000
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.histogram.record(time.perf_counter() - self.started)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc: Any):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+# a histogram per metric name and label
+Key = Tuple[str, str]
+
+
+class Metrics:
+    """
+    Named histograms with one label, e.g. the TDLib method of a request.
+
+    When disabled `timer` hands out a shared do-nothing context manager and
+    `observe` returns right away, so instrumented code pays for an
+    attribute lookup and a call.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.histograms: Dict[Key, Histogram] = {}
+        self.label_names: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, label: str = "") -> Histogram:
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((name, label), Histogram())
+        return histogram
+
+    def observe(self, name: str, seconds: float, label: str = ""):
+        if self.enabled:
+            self.histogram(name, label).record(seconds)
+
+    def timer(self, name: str, label: str = ""):
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self.histogram(name, label))
+
+    def timed(self, name: str, label: str = "") -> Callable[[F], F]:
+        """Decorate a function to time its calls."""
+
+        def decorate(f: F) -> F:
+            @wraps(f)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with _Timer(self.histogram(name, label)):
+                    return f(*args, **kwargs)
+
+            return wrapper  # type: ignore
+
+        return decorate
+
+    def set_label_name(self, name: str, label_name: str):
+        """Name the label of a metric in the Prometheus output."""
+        self.label_names[name] = label_name
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            f"{name}{{{label}}}" if label else name: histogram.stats()
+            for (name, label), histogram in sorted(self.histograms.items())
+        }
+
+    def to_json(self, components: Dict[str, Dict[str, Any]]) -> str:
+        return json.dumps(
+            {"time": time.time(), "histograms": self.stats(), **components},
+            indent=2,
+        )
+
+    def to_prometheus(self, components: Dict[str, Dict[str, Any]]) -> str:
+        lines = []
+        names = sorted({name for name, _ in self.histograms})
+        for name in names:
+            metric = f"telegram_{name}"
+            label_name = self.label_names.get(name, "label")
+            lines.append(f"# TYPE {metric} summary")
+            for (other, label), histogram in sorted(self.histograms.items()):
+                if other != name:
+                    continue
+                labels = f'{label_name}="{_escape(label)}"' if label else ""
+                for q in QUANTILES:
+                    quantile = f'quantile="{q}"'
+                    lines.append(
+                        f"{metric}{{{_join(labels, quantile)}}} "
+                        f"{histogram.percentile(q):.6g}"
+                    )
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{metric}_sum{suffix} {histogram.sum:.6g}")
+                lines.append(f"{metric}_count{suffix} {histogram.count}")
+        for component, stats in components.items():
+            for path, value in _flatten(stats):
+                metric = _metric_name(f"telegram_{component}_{path}")
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {float(value):.6g}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str, components: Dict[str, Dict[str, Any]]):
+        """Write the metrics to `path`, JSON for a .json file."""
+        if path.endswith(".json"):
+            text = self.to_json(components)
+        else:
+            text = self.to_prometheus(components)
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # scrapers only ever see a complete file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _flatten(stats: Dict[str, Any], prefix: str = "") -> Iterator[Tuple[str, Any]]:
+    for key, value in stats.items():
+        path = f"{prefix}_{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            yield from _flatten(value, path)
+        elif isinstance(value, (int, float)):
+            yield path, value
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def _escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _join(*labels: str) -> str:
+    return ",".join(label for label in labels if label)
+
+
+metrics = Metrics(METRICS_ENABLED or bool(METRICS_PATH))
+metrics.set_label_name("tdlib_request_seconds", "method")
+metrics.set_label_name("parse_seconds", "model")
+metrics.set_label_name("compose_seconds", "widget")
+metrics.set_label_name("mount_seconds", "widget")
+metrics.set_label_name("render_line_seconds", "widget")
+metrics.set_label_name("render_seconds", "kind")
+metrics.set_label_name("frame_seconds", "stage")
@@ -1,15 +1,174 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import List, Literal, Optional, Union
+from typing import (
+    Annotated,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+    get_origin,
+)
 
 from pydantic import BaseModel as _BaseModel
-from pydantic import Field
+from pydantic import Field, parse_obj_as
+from pydantic.datetime_parse import parse_datetime
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+
+M = TypeVar("M", bound="BaseModel")
 
 
 class BaseModel(_BaseModel):
     class NotFound(Exception):
         pass
 
+    @classmethod
+    def from_tdlib(cls: Type[M], data: Dict[str, Any]) -> M:
+        """
+        Build a model from a trusted TDLib payload, only leaves that need
+        converting are validated. Payloads of an unexpected shape go
+        through full validation instead.
+        """
+        try:
+            return _builder(cls)(data)
+        except (_Mismatch, TypeError):
+            return cls(**data)
+
+
+class _Mismatch(Exception):
+    pass
+
+
+_builders: Dict[type, Callable[[Any], Any]] = {}
+_MISSING = object()
+
+
+def _compile(model: Type[BaseModel]) -> Callable[[Any], Any]:
+    """
+    Generate straight-line code building `model` without validation. Fields
+    holding models are built recursively and plain values of the expected
+    type are taken as they are, anything else goes through the field's
+    validator.
+    """
+    namespace: Dict[str, Any] = {
+        "_Mismatch": _Mismatch,
+        "_MISSING": _MISSING,
+        "_new": model.__new__,
+        "_setattr": object.__setattr__,
+        "_model": model,
+    }
+    lines = [
+        "def build(data):",
+        "    if data.__class__ is not dict:",
+        "        raise _Mismatch",
+        "    get = data.get",
+        "    values = {}",
+    ]
+    required = []
+    for i, (name, field) in enumerate(model.__fields__.items()):
+        namespace[f"field_{i}"] = field
+        lines.append(f"    v = get({field.alias!r}, _MISSING)")
+        if field.required:
+            required.append(name)
+            lines += ["    if v is _MISSING:", "        raise _Mismatch"]
+        else:
+            lines += [
+                "    if v is _MISSING:",
+                f"        v = field_{i}.get_default()",
+                "    else:",
+                f"        fields_set_add({name!r})",
+            ]
+        lines += ["    if v is None:"]
+        lines += ["        pass" if field.allow_none else "        raise _Mismatch"]
+        type_ = field.type_
+        if field.discriminator_key is not None and field.sub_fields_mapping:
+            namespace[f"union_{i}"] = {
+                k: _builder(f.type_) for k, f in field.sub_fields_mapping.items()
+            }
+            lines += [
+                "    elif v.__class__ is not dict:",
+                "        raise _Mismatch",
+                "    else:",
+                f"        sub = union_{i}.get(v.get({field.discriminator_alias!r}))",
+                "        if sub is None:",
+                "            raise _Mismatch",
+                "        v = sub(v)",
+            ]
+        elif isinstance(type_, type) and issubclass(type_, BaseModel):
+            namespace[f"sub_{i}"] = _builder(type_)
+            if field.shape == SHAPE_SINGLETON:
+                lines += ["    else:", f"        v = sub_{i}(v)"]
+            elif field.shape == SHAPE_LIST:
+                lines += [
+                    "    elif v.__class__ is not list:",
+                    "        raise _Mismatch",
+                    "    else:",
+                    f"        v = [sub_{i}(x) for x in v]",
+                ]
+            else:
+                lines += ["    else:", f"        v = _validate(field_{i}, v)"]
+        elif field.shape == SHAPE_SINGLETON and get_origin(type_) is Literal:
+            namespace[f"literal_{i}"] = frozenset(get_args(type_))
+            lines += [
+                f"    elif v not in literal_{i}:",
+                f"        v = _validate(field_{i}, v)",
+            ]
+        elif field.shape == SHAPE_SINGLETON and type_ is datetime:
+            lines += ["    else:", "        v = _parse_datetime(v)"]
+        elif field.shape == SHAPE_SINGLETON and type_ in (int, str, bool, float):
+            namespace[f"type_{i}"] = type_
+            lines += [
+                f"    elif v.__class__ is not type_{i}:",
+                f"        v = _validate(field_{i}, v)",
+            ]
+        else:
+            lines += ["    else:", f"        v = _validate(field_{i}, v)"]
+        lines.append(f"    values[{name!r}] = v")
+
+    lines[5:5] = [
+        f"    fields_set = set({tuple(required)!r})",
+        "    fields_set_add = fields_set.add",
+    ]
+    lines += [
+        "    m = _new(_model)",
+        "    _setattr(m, '__dict__', values)",
+        "    _setattr(m, '__fields_set__', fields_set)",
+    ]
+    if model.__private_attributes__:
+        lines.append("    m._init_private_attributes()")
+    lines.append("    return m")
+
+    def _validate(field: ModelField, value: Any) -> Any:
+        value, errors = field.validate(value, {}, loc=field.alias, cls=model)
+        if errors:
+            raise _Mismatch
+        return value
+
+    namespace["_validate"] = _validate
+    namespace["_parse_datetime"] = _parse_datetime
+    exec("\n".join(lines), namespace)
+    return namespace["build"]
+
+
+def _parse_datetime(value: Any) -> datetime:
+    try:
+        return parse_datetime(value)
+    except (ValueError, TypeError):
+        raise _Mismatch
+
+
+def _builder(model: Type[BaseModel]) -> Callable[[Any], Any]:
+    builder = _builders.get(model)
+    if builder is None:
+        builder = _builders[model] = _compile(model)
+    return builder
+
 
 class User(BaseModel):
     id: int
@@ -21,9 +180,35 @@ class User(BaseModel):
         return f"{self.first_name} {self.last_name}"
 
 
+class ChatList(BaseModel):
+    tdlib_type: str = Field(..., alias="@type")
+
+
+class ChatPosition(BaseModel):
+    chat_list: ChatList = Field(..., alias="list")
+    order: int
+    is_pinned: bool
+
+    @property
+    def is_main(self) -> bool:
+        return self.chat_list.tdlib_type == "chatListMain"
+
+
 class Chat(BaseModel):
     id: int
     title: str
+    positions: List[ChatPosition] = []
+    unread_count: int = 0
+
+    @property
+    def order(self) -> int:
+        """Position in the main chat list, 0 when the chat is not in it."""
+        return next((p.order for p in self.positions if p.is_main), 0)
+
+    @property
+    def list_key(self) -> Tuple[int, int]:
+        """Sort key of the main chat list, by descending order then id."""
+        return -self.order, -self.id
 
 
 class MessageSender(BaseModel):
@@ -57,6 +242,11 @@ class MessageContent(ABC):
     def renderable_text(self):
         pass
 
+    @property
+    def searchable_text(self) -> str:
+        """The text the message index matches."""
+        return self.renderable_text or ""
+
 
 class HasImage(ABC):
     has_image: bool = True
@@ -66,15 +256,28 @@ class HasImage(ABC):
     def image_data(self) -> Optional[bytes]:
         pass
 
+    @property
+    @abstractmethod
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        pass
+
+    @abstractmethod
+    def with_image_data(self, data: bytes) -> "HasImage":
+        pass
+
 
 class HasDownloadableImage(ABC):
     has_downloadable_image: bool = True
 
     @property
     @abstractmethod
-    def downloadable_image_id(self) -> int:
+    def downloadable_image(self) -> "File":
         pass
 
+    @property
+    def downloadable_image_id(self) -> int:
+        return self.downloadable_image.id
+
 
 class MessageText(BaseModel, MessageContent):
     tdlib_type: Literal["messageText"] = Field(..., alias="@type")
@@ -140,6 +343,9 @@ class MessageAnimatedEmoji(BaseModel, MessageContent):
 
 class LocalFile(BaseModel):
     path: str
+    is_downloading_active: bool = False
+    is_downloading_completed: bool = False
+    downloaded_size: int = 0
 
 
 class File(BaseModel):
@@ -170,6 +376,19 @@ class MessageDocument(BaseModel, MessageContent, HasImage):
     def image_data(self) -> Optional[bytes]:
         return self.document.minithumbnail.data if self.document.minithumbnail else None
 
+    @property
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        thumbnail = self.document.minithumbnail
+        return (thumbnail.width, thumbnail.height) if thumbnail else None
+
+    def with_image_data(self, data: bytes) -> "MessageDocument":
+        thumbnail = self.document.minithumbnail
+        if thumbnail is None:
+            return self
+        thumbnail = thumbnail.copy(update={"data": data})
+        document = self.document.copy(update={"minithumbnail": thumbnail})
+        return self.copy(update={"document": document})
+
 
 class Sizes(BaseModel):
     type: str
@@ -193,17 +412,66 @@ class MessagePhoto(BaseModel, MessageContent, HasImage, HasDownloadableImage):
     def renderable_text(self):
         return "Photo"
 
+    @property
+    def searchable_text(self) -> str:
+        return self.caption.text or self.renderable_text
+
     @property
     def image_data(self) -> Optional[bytes]:
         return self.photo.minithumbnail.data if self.photo.minithumbnail else None
 
     @property
-    def downloadable_image_id(self) -> int:
-        return self.photo.sizes[-1].photo.id
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        thumbnail = self.photo.minithumbnail
+        return (thumbnail.width, thumbnail.height) if thumbnail else None
+
+    def with_image_data(self, data: bytes) -> "MessagePhoto":
+        thumbnail = self.photo.minithumbnail
+        if thumbnail is None:
+            return self
+        thumbnail = thumbnail.copy(update={"data": data})
+        photo = self.photo.copy(update={"minithumbnail": thumbnail})
+        return self.copy(update={"photo": photo})
+
+    @property
+    def downloadable_image(self) -> File:
+        return self.photo.sizes[-1].photo
+
+
+AnyMessageContent = Annotated[
+    Union[
+        MessageText,
+        MessageDocument,
+        MessageSticker,
+        MessageAnimatedEmoji,
+        MessagePhoto,
+        MessageContactRegistered,
+    ],
+    Field(discriminator="tdlib_type"),
+]
+
+
+class MessageSendingStatePending(BaseModel):
+    tdlib_type: Literal["messageSendingStatePending"] = Field(..., alias="@type")
+
+
+class MessageSendingStateFailed(BaseModel):
+    tdlib_type: Literal["messageSendingStateFailed"] = Field(..., alias="@type")
+    error_code: int = 0
+    error_message: str = ""
+    can_retry: bool = False
+    retry_after: float = 0
+
+
+MessageSendingState = Annotated[
+    Union[MessageSendingStatePending, MessageSendingStateFailed],
+    Field(discriminator="tdlib_type"),
+]
 
 
 class Message(BaseModel):
     id: int
+    chat_id: int
     sender_id: MessageSender
     is_outgoing: bool
     is_pinned: bool
@@ -222,18 +490,80 @@ class Message(BaseModel):
     date: datetime
     edit_date: int
     interaction_info: Optional[MessageInteractionInfo]
+    # only set on outgoing messages that have not reached the server
+    sending_state: Optional[MessageSendingState] = None
 
-    content: Union[
-        MessageText,
-        MessageDocument,
-        MessageSticker,
-        MessageAnimatedEmoji,
-        MessagePhoto,
-        MessageContactRegistered,
-    ] = Field(..., discriminator="tdlib_type")
+    content: AnyMessageContent
+
+    @staticmethod
+    def parse_content(data: dict) -> AnyMessageContent:
+        return parse_obj_as(AnyMessageContent, data)
 
     @property
     def renderable_text(self):
         if isinstance(self.content, MessagePhoto):
             return self.content.renderable_text
         return f"{self.content.__class__.__name__}: {self.content.renderable_text}"
+
+
+class UpdateNewMessage(BaseModel):
+    message: Message
+
+
+class UpdateMessageContent(BaseModel):
+    chat_id: int
+    message_id: int
+    new_content: AnyMessageContent
+
+
+class UpdateMessageInteractionInfo(BaseModel):
+    chat_id: int
+    message_id: int
+    interaction_info: Optional[MessageInteractionInfo]
+
+
+class UpdateDeleteMessages(BaseModel):
+    chat_id: int
+    message_ids: List[int]
+    is_permanent: bool
+    from_cache: bool
+
+
+class UpdateMessageSendSucceeded(BaseModel):
+    message: Message
+    old_message_id: int
+
+
+class UpdateMessageSendFailed(BaseModel):
+    message: Message
+    old_message_id: int
+    error_code: int = 0
+    error_message: str = ""
+
+
+class UpdateChatLastMessage(BaseModel):
+    # last_message is left out, its content may be of a type without a model
+    chat_id: int
+    positions: List[ChatPosition]
+
+
+class UpdateChatPosition(BaseModel):
+    chat_id: int
+    position: ChatPosition
+
+
+class UpdateChatReadInbox(BaseModel):
+    chat_id: int
+    last_read_inbox_message_id: int
+    unread_count: int
+
+
+class UpdateChatTitle(BaseModel):
+    chat_id: int
+    title: str
+
+
+# updates that change how a chat shows in the chat list
+ChatUpdate = Union[
+    UpdateChatLastMessage, UpdateChatPosition, UpdateChatReadInbox, UpdateChatTitle
+]
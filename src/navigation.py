@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+from client import HISTORY_PAGE_SIZE
+
+if TYPE_CHECKING:
+    from client import AsyncClient
+
+# highlights closer together than this are coalesced, only the last one loads
+NAVIGATION_DEBOUNCE = int(os.getenv("TELEGRAM_NAVIGATION_DEBOUNCE_MS", 40)) / 1000
+# how long the list stays still before the chats next to it are preloaded,
+# 0 disables preloading
+PRELOAD_DELAY = int(os.getenv("TELEGRAM_PRELOAD_DELAY_MS", 500)) / 1000
+LATENCY_SAMPLES = 1000
+
+ChatLoader = Callable[[int, Optional[int]], Awaitable[None]]
+
+
+class NavigationScheduler:
+    """
+    Switches the open chat, the latest request wins.
+
+    A request right after the previous one waits out `debounce` first and
+    any newer request cancels the pending or running load. Once a load is
+    done and nothing else was asked for `preload_delay` seconds, the latest
+    page of the chats `neighbours` returns is fetched into the history cache
+    one chat at a time, so moving on to them paints from the cache.
+
+    Latencies run from the request to the chat being shown, and to its
+    fresh page being loaded.
+    """
+
+    def __init__(
+        self,
+        tg: "AsyncClient",
+        load: ChatLoader,
+        neighbours: Callable[[], List[int]],
+        debounce: float = NAVIGATION_DEBOUNCE,
+        preload_delay: float = PRELOAD_DELAY,
+    ) -> None:
+        self.tg = tg
+        self.load = load
+        self.neighbours = neighbours
+        self.debounce = debounce
+        self.preload_delay = preload_delay
+        self.chat_id = 0
+        self.requests = 0
+        self.superseded = 0
+        self.preloaded = 0
+        self.preload_hits = 0
+        self.shown_latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.loaded_latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._task: Optional[asyncio.Task] = None
+        self._requested_at = 0.0
+        self._shown = True
+        self._loading = False
+        self._preloaded_chats: Set[int] = set()
+
+    def go(self, chat_id: int, around: Optional[int] = None):
+        """Open a chat, or the page `around` one of its messages."""
+        now = time.perf_counter()
+        self.requests += 1
+        busy = self._loading or now - self._requested_at < self.debounce
+        if self._loading:
+            self.superseded += 1
+        self.cancel()
+        if chat_id in self._preloaded_chats:
+            self._preloaded_chats.discard(chat_id)
+            self.preload_hits += 1
+        self.chat_id = chat_id
+        self._requested_at = now
+        self._shown = False
+        self._task = asyncio.create_task(
+            self._run(chat_id, around, self.debounce if busy else 0)
+        )
+
+    def shown(self, chat_id: int, at: Optional[float] = None):
+        """Account for the chat being put on screen, from the cache or not."""
+        if chat_id == self.chat_id and not self._shown:
+            self._shown = True
+            at = time.perf_counter() if at is None else at
+            self.shown_latencies.append(at - self._requested_at)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._loading = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "superseded": self.superseded,
+            "shown_p50_ms": _percentile(self.shown_latencies, 0.5) * 1000,
+            "shown_p99_ms": _percentile(self.shown_latencies, 0.99) * 1000,
+            "loaded_p50_ms": _percentile(self.loaded_latencies, 0.5) * 1000,
+            "loaded_p99_ms": _percentile(self.loaded_latencies, 0.99) * 1000,
+            "preloaded": self.preloaded,
+            "preload_hits": self.preload_hits,
+        }
+
+    async def _run(self, chat_id: int, around: Optional[int], delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        self._loading = True
+        try:
+            await self.load(chat_id, around)
+        finally:
+            self._loading = False
+        self.shown(chat_id)
+        self.loaded_latencies.append(time.perf_counter() - self._requested_at)
+        if self.preload_delay:
+            await asyncio.sleep(self.preload_delay)
+            await self._preload()
+
+    async def _preload(self):
+        history_cache = self.tg.client.history_cache
+        for chat_id in self.neighbours():
+            if chat_id in history_cache:
+                continue
+            messages = await self.tg.get_chat_history(chat_id, limit=HISTORY_PAGE_SIZE)
+            # the authors are needed to paint the page too
+            await self.tg.get_users([m.sender_id.user_id for m in messages])
+            history_cache.set(chat_id, messages)
+            self._preloaded_chats.add(chat_id)
+            self.preloaded += 1
+
+
+def _percentile(samples: Deque[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
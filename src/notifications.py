@@ -0,0 +1,255 @@
+import importlib.util
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+APP_NAME = "project_telegram"
+# a chat gets at most one notification per interval, the rest are coalesced
+NOTIFY_INTERVAL = float(os.getenv("TELEGRAM_NOTIFY_INTERVAL", 3))
+NOTIFY_TIMEOUT = 5
+SUMMARY_LINES = 3
+
+
+class NotificationError(Exception):
+    pass
+
+
+class DBusBackend:
+    """
+    `org.freedesktop.Notifications` over one persistent D-Bus connection.
+
+    jeepney is imported by the first call, on the notifier thread.
+    """
+
+    def __init__(self, bus: str = "SESSION") -> None:
+        self.bus = bus
+        self._connection = None
+
+    @staticmethod
+    def available() -> bool:
+        # only installed on Linux, elsewhere notifications fall back to dunstify
+        return importlib.util.find_spec("jeepney") is not None
+
+    def notify(self, summary: str, body: str, replaces_id: int = 0) -> int:
+        return self._call(
+            "Notify",
+            "susssasa{sv}i",
+            (APP_NAME, replaces_id, "", summary, body, [], {}, -1),
+        )[0]
+
+    def close_notification(self, notification_id: int):
+        self._call("CloseNotification", "u", (notification_id,))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _call(self, method: str, signature: str, body: tuple) -> tuple:
+        from jeepney import DBusAddress, new_method_call
+        from jeepney.io.blocking import open_dbus_connection
+        from jeepney.wrappers import DBusErrorResponse, unwrap_msg
+
+        address = DBusAddress(
+            "/org/freedesktop/Notifications",
+            bus_name="org.freedesktop.Notifications",
+            interface="org.freedesktop.Notifications",
+        )
+        message = new_method_call(address, method, signature, body)
+        try:
+            if self._connection is None:
+                self._connection = open_dbus_connection(bus=self.bus)
+            reply = self._connection.send_and_get_reply(message, timeout=NOTIFY_TIMEOUT)
+            return unwrap_msg(reply)
+        except (OSError, ValueError, KeyError, DBusErrorResponse) as e:
+            # reconnect on the next call, the bus may come back
+            self.close()
+            raise NotificationError(e) from e
+
+
+class SubprocessBackend:
+    """`dunstify`, run to completion so no child is left behind."""
+
+    def notify(self, summary: str, body: str, replaces_id: int = 0) -> int:
+        args = ["dunstify", "-a", APP_NAME, "-p", summary, body]
+        if replaces_id:
+            args += ["-r", str(replaces_id)]
+        output = self._run(args)
+        try:
+            return int(output.strip())
+        except ValueError:
+            return replaces_id
+
+    def close_notification(self, notification_id: int):
+        self._run(["dunstify", "-C", str(notification_id)])
+
+    def close(self):
+        pass
+
+    def _run(self, args: List[str]) -> str:
+        try:
+            return subprocess.run(
+                args, capture_output=True, text=True, timeout=NOTIFY_TIMEOUT
+            ).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            raise NotificationError(e) from e
+
+
+Backend = DBusBackend | SubprocessBackend
+
+
+def default_backends() -> List[Backend]:
+    backends: List[Backend] = []
+    if DBusBackend.available():
+        backends.append(DBusBackend())
+    backends.append(SubprocessBackend())
+    return backends
+
+
+class ChatNotification:
+    def __init__(self, title: str) -> None:
+        self.title = title
+        self.notification_id = 0
+        self.count = 0
+        self.lines: Deque[Tuple[str, str]] = deque(maxlen=SUMMARY_LINES)
+        self.dirty = False
+        self.sent_at = float("-inf")
+
+    def render(self) -> Tuple[str, str]:
+        if self.count == 1:
+            sender, text = self.lines[-1]
+            return f"From: {sender}", text
+        summary = f"{self.title} ({self.count} new messages)"
+        return summary, "\n".join(f"{sender}: {text}" for sender, text in self.lines)
+
+
+class Notifier:
+    """
+    Desktop notifications sent from a background thread.
+
+    Messages of the same chat are coalesced into one summary notification,
+    which is replaced rather than stacked and updated at most once per
+    `interval`. Backends are tried in order, the next one is used when a
+    send fails.
+    """
+
+    def __init__(
+        self,
+        backends: Optional[List[Backend]] = None,
+        interval: float = NOTIFY_INTERVAL,
+    ) -> None:
+        self.backends = backends if backends is not None else default_backends()
+        self.interval = interval
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._chats: Dict[int, ChatNotification] = {}
+        self._requests: Deque[Callable[[], None]] = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self, summary: str, body: str):
+        self._request(lambda: self._send(summary, body))
+
+    def notify_message(self, chat_id: int, title: str, sender: str, text: str):
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatNotification(title)
+            chat.title = title or chat.title
+            if chat.dirty:
+                self.coalesced += 1
+            chat.count += 1
+            chat.lines.append((sender, text))
+            chat.dirty = True
+            self._cond.notify()
+
+    def clear(self, chat_id: int):
+        """Forget the unseen messages of a chat and close its notification."""
+        with self._cond:
+            chat = self._chats.pop(chat_id, None)
+        if chat is not None and chat.notification_id:
+            notification_id = chat.notification_id
+            self._request(lambda: self._close_notification(notification_id))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(NOTIFY_TIMEOUT)
+        for backend in self.backends:
+            backend.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "coalesced": self.coalesced, "failed": self.failed}
+
+    def _request(self, request: Callable[[], None]):
+        with self._cond:
+            self._requests.append(request)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._wait_for_work()
+                if due is None:
+                    return
+                requests = list(self._requests)
+                self._requests.clear()
+                now = time.monotonic()
+                pending = []
+                for chat_id, chat in due:
+                    chat.dirty = False
+                    chat.sent_at = now
+                    pending.append((chat_id, chat, *chat.render()))
+
+            for request in requests:
+                request()
+            for chat_id, chat, summary, body in pending:
+                notification_id = self._send(summary, body, chat.notification_id)
+                with self._cond:
+                    # a cleared chat starts over with a fresh notification
+                    if self._chats.get(chat_id) is chat:
+                        chat.notification_id = notification_id
+
+    def _wait_for_work(self) -> Optional[List[Tuple[int, ChatNotification]]]:
+        while not self._closed:
+            now = time.monotonic()
+            due = []
+            next_at = None
+            for chat_id, chat in self._chats.items():
+                if not chat.dirty:
+                    continue
+                at = chat.sent_at + self.interval
+                if at <= now:
+                    due.append((chat_id, chat))
+                elif next_at is None or at < next_at:
+                    next_at = at
+            if due or self._requests:
+                return due
+            self._cond.wait(None if next_at is None else next_at - now)
+        return None
+
+    def _send(self, summary: str, body: str, replaces_id: int = 0) -> int:
+        for backend in self.backends:
+            try:
+                notification_id = backend.notify(summary, body, replaces_id)
+            except NotificationError:
+                continue
+            self.sent += 1
+            return notification_id
+        self.failed += 1
+        return replaces_id
+
+    def _close_notification(self, notification_id: int):
+        for backend in self.backends:
+            try:
+                backend.close_notification(notification_id)
+                return
+            except NotificationError:
+                continue
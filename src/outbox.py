@@ -0,0 +1,324 @@
+import asyncio
+import itertools
+import os
+from datetime import datetime, timezone
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from telegram.utils import AsyncResult
+
+from models import (
+    FormattedText,
+    Message,
+    MessageSender,
+    MessageSendingStateFailed,
+    MessageSendingStatePending,
+    MessageText,
+    UpdateMessageSendFailed,
+    UpdateMessageSendSucceeded,
+)
+
+if TYPE_CHECKING:
+    from client import AsyncClient
+
+# messages waiting for the server at once, across all chats
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv("TELEGRAM_OUTBOX_MAX_IN_FLIGHT", 8))
+OUTBOX_RETRIES = int(os.getenv("TELEGRAM_OUTBOX_RETRIES", 5))
+OUTBOX_BACKOFF = float(os.getenv("TELEGRAM_OUTBOX_BACKOFF", 1))
+# a message TDLib took but never reported sent or failed, e.g. after a
+# restart or when its chat was deleted, fails and frees its slot after this
+OUTBOX_SEND_TIMEOUT = float(os.getenv("TELEGRAM_OUTBOX_SEND_TIMEOUT", 120))
+OUTBOX_MAX_BACKOFF = 60.0
+
+# placeholder ids sort after any TDLib message id
+LOCAL_ID_START = 1 << 62
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+class OutgoingMessage:
+    def __init__(self, message: Message, text: str) -> None:
+        # as shown, under a placeholder id until TDLib gives it one
+        self.message = message
+        self.text = text
+        self.state = QUEUED
+        self.attempts = 0
+        self.error = ""
+        self.holds_slot = False
+        self.timeout: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def chat_id(self) -> int:
+        return self.message.chat_id
+
+    @property
+    def done(self) -> bool:
+        return self.state in (SENT, FAILED)
+
+
+# called with the id the message was shown under before, None for a new one
+OutboxCallback = Callable[[OutgoingMessage, Optional[int]], None]
+
+SendOutcome = Union[UpdateMessageSendSucceeded, UpdateMessageSendFailed]
+
+
+class Outbox:
+    """
+    Outgoing messages, shown right away and sent in the background.
+
+    A message is shown under a placeholder id until TDLib takes it and gives
+    it a temporary id, `updateMessageSendSucceeded` then brings the server
+    one. The messages of a chat are handed to TDLib in the order they were
+    written, TDLib keeps that order, and up to `max_in_flight` messages wait
+    for the server at once. A message TDLib refuses is retried with
+    exponential backoff and holds back the ones written after it in its
+    chat, one that failed on the server is resent after a backoff, by then
+    later messages may have gone out before it.
+    """
+
+    def __init__(
+        self,
+        tg: "AsyncClient",
+        max_in_flight: int = OUTBOX_MAX_IN_FLIGHT,
+        retries: int = OUTBOX_RETRIES,
+        send_timeout: float = OUTBOX_SEND_TIMEOUT,
+    ):
+        self.tg = tg
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.send_timeout = send_timeout
+        # by chat id and the id the message is shown under
+        self.messages: Dict[Tuple[int, int], OutgoingMessage] = {}
+        self._listeners: List[OutboxCallback] = []
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._local_ids = itertools.count(LOCAL_ID_START)
+        # outcomes that came before the result of the request, by chat
+        self._handing: Dict[int, int] = {}
+        self._early: Dict[Tuple[int, int], SendOutcome] = {}
+        tg.updates.add_handler("updateMessageSendSucceeded", self._on_send_succeeded)
+        tg.updates.add_handler("updateMessageSendFailed", self._on_send_failed)
+
+    def send(self, chat_id: int, text: str) -> OutgoingMessage:
+        """Show a message as pending and send it without waiting."""
+        me = self.tg.client.me
+        out = OutgoingMessage(
+            _pending_message(next(self._local_ids), chat_id, me.id if me else 0, text),
+            text,
+        )
+        self.messages[chat_id, out.message.id] = out
+        self._notify(out, None)
+        self._spawn(self._deliver(out))
+        return out
+
+    def subscribe(self, callback: OutboxCallback):
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback: OutboxCallback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def stats(self) -> Dict[str, Any]:
+        states = [out.state for out in self.messages.values()]
+        return {
+            "queued": states.count(QUEUED),
+            "sending": states.count(SENDING),
+            "in_flight": sum(out.holds_slot for out in self.messages.values()),
+        }
+
+    async def _deliver(self, out: OutgoingMessage):
+        chat_id = out.chat_id
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            await self._acquire(out)
+            r = await self._hand_over(out, self.tg.send_message, chat_id, out.text)
+        if r is None:
+            return
+        self._sending(out, Message.from_tdlib(r.update))
+
+    async def _resend(self, out: OutgoingMessage, delay: float):
+        await asyncio.sleep(delay)
+        await self._acquire(out)
+        r = await self._hand_over(
+            out, self.tg.resend_messages, out.chat_id, [out.message.id]
+        )
+        if r is None:
+            return
+        messages = r.update.get("messages") or [None]
+        if messages[0] is None:
+            self._fail(out, "Message can't be resent")
+            return
+        self._sending(out, Message.from_tdlib(messages[0]))
+
+    async def _hand_over(
+        self, out: OutgoingMessage, method: Callable[..., Any], *args: Any
+    ) -> Optional[AsyncResult]:
+        """
+        `_request`, while outcomes for the chat are kept for `_sending` until
+        the result gives the message its temporary id.
+        """
+        chat_id = out.chat_id
+        self._handing[chat_id] = self._handing.get(chat_id, 0) + 1
+        try:
+            return await self._request(out, method, *args)
+        finally:
+            self._handing[chat_id] -= 1
+
+    async def _request(
+        self, out: OutgoingMessage, method: Callable[..., Any], *args: Any
+    ) -> Optional[AsyncResult]:
+        """Ask TDLib to take the message, retrying while it refuses."""
+        while True:
+            out.attempts += 1
+            r = await method(*args)
+            if not r.error and r.update:
+                return r
+            error = (r.error_info or {}).get("message", "no update")
+            if out.attempts > self.retries:
+                self._fail(out, error)
+                return None
+            out.error = error
+            await asyncio.sleep(_backoff(out.attempts))
+
+    async def _acquire(self, out: OutgoingMessage):
+        await self._slots.acquire()
+        out.holds_slot = True
+        out.state = SENDING
+
+    def _release(self, out: OutgoingMessage):
+        if out.timeout is not None:
+            out.timeout.cancel()
+            out.timeout = None
+        if out.holds_slot:
+            out.holds_slot = False
+            self._slots.release()
+
+    def _sending(self, out: OutgoingMessage, message: Message):
+        """TDLib took the message, under a temporary id."""
+        self._show(out, message)
+        early = self._early.pop((out.chat_id, message.id), None)
+        if isinstance(early, UpdateMessageSendSucceeded):
+            self._on_send_succeeded([early])
+        elif isinstance(early, UpdateMessageSendFailed):
+            self._on_send_failed([early])
+        if out.holds_slot:
+            self._watch(out)
+
+    def _watch(self, out: OutgoingMessage):
+        """Wait `send_timeout` for the outcome of a message TDLib took."""
+        if out.timeout is not None:
+            out.timeout.cancel()
+        out.timeout = asyncio.get_running_loop().call_later(
+            self.send_timeout, self._time_out, out
+        )
+
+    def _time_out(self, out: OutgoingMessage):
+        out.timeout = None
+        if out.holds_slot and not out.done:
+            self._fail(out, "The server did not answer")
+
+    def _show(self, out: OutgoingMessage, message: Message):
+        old_id = out.message.id
+        self.messages.pop((out.chat_id, old_id), None)
+        out.message = message
+        if not out.done:
+            self.messages[out.chat_id, message.id] = out
+        self._notify(out, old_id)
+
+    def _fail(self, out: OutgoingMessage, error: str):
+        out.state = FAILED
+        out.error = error
+        self._release(out)
+        state = MessageSendingStateFailed.construct(
+            tdlib_type="messageSendingStateFailed", error_message=error
+        )
+        self._show(out, out.message.copy(update={"sending_state": state}))
+
+    def _take(self, update: SendOutcome) -> Optional[OutgoingMessage]:
+        key = (update.message.chat_id, update.old_message_id)
+        out = self.messages.get(key)
+        if out is None and self._handing.get(key[0]):
+            # the temporary id is not known yet, see `_sending`
+            self._early[key] = update
+        return out
+
+    def _on_send_succeeded(self, updates: List[UpdateMessageSendSucceeded]):
+        for update in updates:
+            out = self._take(update)
+            if out is None:
+                continue
+            out.state = SENT
+            out.error = ""
+            self._release(out)
+            self._show(out, update.message)
+
+    def _on_send_failed(self, updates: List[UpdateMessageSendFailed]):
+        for update in updates:
+            out = self._take(update)
+            if out is None:
+                continue
+            self._release(out)
+            state = update.message.sending_state
+            if (
+                isinstance(state, MessageSendingStateFailed)
+                and state.can_retry
+                and out.attempts <= self.retries
+            ):
+                out.state = QUEUED
+                out.error = update.error_message
+                self._show(out, update.message)
+                delay = max(state.retry_after, _backoff(out.attempts))
+                self._spawn(self._resend(out, delay))
+            else:
+                out.state = FAILED
+                out.error = update.error_message
+                self._show(out, update.message)
+
+    def _notify(self, out: OutgoingMessage, old_id: Optional[int]):
+        for callback in list(self._listeners):
+            callback(out, old_id)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def _backoff(attempt: int) -> float:
+    return min(OUTBOX_BACKOFF * 2 ** (attempt - 1), OUTBOX_MAX_BACKOFF)
+
+
+def _pending_message(message_id: int, chat_id: int, user_id: int, text: str) -> Message:
+    values: Dict[str, Any] = {
+        name: False for name, field in Message.__fields__.items() if field.type_ is bool
+    }
+    values.update(
+        id=message_id,
+        chat_id=chat_id,
+        sender_id=MessageSender.construct(user_id=user_id),
+        is_outgoing=True,
+        date=datetime.now(timezone.utc),
+        edit_date=0,
+        interaction_info=None,
+        sending_state=MessageSendingStatePending.construct(
+            tdlib_type="messageSendingStatePending"
+        ),
+        content=MessageText.construct(
+            tdlib_type="messageText",
+            text=FormattedText.construct(text=text, entities=[]),
+        ),
+    )
+    return Message.construct(**values)
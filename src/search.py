@@ -0,0 +1,172 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from models import Message
+
+SEARCH_LIMIT = 50
+# snippet() markers around matched words, never found in message text
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (chat_id, message_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='rowid', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text)
+    VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text)
+    VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.rowid, new.text);
+END;
+"""
+
+UPSERT = """
+INSERT INTO messages (chat_id, message_id, sender_id, date, text)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (chat_id, message_id) DO UPDATE SET text = excluded.text
+WHERE text != excluded.text
+"""
+
+SEARCH = """
+SELECT m.chat_id, m.message_id, m.sender_id, m.date,
+       snippet(messages_fts, 0, char(2), char(3), '…', 8)
+FROM messages_fts JOIN messages AS m ON m.rowid = messages_fts.rowid
+WHERE messages_fts MATCH ? {chat_filter}
+ORDER BY messages_fts.rowid DESC
+LIMIT ?
+"""
+
+
+class SearchResult(NamedTuple):
+    chat_id: int
+    message_id: int
+    sender_id: int
+    date: int
+    snippet: str
+
+
+def fts_query(query: str) -> str:
+    """Match every word of `query` as a prefix, FTS5 syntax is not exposed."""
+    words = query.split()
+    return " ".join('"{}"*'.format(w.replace('"', '""')) for w in words)
+
+
+class MessageIndex:
+    """
+    Full-text index of messages across chats, kept in SQLite with FTS5.
+
+    Writes are queued to a background thread, searches are awaited and run
+    on another one with their own connection so they never wait behind a
+    backlog of writes. Results come newest indexed first, ranking every
+    match of a common word would not keep up with typing.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+        self._db: Optional[sqlite3.Connection] = None
+        self._read_db: Optional[sqlite3.Connection] = None
+
+    def add(self, messages: Iterable[Message]):
+        rows = [
+            (
+                m.chat_id,
+                m.id,
+                m.sender_id.user_id,
+                int(m.date.timestamp()),
+                m.content.searchable_text,
+            )
+            for m in messages
+        ]
+        if rows:
+            self._writer.submit(self._write, UPSERT, rows)
+
+    def update_text(self, chat_id: int, message_id: int, text: str):
+        self._writer.submit(
+            self._write,
+            "UPDATE messages SET text = ? WHERE chat_id = ? AND message_id = ?",
+            [(text, chat_id, message_id)],
+        )
+
+    def remove(self, chat_id: int, message_ids: List[int]):
+        rows = [(chat_id, message_id) for message_id in message_ids]
+        self._writer.submit(
+            self._write,
+            "DELETE FROM messages WHERE chat_id = ? AND message_id = ?",
+            rows,
+        )
+
+    async def search(
+        self, query: str, chat_id: Optional[int] = None, limit: int = SEARCH_LIMIT
+    ) -> List[SearchResult]:
+        match = fts_query(query)
+        if not match:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader, self._search, match, chat_id, limit
+        )
+
+    def close(self):
+        self._writer.submit(self._close_writer)
+        self._reader.submit(self._close_reader)
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path)
+        # WAL lets the search connection read while the writer commits
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.executescript(SCHEMA)
+        return db
+
+    def _write(self, statement: str, rows: List[Tuple]):
+        if self._db is None:
+            self._db = self._connect()
+        with self._db:
+            self._db.executemany(statement, rows)
+
+    def _search(
+        self, match: str, chat_id: Optional[int], limit: int
+    ) -> List[SearchResult]:
+        if self._read_db is None:
+            self._read_db = self._connect()
+        if chat_id is None:
+            sql, params = SEARCH.format(chat_filter=""), (match, limit)
+        else:
+            sql = SEARCH.format(chat_filter="AND m.chat_id = ?")
+            params = (match, chat_id, limit)
+        rows = self._read_db.execute(sql, params)
+        return [SearchResult(*row) for row in rows]
+
+    def _close_writer(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _close_reader(self):
+        if self._read_db is not None:
+            self._read_db.close()
+            self._read_db = None
@@ -0,0 +1,138 @@
+import marshal
+import os
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+from client import HISTORY_PAGE_SIZE, Client
+from models import Chat, Message, MessageSendingStatePending, User
+from outbox import LOCAL_ID_START
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_PATH = os.getenv("TELEGRAM_SNAPSHOT_PATH", "")
+# recently opened chats whose last page is kept for the next launch
+SNAPSHOT_CHATS = int(os.getenv("TELEGRAM_SNAPSHOT_CHATS", 10))
+
+
+def _dump_message(message: Message) -> Dict[str, Any]:
+    data = message.dict(by_alias=True)
+    data["date"] = int(message.date.timestamp())
+    return data
+
+
+def _is_settled(message: Message) -> bool:
+    # the outbox of the next launch knows nothing of messages still on their
+    # way, TDLib hands them over again with the fresh page
+    return message.id < LOCAL_ID_START and not isinstance(
+        message.sending_state, MessageSendingStatePending
+    )
+
+
+class Snapshot:
+    """
+    What the app shows first, saved on exit so the next launch can paint
+    it before TDLib is ready and reconcile in the background.
+
+    Models are stored as plain TDLib shaped data with `marshal` and rebuilt
+    with `from_tdlib`, a snapshot that does not fit the models any more is
+    ignored. The marshal format may change between Python versions, so is a
+    snapshot written by another one.
+    """
+
+    def __init__(
+        self,
+        me: User,
+        chats: List[Chat],
+        users: List[User],
+        history: List[Tuple[int, List[Message]]],
+    ) -> None:
+        self.me = me
+        self.chats = chats
+        self.users = users
+        # newest chat first
+        self.history = history
+
+    @classmethod
+    def capture(cls, client: Client, chats: List[Chat]) -> Optional["Snapshot"]:
+        me = client.me
+        if me is None:
+            return None
+        history = [
+            (chat_id, [m for m in messages if _is_settled(m)])
+            for chat_id, messages in client.history_cache.recent(
+                SNAPSHOT_CHATS, HISTORY_PAGE_SIZE
+            )
+        ]
+        users = {me.id: me}
+        for _, messages in history:
+            for m in messages:
+                user_id = m.sender_id.user_id
+                user = users.get(user_id) or client.users.get(user_id, count=False)
+                if user is not None:
+                    users[user_id] = user
+        return cls(me, chats, list(users.values()), history)
+
+    def restore(self, client: Client):
+        """Seed the client caches, TDLib updates overwrite them as they come."""
+        client.me = self.me
+        for user in self.users:
+            client.users.set(user.id, user)
+        for chat in self.chats:
+            client.chats.setdefault(chat.id, chat.dict(by_alias=True))
+        for chat_id, messages in reversed(self.history):
+            client.history_cache.set(chat_id, messages)
+
+    def save(self, path: str):
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "python": tuple(sys.version_info[:2]),
+            "me": self.me.dict(),
+            "chats": [chat.dict(by_alias=True) for chat in self.chats],
+            "users": [user.dict() for user in self.users],
+            "history": [
+                (chat_id, [_dump_message(m) for m in messages])
+                for chat_id, messages in self.history
+            ],
+        }
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # readers only ever see the previous snapshot or the complete new one
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(marshal.dumps(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Snapshot"]:
+        try:
+            with open(path, "rb") as f:
+                # one read, marshal.load reads a file piece by piece
+                data = marshal.loads(f.read())
+            if data["version"] != SNAPSHOT_VERSION or data["python"] != tuple(
+                sys.version_info[:2]
+            ):
+                return None
+            return cls(
+                User.from_tdlib(data["me"]),
+                [Chat.from_tdlib(chat) for chat in data["chats"]],
+                [User.from_tdlib(user) for user in data["users"]],
+                [
+                    (chat_id, [Message.from_tdlib(m) for m in messages])
+                    for chat_id, messages in data["history"]
+                ],
+            )
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return None
+
+    @staticmethod
+    def delete(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,316 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Type,
+)
+
+from pydantic import ValidationError
+
+from metrics import metrics
+from models import (
+    BaseModel,
+    UpdateChatLastMessage,
+    UpdateChatPosition,
+    UpdateChatReadInbox,
+    UpdateChatTitle,
+    UpdateDeleteMessages,
+    UpdateMessageContent,
+    UpdateMessageInteractionInfo,
+    UpdateMessageSendFailed,
+    UpdateMessageSendSucceeded,
+    UpdateNewMessage,
+)
+
+if TYPE_CHECKING:
+    from client import Client
+
+UPDATE_QUEUE_SIZE = int(os.getenv("TELEGRAM_UPDATE_QUEUE_SIZE", 1000))
+UPDATE_BATCH_SIZE = int(os.getenv("TELEGRAM_UPDATE_BATCH_SIZE", 100))
+# how long a full queue holds up TDLib before the update is let in anyway
+UPDATE_PUT_TIMEOUT = float(os.getenv("TELEGRAM_UPDATE_PUT_TIMEOUT", 1))
+
+logger = logging.getLogger(__name__)
+
+UpdateHandler = Callable[[List[Any]], Optional[Awaitable[None]]]
+
+
+def _message_key(update: Dict[str, Any]) -> Hashable:
+    return update["chat_id"], update["message_id"]
+
+
+def _chat_key(update: Dict[str, Any]) -> Hashable:
+    return update["chat_id"]
+
+
+def _chat_position_key(update: Dict[str, Any]) -> Hashable:
+    return update["chat_id"], tuple(update["position"]["list"].items())
+
+
+class Route:
+    """
+    How one update type goes through the pipeline.
+
+    Updates with a `key` carry the full new state, a queued update is
+    replaced by a newer one with the same key. `droppable` updates are
+    discarded when the queue is full, the others hold up the TDLib thread
+    until there is room, for at most `UPDATE_PUT_TIMEOUT` seconds. Handlers
+    may be waiting on TDLib results themselves, so the queue then goes over
+    its size rather than stall TDLib for good.
+    """
+
+    def __init__(
+        self,
+        model: Type[BaseModel],
+        key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+        droppable: bool = False,
+    ) -> None:
+        self.model = model
+        self.key = key
+        self.droppable = droppable
+
+
+ROUTES: Dict[str, Route] = {
+    "updateNewMessage": Route(UpdateNewMessage),
+    "updateMessageContent": Route(UpdateMessageContent, key=_message_key),
+    # views and reactions change the most often, a dropped one leaves a stale count
+    "updateMessageInteractionInfo": Route(
+        UpdateMessageInteractionInfo, key=_message_key, droppable=True
+    ),
+    "updateDeleteMessages": Route(UpdateDeleteMessages),
+    "updateMessageSendSucceeded": Route(UpdateMessageSendSucceeded),
+    "updateMessageSendFailed": Route(UpdateMessageSendFailed),
+    "updateChatLastMessage": Route(UpdateChatLastMessage, key=_chat_key),
+    "updateChatPosition": Route(UpdateChatPosition, key=_chat_position_key),
+    # the client keeps the count itself, a dropped one only skips a repaint
+    "updateChatReadInbox": Route(UpdateChatReadInbox, key=_chat_key, droppable=True),
+    "updateChatTitle": Route(UpdateChatTitle, key=_chat_key),
+}
+
+
+class Entry:
+    __slots__ = ("type", "key", "update", "queued_at")
+
+    def __init__(self, type: str, key: Hashable, update: Dict[str, Any]) -> None:
+        self.type = type
+        self.key = key
+        self.update = update
+        self.queued_at = time.perf_counter()
+
+
+class HandlerStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.updates = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, updates: int, elapsed: float):
+        self.calls += 1
+        self.updates += updates
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "updates": self.updates,
+            "errors": self.errors,
+            "mean_ms": self.total / self.calls * 1000 if self.calls else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class UpdateDispatcher:
+    """
+    Typed TDLib updates, handled in batches on the asyncio loop.
+
+    The TDLib thread only puts raw updates on a bounded queue. A dispatcher
+    thread parses them into models and hands them to the loop in batches of
+    consecutive updates of the same type, waiting for each batch to be
+    handled before taking the next one.
+    """
+
+    def __init__(
+        self,
+        client: "Client",
+        maxsize: int = UPDATE_QUEUE_SIZE,
+        batch_size: int = UPDATE_BATCH_SIZE,
+    ) -> None:
+        self.client = client
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.handlers: Dict[str, List[UpdateHandler]] = {}
+
+        self.pushed = 0
+        self.merged = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.invalid = 0
+        self.max_depth = 0
+        self.max_lag = 0.0
+        self.handler_stats: Dict[str, HandlerStats] = {}
+
+        self._queue: Deque[Entry] = deque()
+        self._pending: Dict[Hashable, Entry] = {}
+        self._subscribed: set[str] = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def add_handler(self, update_type: str, handler: UpdateHandler):
+        """
+        Call `handler` on the loop with lists of parsed `update_type` updates,
+        it may be a coroutine function.
+        """
+        if update_type not in ROUTES:
+            raise ValueError(f"No route for {update_type}")
+        self.handlers.setdefault(update_type, []).append(handler)
+        self.handler_stats.setdefault(update_type, HandlerStats())
+        if self.loop is not None:
+            self._subscribe(update_type)
+
+    def start(self):
+        """Start dispatching to the running loop."""
+        self.loop = asyncio.get_running_loop()
+        for update_type in self.handlers:
+            self._subscribe(update_type)
+        self._thread.start()
+
+    def stop(self):
+        for update_type in self._subscribed:
+            self.client.remove_update_handler(update_type, self._push)
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "pushed": self.pushed,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+            "invalid": self.invalid,
+            "max_lag_ms": self.max_lag * 1000,
+            "handlers": {t: s.stats() for t, s in self.handler_stats.items()},
+        }
+
+    def _subscribe(self, update_type: str):
+        if update_type not in self._subscribed:
+            self._subscribed.add(update_type)
+            self.client.add_update_handler(update_type, self._push)
+
+    def _push(self, update: Dict[str, Any]):
+        # runs on python-telegram's worker thread, keep it cheap
+        update_type = update["@type"]
+        route = ROUTES[update_type]
+        key = (update_type, route.key(update)) if route.key is not None else None
+        with self._cond:
+            self.pushed += 1
+            entry = self._pending.get(key) if key is not None else None
+            if entry is not None:
+                entry.update = update
+                self.merged += 1
+                return
+            if len(self._queue) >= self.maxsize and route.droppable:
+                self.dropped += 1
+                return
+            if not self._cond.wait_for(
+                lambda: len(self._queue) < self.maxsize or self._closed,
+                UPDATE_PUT_TIMEOUT,
+            ):
+                self.overflowed += 1
+            if self._closed:
+                return
+            entry = Entry(update_type, key, update)
+            self._queue.append(entry)
+            if key is not None:
+                self._pending[key] = entry
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify_all()
+
+    def _take(self) -> List[Entry]:
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            entries = []
+            while self._queue and len(entries) < self.batch_size:
+                entry = self._queue.popleft()
+                if entry.key is not None:
+                    del self._pending[entry.key]
+                entries.append(entry)
+            self._cond.notify_all()
+            return entries
+
+    def _run(self):
+        assert self.loop is not None
+        while not self._closed:
+            entries = self._take()
+            batches = []
+            for update_type, group in itertools.groupby(entries, lambda e: e.type):
+                updates = []
+                for entry in group:
+                    self.max_lag = max(
+                        self.max_lag, time.perf_counter() - entry.queued_at
+                    )
+                    try:
+                        with metrics.timer("parse_seconds", update_type):
+                            updates.append(
+                                ROUTES[update_type].model.from_tdlib(entry.update)
+                            )
+                    except ValidationError:
+                        self.invalid += 1
+                if updates:
+                    batches.append((update_type, updates))
+            if not batches:
+                continue
+            try:
+                future = asyncio.run_coroutine_threadsafe(
+                    self._dispatch(batches), self.loop
+                )
+                # backpressure, the queue fills up while the loop is busy
+                future.result()
+            except concurrent.futures.CancelledError:
+                # the loop cancelled the batch, e.g. on shutdown, keep going
+                continue
+            except RuntimeError:
+                # the loop is gone
+                return
+
+    async def _dispatch(self, batches: List[tuple[str, List[Any]]]):
+        for update_type, updates in batches:
+            stats = self.handler_stats[update_type]
+            for handler in list(self.handlers.get(update_type, [])):
+                started = time.perf_counter()
+                try:
+                    result = handler(updates)
+                    if result is not None:
+                        await result
+                except Exception:
+                    stats.errors += 1
+                    logger.exception("%s handler failed", update_type)
+                stats.record(len(updates), time.perf_counter() - started)
@@ -1,37 +1,93 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import bisect
+import hashlib
 import io
+import itertools
 import subprocess
-from typing import ClassVar, List
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache, partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Tuple,
+)
 
-from PIL import Image
 from rich.color import Color
-from rich.color_triplet import ColorTriplet
 from rich.console import RenderableType
 from rich.segment import Segment
 from rich.style import Style
+from rich.text import Text
 from textual import events
 from textual.app import ComposeResult
 from textual.binding import Binding, BindingType
 from textual.containers import Container
+from textual.geometry import clamp
 from textual.message import Message as _Message
 from textual.strip import Strip
+from textual.timer import Timer
 from textual.widget import Widget
 from textual.widgets import Input, Label, ListItem, ListView, Static, TextLog
 
-from client import Client
-from models import HasDownloadableImage, HasImage, Message
+from cache import LRUCache
+from client import HISTORY_MAX_PAGES, HISTORY_PAGE_SIZE, AsyncClient
+from downloads import PRIORITY_SELECTED, Download
+from metrics import metrics
+from models import (
+    AnyMessageContent,
+    Chat,
+    HasDownloadableImage,
+    HasImage,
+    Message,
+    MessageInteractionInfo,
+    MessageSendingStateFailed,
+    MessageSendingStatePending,
+    User,
+)
+from search import MATCH_END, MATCH_START, SearchResult
 
 
 class ChatListItem(ListItem):
-    def __init__(self, tg: Client, chat_id: int, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
+    def __init__(self, tg: AsyncClient, chat: Chat, *args, **kwargs) -> None:
+        self.label = Label()
+        super().__init__(self.label, *args, **kwargs)
         self.tg = tg
-        self.chat_id = chat_id
+        self.update_chat(chat)
+
+    @property
+    def chat_id(self) -> int:
+        return self.chat.id
+
+    def update_chat(self, chat: Chat):
+        self.chat = chat
+        # the key the item is sorted under, kept until the view moves it
+        self.key = chat.list_key
+        if chat.unread_count:
+            self.label.update(f"{chat.title} ({chat.unread_count})")
+        else:
+            self.label.update(chat.title)
 
 
 class ChatListView(ListView):
+    """
+    The main chat list, ordered like TDLib orders it.
+
+    The items are kept in the order of their sorted keys, a chat that
+    changes is found and placed with bisect and only its item is moved.
+    """
+
     BINDINGS: ClassVar[list[BindingType]] = [
         Binding("enter", "select_cursor", "Select", show=False),
         Binding("k", "cursor_up", "Cursor Up", show=False),
@@ -51,20 +107,123 @@ class ChatListView(ListView):
             self.list_view = list_view
             self.item: ChatListItem = item
 
-    def __init__(self, tg: Client, **kwargs) -> None:
+    def __init__(
+        self, tg: AsyncClient, chats: List[Chat] | None = None, **kwargs
+    ) -> None:
+        super().__init__(**kwargs)
         self.tg = tg
+        self._keys: List[Tuple[int, int]] = []
+        self._items: Dict[int, ChatListItem] = {}
+        self._highlighted: ChatListItem | None = None
+        self._lock = asyncio.Lock()
+        # shown until the list is loaded, e.g. from the startup snapshot
+        self._initial_chats = chats or []
 
-        items: List[ChatListItem] = []
-        for chat in self.tg.get_chats():
-            items.append(
-                ChatListItem(
-                    self.tg,
-                    chat.id,
-                    Label(chat.title),
-                    id=f"chat_id__{chat.id}",
-                )
-            )
-        super().__init__(*items, **kwargs)
+    @property
+    def chats(self) -> List[Chat]:
+        return [self._items[-neg_id].chat for _, neg_id in self._keys]
+
+    def neighbours(self) -> List[int]:
+        """The chats right below and above the highlighted one."""
+        if self.index is None:
+            return []
+        below = self._keys[self.index + 1 : self.index + 2]
+        above = self._keys[max(self.index - 1, 0) : self.index]
+        return [-neg_id for _, neg_id in below + above]
+
+    async def on_mount(self) -> None:
+        super().on_mount()
+        if self._initial_chats:
+            await self.show_chats(self._initial_chats)
+        else:
+            await self.load_chats()
+
+    async def load_chats(self):
+        chats = await self.tg.get_chats()
+        if chats != self.chats:
+            await self.show_chats(chats)
+
+    async def show_chats(self, chats: List[Chat]):
+        """Replace the list, the highlighted chat stays highlighted."""
+        async with self._lock:
+            chats = sorted(chats, key=lambda chat: chat.list_key)
+            item = self.highlighted_child
+            chat_ids = [chat.id for chat in chats]
+            index = 0
+            if item is not None and item.chat_id in chat_ids:
+                index = chat_ids.index(item.chat_id)
+            await self.clear()
+            self._keys = [chat.list_key for chat in chats]
+            self._items = {
+                chat.id: ChatListItem(self.tg, chat, id=f"chat_id__{chat.id}")
+                for chat in chats
+            }
+            with metrics.timer("mount_seconds", "ChatListView"):
+                await self.mount_all(self._items.values())
+            self.index = index
+
+    async def refresh_chats(self, chat_ids: Iterable[int]):
+        """Bring the given chats up to date and move them to their place."""
+        async with self._lock:
+            for chat_id in dict.fromkeys(chat_ids):
+                await self._refresh_chat(chat_id)
+
+    async def _refresh_chat(self, chat_id: int):
+        chat = await self.tg.get_chat(chat_id)
+        item = self._items.get(chat_id)
+        index = self.index
+        old = None
+        if item is not None:
+            if item.key == chat.list_key:
+                item.update_chat(chat)
+                return
+            old = bisect.bisect_left(self._keys, item.key)
+            del self._keys[old]
+            if index is not None and index > old:
+                index -= 1
+
+        if not chat.order:
+            # the chat left the main list
+            if item is not None:
+                del self._items[chat_id]
+                await item.remove()
+                self.index = index
+            return
+
+        new = bisect.bisect_left(self._keys, chat.list_key)
+        self._keys.insert(new, chat.list_key)
+        if item is None:
+            item = ChatListItem(self.tg, chat, id=f"chat_id__{chat_id}")
+            self._items[chat_id] = item
+            if new < len(self._nodes):
+                await self.mount(item, before=new)
+            else:
+                await self.mount(item)
+        else:
+            item.update_chat(chat)
+            if new < old:
+                self.move_child(item, before=new)
+            elif new > old:
+                self.move_child(item, after=new)
+        if index is not None:
+            if item is self._highlighted:
+                index = new
+            elif index >= new:
+                index += 1
+        if index != self.index:
+            self.index = index
+
+    def watch_index(self, old_index: int | None, new_index: int | None) -> None:
+        # items move as chats are reordered, only a different chat is news
+        new_child = self.highlighted_child
+        if self._highlighted is not None:
+            self._highlighted.highlighted = False
+        if new_child is not None:
+            new_child.highlighted = True
+        self._scroll_highlighted_region()
+        if new_child is not self._highlighted:
+            self._highlighted = new_child
+            self.post_message(self.Highlighted(self, new_child))
 
     @property
     def highlighted_child(self) -> ChatListItem | None:
@@ -123,17 +282,114 @@ class MessageListView(ListView):
             self.list_view = list_view
             self.item: MessageItem = item
 
-    def __init__(self, tg: Client, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
+    class Shown(_Message, bubble=True):
+        """A chat was put on screen, from the cache or a fresh page."""
+
+        def __init__(self, list_view: MessageListView, chat_id: int) -> None:
+            super().__init__()
+            self.list_view = list_view
+            self.chat_id = chat_id
+            # handled after the app caught up, when it was shown is now
+            self.shown_at = time.perf_counter()
+
+    WINDOW_SIZE = 40
+    OVERSCAN = 10
+    PAGE_SIZE = HISTORY_PAGE_SIZE
+    MAX_PAGES = HISTORY_MAX_PAGES
+
+    def __init__(self, tg: AsyncClient, *args, **kwargs) -> None:
+        self.top_spacer = Spacer()
+        self.bottom_spacer = Spacer()
+        super().__init__(self.top_spacer, self.bottom_spacer, *args, **kwargs)
         self.tg = tg
-        self.messages_ids = set()
+        self.chat_id = 0
+        self.me = 0
+
+        # backing store, ordered by message id
+        self.messages: List[Message] = []
+        self.message_ids: List[int] = []
+        self.heights: List[int] = []
+        # running totals of `heights`, None once they changed
+        self._offsets: List[int] | None = None
+        self.authors: Dict[int, User] = {}
+
+        # mounted window over the backing store
+        self.window: List[MessageItem] = []
+        self.items: Dict[int, MessageItem] = {}
+        self.window_start = 0
+        self.cursor = 0
+
+        # whether the store is cut off from the rest of the history
+        self.has_older = False
+        self.has_newer = False
+        self._page_task: asyncio.Task | None = None
+
+        self._hold_scroll = False
+        self._viewport_check_pending = False
+
+    @property
+    def window_end(self) -> int:
+        return self.window_start + len(self.window)
 
     @property
     def highlighted_child(self) -> MessageItem | None:
-        if self.index is not None and 0 <= self.index < len(self._nodes):
-            list_item = self._nodes[self.index]
-            assert isinstance(list_item, MessageItem)
-            return list_item
+        return self._item_at(self.index)
+
+    def _item_at(self, index: int | None) -> MessageItem | None:
+        if index is not None and 0 <= index < len(self._nodes):
+            list_item = self._nodes[index]
+            if isinstance(list_item, MessageItem):
+                return list_item
+
+    def validate_index(self, index: int | None) -> int | None:
+        if not self.window or index is None:
+            return None
+        # the spacers sit at both ends of the node list
+        return clamp(index, 1, len(self.window))
+
+    def watch_index(self, old_index: int | None, new_index: int | None) -> None:
+        old_child = self._item_at(old_index)
+        if old_child is not None:
+            old_child.highlighted = False
+
+        new_child = self._item_at(new_index)
+        if new_child is not None and new_index is not None:
+            new_child.highlighted = True
+            self.cursor = self.window_start + new_index - 1
+            self.tg.prefetcher.update(self.messages, self.cursor)
+
+        self._scroll_highlighted_region()
+        self.post_message(self.Highlighted(self, new_child))
+
+    def _scroll_highlighted_region(self) -> None:
+        if not self._hold_scroll:
+            super()._scroll_highlighted_region()
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        if not self._viewport_check_pending:
+            self._viewport_check_pending = True
+            self.call_after_refresh(self._follow_viewport)
+
+    async def action_cursor_down(self) -> None:
+        await self.move_cursor(self.cursor + 1)
+
+    async def action_cursor_up(self) -> None:
+        await self.move_cursor(self.cursor - 1)
+
+    async def move_cursor(self, cursor: int):
+        if not self.messages:
+            return
+        cursor = clamp(cursor, 0, len(self.messages) - 1)
+        start, end = self.window_start, self.window_end
+        if (
+            not start <= cursor < end
+            or (cursor < start + self.OVERSCAN and start > 0)
+            or (cursor >= end - self.OVERSCAN and end < len(self.messages))
+        ):
+            await self._set_window(cursor - self.WINDOW_SIZE // 2)
+        self.index = cursor - self.window_start + 1
+        self._prefetch_page(cursor)
 
     def action_select_left(self):
         self.app.query_one(ChatListView).focus()
@@ -149,27 +405,384 @@ class MessageListView(ListView):
             details_pane.write(item.msg)
         details_pane.focus()
 
-    def action_select_item(self) -> None:
+    async def action_select_item(self) -> None:
         item = self.highlighted_child
         if item is not None:
-            item.action_select_item()
+            await item.action_select_item()
 
     def action_deselect_item(self) -> None:
         item = self.highlighted_child
         if item is not None:
             item.action_deselect_item()
 
-    async def load_messages(self, chat_id: int):
-        me = self.tg.get_me()
-        messages = self.tg.get_chat_history(chat_id)
-        message_ids = set(m.id for m in messages)
-        if self.messages_ids == message_ids:
+    async def load_messages(self, chat_id: int, around: int | None = None):
+        """Show the latest messages of a chat, or the page `around` a message."""
+        self.me = await self.tg.get_me()
+        history_cache = self.tg.client.history_cache
+
+        if around is not None and chat_id == self.chat_id:
+            position = self._store_position(around)
+            if position is not None:
+                await self.move_cursor(position)
+                return
+
+        if chat_id != self.chat_id:
+            self.cache_history()
+
+        if around is not None:
+            await self._show_around(chat_id, around)
+            return
+
+        if chat_id != self.chat_id:
+            # show what we have right away, the fresh page is reconciled below
+            cached = history_cache.get(chat_id)
+            if cached:
+                await self._fetch_authors(cached)
+                await self._show(chat_id, cached, has_older=True)
+
+        messages = await self.tg.get_chat_history(chat_id, limit=self.PAGE_SIZE)
+        await self._fetch_authors(messages)
+
+        if chat_id != self.chat_id or self.has_newer:
+            await self._show(chat_id, messages, has_older=messages.has_older)
+            return
+
+        with self._keep_position():
+            # only the range covered by the fresh page can be reconciled
+            message_ids = set(m.id for m in messages)
+            oldest = messages[0].id if messages else 0
+            self._remove_from_store(
+                [i for i in self.message_ids if i >= oldest and i not in message_ids]
+            )
+            for m in messages:
+                self._put_in_store(m)
+            await self._set_window(self.window_start)
+
+    def cache_history(self):
+        """Keep the shown messages for the next visit to the chat."""
+        # a range cut off from the latest message cannot be extended by updates
+        if self.chat_id and not self.has_newer:
+            self.tg.client.history_cache.set(self.chat_id, self.messages)
+
+    async def _show(
+        self,
+        chat_id: int,
+        messages: List[Message],
+        has_older: bool,
+        has_newer: bool = False,
+        cursor: int | None = None,
+    ):
+        if self._page_task is not None:
+            self._page_task.cancel()
+        self.chat_id = chat_id
+        self.messages = messages
+        self.message_ids = [m.id for m in messages]
+        width = self._text_width()
+        self.heights = [self._estimate_height(m, width) for m in messages]
+        self._offsets = None
+        self.has_older = has_older
+        self.has_newer = has_newer
+        position = len(messages) - 1
+        if cursor is not None:
+            position = bisect.bisect_left(self.message_ids, cursor)
+            position = clamp(position, 0, len(messages) - 1)
+        await self._set_window(position - self.WINDOW_SIZE // 2)
+        self.index = position - self.window_start + 1
+        if cursor is None:
+            self.scroll_end(animate=False)
+        else:
+            self.call_after_refresh(self._scroll_highlighted_region)
+        self.post_message(self.Shown(self, chat_id))
+
+    async def _show_around(self, chat_id: int, message_id: int):
+        half = self.PAGE_SIZE // 2
+        messages = await self.tg.get_chat_history(
+            chat_id, from_message_id=message_id, limit=self.PAGE_SIZE, offset=-half
+        )
+        await self._fetch_authors(messages)
+        newer = sum(1 for m in messages if m.id > message_id)
+        await self._show(
+            chat_id,
+            messages,
+            has_older=messages.has_older,
+            has_newer=newer >= half,
+            cursor=message_id,
+        )
+
+    async def _fetch_authors(self, messages: List[Message]):
+        self.authors.update(
+            await self.tg.get_users([m.sender_id.user_id for m in messages])
+        )
+
+    def _prefetch_page(self, position: int):
+        """Load the next page in the background once `position` nears an end."""
+        if self._page_task is not None and not self._page_task.done():
+            return
+        margin = self.PAGE_SIZE // 2
+        if self.has_older and position < margin:
+            self._page_task = asyncio.create_task(self._load_page(older=True))
+        elif self.has_newer and position >= len(self.messages) - margin:
+            self._page_task = asyncio.create_task(self._load_page(older=False))
+
+    async def _load_page(self, older: bool):
+        chat_id = self.chat_id
+        if older:
+            page = await self.tg.get_chat_history(
+                chat_id, from_message_id=self.message_ids[0], limit=self.PAGE_SIZE
+            )
+        else:
+            page = await self.tg.get_chat_history(
+                chat_id,
+                from_message_id=self.message_ids[-1],
+                limit=self.PAGE_SIZE + 1,
+                offset=-self.PAGE_SIZE,
+            )
+        if chat_id != self.chat_id:
+            return
+        if older:
+            messages = [m for m in page if m.id < self.message_ids[0]]
+            self.has_older = page.has_older and len(messages) > 0
+        else:
+            messages = [m for m in page if m.id > self.message_ids[-1]]
+            self.has_newer = len(messages) > 0
+        if not messages:
+            return
+        await self._fetch_authors(messages)
+
+        with self._keep_position(scroll=False):
+            for m in messages:
+                self._put_in_store(m)
+            self._trim_store(keep_oldest=older)
+            await self._set_window(self.window_start)
+
+    def _trim_store(self, keep_oldest: bool):
+        """Drop whole pages from the far end once MAX_PAGES is exceeded."""
+        excess = len(self.messages) - self.MAX_PAGES * self.PAGE_SIZE
+        if excess <= 0:
             return
-        self.messages_ids = message_ids
-        self.clear()
+        if keep_oldest:
+            excess = min(excess, len(self.messages) - self.window_end)
+            dropped = self.message_ids[len(self.message_ids) - excess :]
+            self.has_newer = self.has_newer or excess > 0
+        else:
+            excess = min(excess, self.window_start)
+            dropped = self.message_ids[:excess]
+            self.has_older = self.has_older or excess > 0
+        self._remove_from_store(dropped)
+
+    async def add_message(self, msg: Message, replaces: int | None = None):
+        """Add a new message, or put it in place of the message `replaces`."""
+        if msg.chat_id != self.chat_id or self.has_newer:
+            return
+        if replaces is None and msg.id in self.items:
+            return
+        self.authors[msg.sender_id.user_id] = await self.tg.get_user(
+            msg.sender_id.user_id
+        )
+        with self._keep_position():
+            following = self.window_end == len(self.messages)
+            if replaces is not None and replaces != msg.id:
+                self._remove_from_store([replaces])
+            self._put_in_store(msg)
+            start = self.window_start
+            if following and len(self.window) >= self.WINDOW_SIZE:
+                start += 1
+            await self._set_window(start)
+
+    def update_message_content(self, message_id: int, content: AnyMessageContent):
+        position = self._store_position(message_id)
+        if position is not None:
+            msg = self.messages[position].copy(update={"content": content})
+            self._put_in_store(msg)
+
+    def update_interaction_info(
+        self, message_id: int, interaction_info: MessageInteractionInfo | None
+    ):
+        position = self._store_position(message_id)
+        if position is not None:
+            msg = self.messages[position].copy(
+                update={"interaction_info": interaction_info}
+            )
+            self._put_in_store(msg)
+
+    async def remove_messages(self, message_ids: List[int]):
+        with self._keep_position():
+            self._remove_from_store(message_ids)
+            await self._set_window(self.window_start)
+
+    def _store_position(self, message_id: int) -> int | None:
+        position = bisect.bisect_left(self.message_ids, message_id)
+        if (
+            position < len(self.message_ids)
+            and self.message_ids[position] == message_id
+        ):
+            return position
+
+    def _put_in_store(self, msg: Message):
+        """Insert or replace a message, refreshing its item if it is mounted."""
+        position = self._store_position(msg.id)
+        if position is None:
+            position = bisect.bisect(self.message_ids, msg.id)
+            self.message_ids.insert(position, msg.id)
+            self.messages.insert(position, msg)
+            self.heights.insert(
+                position, self._estimate_height(msg, self._text_width())
+            )
+            self._offsets = None
+            if position < self.window_start:
+                self.window_start += 1
+            if position <= self.cursor:
+                self.cursor += 1
+            return
+        self.messages[position] = msg
+        item = self.items.get(msg.id)
+        if item is not None:
+            item.update_message(msg)
 
-        await self.mount_all(MessageItem(self.tg, m, me) for m in messages)
-        self.index = len(self.children)
+    def _remove_from_store(self, message_ids: List[int]):
+        removed = set(message_ids)
+        if not removed:
+            return
+        self.window_start -= sum(
+            1 for i in self.message_ids[: self.window_start] if i in removed
+        )
+        self.cursor -= sum(1 for i in self.message_ids[: self.cursor] if i in removed)
+        kept = [i for i, m in enumerate(self.messages) if m.id not in removed]
+        self.messages = [self.messages[i] for i in kept]
+        self.heights = [self.heights[i] for i in kept]
+        self._offsets = None
+        self.message_ids = [m.id for m in self.messages]
+
+    def _make_item(self, msg: Message) -> MessageItem:
+        return MessageItem(self.tg, msg, self.me, self.authors[msg.sender_id.user_id])
+
+    async def _set_window(self, start: int):
+        """
+        Mount the items for `messages[start:start + WINDOW_SIZE]`, recycling
+        the items that fall out of the window.
+        """
+        start = clamp(start, 0, max(len(self.messages) - self.WINDOW_SIZE, 0))
+        wanted = self.messages[start : start + self.WINDOW_SIZE]
+        wanted_ids = set(m.id for m in wanted)
+        kept = {
+            item.msg.id: item
+            for item in self.window
+            if item.msg.chat_id == self.chat_id and item.msg.id in wanted_ids
+        }
+        free = [item for item in self.window if kept.get(item.msg.id) is not item]
+
+        window: List[MessageItem] = []
+        pending: List[Awaitable] = []
+        for position, msg in enumerate(wanted, start=1):
+            item = kept.get(msg.id)
+            if item is None and free:
+                item = free.pop()
+                item.rebind(msg, self.authors[msg.sender_id.user_id])
+            if item is None:
+                item = self._make_item(msg)
+                pending.append(self.mount(item, before=position))
+            elif self._nodes[position] is not item:
+                self.move_child(item, before=position)
+            window.append(item)
+        pending.extend(item.remove() for item in free)
+
+        self.window = window
+        self.items = {item.msg.id: item for item in window}
+        self.window_start = start
+        self._resize_spacers()
+        with metrics.timer("mount_seconds", "MessageListView"):
+            await asyncio.gather(*pending)
+        self.call_after_refresh(self._measure_window)
+
+    def _resize_spacers(self):
+        self.top_spacer.styles.height = self._rows_before(self.window_start)
+        total = self._rows_before(len(self.heights))
+        self.bottom_spacer.styles.height = total - self._rows_before(self.window_end)
+
+    def _measure_window(self):
+        """Replace the estimated heights of mounted items by the real ones."""
+        for position, item in enumerate(self.window, start=self.window_start):
+            height = item.outer_size.height
+            if (
+                height
+                and position < len(self.heights)
+                and self.heights[position] != height
+            ):
+                self.heights[position] = height
+                self._offsets = None
+        self._resize_spacers()
+
+    def _text_width(self) -> int:
+        return max(int(self.size.width * 0.8) - 4, 10)
+
+    def _estimate_height(self, msg: Message, width: int) -> int:
+        if isinstance(msg.content, HasImage) and msg.content.image_data:
+            return ImagePreview.lines_for(msg.content.image_size) + 2
+        lines = msg.renderable_text.splitlines() or [""]
+        return sum(len(line) // width + 1 for line in lines) + 2
+
+    def _rows_above(self, message_id: int | None) -> int:
+        if message_id is None:
+            return 0
+        return self._rows_before(bisect.bisect_left(self.message_ids, message_id))
+
+    def _row_to_message(self, row: float) -> int:
+        return bisect.bisect(self._row_offsets(), row)
+
+    def _row_offsets(self) -> List[int]:
+        """The row each message ends at, rebuilt only after heights changed."""
+        if self._offsets is None:
+            self._offsets = list(itertools.accumulate(self.heights))
+        return self._offsets
+
+    def _rows_before(self, position: int) -> int:
+        """The rows taken by the messages before `position`."""
+        if position <= 0:
+            return 0
+        offsets = self._row_offsets()
+        return offsets[min(position, len(offsets)) - 1]
+
+    async def _follow_viewport(self):
+        """Shift the window when scrolling leaves the overscan area."""
+        self._viewport_check_pending = False
+        if not self.messages:
+            return
+        first = self._row_to_message(self.scroll_y)
+        last = self._row_to_message(self.scroll_y + self.size.height)
+        start, end = self.window_start, self.window_end
+        if (first < start + self.OVERSCAN and start > 0) or (
+            last >= end - self.OVERSCAN and end < len(self.messages)
+        ):
+            with self._keep_position(scroll=False):
+                await self._set_window(first - self.OVERSCAN)
+        self._prefetch_page(first)
+
+    @contextmanager
+    def _keep_position(self, scroll: bool = True):
+        """Keep the highlighted message and the scroll position across changes."""
+        at_end = self.scroll_y >= self.max_scroll_y
+        anchor_id = self.window[0].msg.id if self.window else None
+        rows_above_anchor = self._rows_above(anchor_id)
+        self._hold_scroll = not scroll
+        try:
+            yield
+            # rows inserted or dropped above the anchor would shift the view
+            shift = self._rows_above(anchor_id) - rows_above_anchor
+            if shift and not (at_end and scroll):
+                self.call_after_refresh(
+                    self.scroll_to, y=self.scroll_y + shift, animate=False
+                )
+            # the store keeps the cursor on its message as others come and go
+            cursor = clamp(self.cursor, 0, max(len(self.messages) - 1, 0))
+            if self.window_start <= cursor < self.window_end:
+                self.index = cursor - self.window_start + 1
+            else:
+                self.cursor = cursor
+                self.index = None
+        finally:
+            self._hold_scroll = False
+        if at_end and scroll:
+            self.call_after_refresh(self.scroll_end, animate=False)
 
     def on_mount(self) -> None:
         r = super().on_mount()
@@ -177,18 +790,46 @@ class MessageListView(ListView):
         return r
 
 
+class Spacer(Widget):
+    """Stands in for the messages above or below the mounted window."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.styles.height = 0
+
+    def render_line(self, y: int) -> Strip:
+        # Widget renders all of its rows before picking one, a spacer may
+        # stand in for thousands of messages
+        return Strip.blank(self.size.width, self.rich_style)
+
+
 class MessageItem(ListItem):
-    def __init__(self, tg: Client, msg: Message, me: int, *args, **kwargs) -> None:
+    def __init__(
+        self, tg: AsyncClient, msg: Message, me: int, author: User, *args, **kwargs
+    ) -> None:
         self.tg = tg
         self.me = me
         self.msg = msg
+        self.author = author
+        self.download_file_id: int | None = None
+        self.download_progress: float | None = None
+        self._open_task: asyncio.Task | None = None
         super().__init__(*args, **kwargs)
 
     def compose(self) -> ComposeResult:
+        with metrics.timer("compose_seconds", "MessageItem"):
+            content = self._build_content()
+        yield content
+
+    def _build_content(self) -> Widget:
         msg_text = self.msg.renderable_text
 
         if isinstance(self.msg.content, HasImage) and self.msg.content.image_data:
-            s = ImagePreview(self.msg.content.image_data, classes="content")
+            s = ImagePreview(
+                self.msg.content.image_data,
+                self.msg.content.image_size,
+                classes="content",
+            )
         else:
             s = Static(msg_text, classes="content")
 
@@ -196,27 +837,91 @@ class MessageItem(ListItem):
         is_author_me = author_id == self.me
         if is_author_me:
             self.add_class("author-me")
-        author = self.tg.get_user(author_id)
-
-        s.border_title = author.full_name
-
-        if self.msg.interaction_info:
-            reactions = self.msg.interaction_info.reactions
-            sub = ""
-            for r in reactions:
-                sub += r.reaction
-                c = r.total_count
-                if c > 1:
-                    sub += f": {c}"
-                sub += " "
-            s.border_subtitle = sub.strip()
-        yield s
-
-    def action_select_item(self):
+
+        s.border_title = self.author.full_name
+        s.border_subtitle = self._subtitle()
+        return s
+
+    def _subtitle(self) -> str:
+        sub = self._reactions()
+        if self.download_progress is not None:
+            sub = f"{sub} ⬇ {self.download_progress:.0%}".strip()
+        state = self.msg.sending_state
+        if isinstance(state, MessageSendingStatePending):
+            sub = f"{sub} sending…".strip()
+        elif isinstance(state, MessageSendingStateFailed):
+            sub = f"{sub} not sent: {state.error_message}".strip()
+        return sub
+
+    def _reactions(self) -> str:
+        if not self.msg.interaction_info:
+            return ""
+        reactions = self.msg.interaction_info.reactions
+        sub = ""
+        for r in reactions:
+            sub += r.reaction
+            c = r.total_count
+            if c > 1:
+                sub += f": {c}"
+            sub += " "
+        return sub.strip()
+
+    def rebind(self, msg: Message, author: User):
+        """Reuse this item for another message."""
+        self.msg = msg
+        self.author = author
+        self.highlighted = False
+        self._unwatch_download()
+        self.set_class(msg.sender_id.user_id == self.me, "author-me")
+        self.query(".content").remove()
+        self.mount(self._build_content())
+
+    def update_message(self, msg: Message):
+        """Refresh in place, rebuilding the content only when it was edited."""
+        old, self.msg = self.msg, msg
+        if old.content != msg.content:
+            self.query(".content").remove()
+            self.mount(self._build_content())
+        elif (
+            old.interaction_info != msg.interaction_info
+            or old.sending_state != msg.sending_state
+        ):
+            self.query_one(".content").border_subtitle = self._subtitle()
+
+    async def action_select_item(self):
         if isinstance(self.msg.content, HasDownloadableImage):
-            file = self.tg.download_file(self.msg.content.downloadable_image_id)
+            file = self.msg.content.downloadable_image
+            self.tg.prefetcher.opened(file)
+            self._watch_download(file.id)
+            # the download runs in the background, the list stays responsive
+            self._open_task = asyncio.create_task(self._open_image(file.id))
+
+    async def _open_image(self, file_id: int):
+        file = await self.tg.downloads.download(file_id, PRIORITY_SELECTED)
+        if self.download_file_id == file_id:
             subprocess.Popen(["kitten", "icat", file.local.path])
 
+    def _watch_download(self, file_id: int):
+        self._unwatch_download()
+        self.download_file_id = file_id
+        self.tg.downloads.subscribe(file_id, self._on_download_progress)
+
+    def _unwatch_download(self):
+        if self.download_file_id is not None:
+            self.tg.downloads.unsubscribe(
+                self.download_file_id, self._on_download_progress
+            )
+        self.download_file_id = None
+        self.download_progress = None
+
+    def _on_download_progress(self, download: Download):
+        self.download_progress = None if download.done else download.progress
+        if self.is_attached:
+            self.query_one(".content").border_subtitle = self._subtitle()
+
+    def on_unmount(self) -> None:
+        self._unwatch_download()
+
     def action_deselect_item(self):
         if isinstance(self.msg.content, HasImage):
             subprocess.Popen(["kitten", "icat", "--clear"])
@@ -269,8 +974,143 @@ class DetailsPane(TextLog):
         self.app.query_one(MessageListView).focus()
 
 
+class StatsPane(Static):
+    """Latency percentiles and component counters, refreshed while shown."""
+
+    def __init__(
+        self, components: Callable[[], Dict[str, Dict[str, Any]]], *args, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.components = components
+        self._timer: Timer | None = None
+
+    def toggle(self):
+        if self.display:
+            self.close()
+            return
+        self.display = True
+        self.refresh_stats()
+        self._timer = self.set_interval(1, self.refresh_stats)
+
+    def close(self):
+        self.display = False
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def refresh_stats(self):
+        text = Text()
+        text.append(f"{'ms':24} {'count':>6} {'p50':>7} {'p99':>7} {'max':>7}\n")
+        for name, stats in metrics.stats().items():
+            name = name.replace("_seconds", "")
+            text.append(f"{name[:24]:24} {stats['count']:>6}")
+            for key in ("p50", "p99", "max"):
+                text.append(f" {stats[key] * 1000:>7.2f}")
+            text.append("\n")
+        if not metrics.histograms:
+            text.append("no timings recorded yet\n", style="italic")
+        for component, stats in self.components().items():
+            text.append(f"\n{component}\n", style="bold")
+            for key, value in stats.items():
+                if isinstance(value, float):
+                    value = f"{value:.3g}"
+                if not isinstance(value, dict):
+                    text.append(f"  {key}: {value}\n")
+        self.update(text)
+
+
+class SearchResultItem(ListItem):
+    def __init__(self, result: SearchResult, chat: str, author: str) -> None:
+        self.result = result
+        date = datetime.fromtimestamp(result.date).strftime("%Y-%m-%d %H:%M")
+        text = Text(f"{chat} · {author} · {date}\n")
+        # the snippet alternates plain text and matched words
+        parts = result.snippet.replace(MATCH_END, MATCH_START).split(MATCH_START)
+        for i, part in enumerate(parts):
+            text.append(part, style="bold" if i % 2 else "")
+        super().__init__(Label(text))
+
+
+class SearchPane(Container):
+    BINDINGS: ClassVar[list[BindingType]] = [
+        Binding("escape", "close", "Close search", show=True),
+    ]
+
+    class Selected(_Message, bubble=True):
+        def __init__(self, search_pane: SearchPane, result: SearchResult) -> None:
+            super().__init__()
+            self.search_pane = search_pane
+            self.result = result
+
+    def __init__(self, tg: AsyncClient, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.tg = tg
+        self._search_task: asyncio.Task | None = None
+
+    def compose(self) -> ComposeResult:
+        self.input = Input(placeholder="Search messages")
+        self.results = ListView()
+        yield self.input
+        yield self.results
+
+    def open(self):
+        self.display = True
+        self.input.focus()
+
+    def action_close(self):
+        self.display = False
+        self.app.query_one(MessageListView).focus()
+
+    def on_input_changed(self, event: Input.Changed) -> None:
+        event.stop()
+        # search as you type, a newer query makes the previous one stale
+        if self._search_task is not None:
+            self._search_task.cancel()
+        self._search_task = asyncio.create_task(self._search(event.value))
+
+    def on_input_submitted(self, event: Input.Submitted) -> None:
+        event.stop()
+        self.results.focus()
+
+    def on_list_view_selected(self, event: ListView.Selected) -> None:
+        event.stop()
+        if isinstance(event.item, SearchResultItem):
+            self.post_message(self.Selected(self, event.item.result))
+            self.action_close()
+
+    async def _search(self, query: str):
+        results = await self.tg.index.search(query)
+        sender_ids = list(set(r.sender_id for r in results))
+        names = await asyncio.gather(*(self._author_name(i) for i in sender_ids))
+        authors = dict(zip(sender_ids, names))
+        chats = {}
+        for chat_id in set(r.chat_id for r in results):
+            chats[chat_id] = await self._chat_title(chat_id)
+        await self.results.clear()
+        await self.results.mount(
+            *(
+                SearchResultItem(r, chats[r.chat_id], authors[r.sender_id])
+                for r in results
+            )
+        )
+        self.results.index = 0
+
+    async def _author_name(self, user_id: int) -> str:
+        # one author that cannot be looked up must not lose the other results
+        try:
+            return (await self.tg.get_user(user_id)).full_name
+        except User.NotFound:
+            return "Unknown user"
+
+    async def _chat_title(self, chat_id: int) -> str:
+        try:
+            return (await self.tg.get_chat(chat_id)).title
+        except Chat.NotFound:
+            return "Unknown chat"
+
+
 class MainPane(Container):
-    def __init__(self, tg: Client, *args, **kwargs) -> None:
+    def __init__(self, tg: AsyncClient, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.tg = tg
 
@@ -282,36 +1122,200 @@ class MainPane(Container):
         yield self.chat_pane
         yield self.message_input
 
-    async def load_messages(self, chat_id: int):
-        await self.chat_pane.load_messages(chat_id)
+    async def load_messages(self, chat_id: int, around: int | None = None):
+        chat = await self.tg.get_chat(chat_id)
+        self.header.update(chat.title)
         self.message_input.value = ""
-        title = self.tg.get_chat(chat_id).title
-        self.header.update(title)
+        await self.chat_pane.load_messages(chat_id, around)
 
 
 class ImagePreview(Widget):
-    def __init__(self, data: bytes, *args, **kwargs) -> None:
+    """
+    Thumbnail preview that mounts as a correctly sized placeholder.
+
+    The image is decoded off the event loop the first time one of its lines
+    is rendered, i.e. once it is close enough to the viewport to be painted.
+    """
+
+    ESTIMATED_HEIGHT = 12
+    WIDTH = 32
+
+    def __init__(
+        self,
+        data: bytes,
+        size: Tuple[int, int] | None = None,
+        *args,
+        half_blocks: bool = True,
+        **kwargs,
+    ) -> None:
         super().__init__(*args, **kwargs)
 
-        data = base64.decodebytes(data)
-        image = Image.open(io.BytesIO(data)).convert("RGB")
-
-        self.width = 32
-        self.height = int(image.height / (image.width / self.width)) // 2
-
-        self.image = image.resize((self.width, self.height))
+        self.data = data
+        self.half_blocks = half_blocks
+        self.width = self.WIDTH
+        self.height = self.lines_for(size)
+        self.strips = thumbnail_cache.get(
+            thumbnail_key(data, self.width, half_blocks), count=False
+        )
+        self.decode_requested = False
 
         self.styles.width = self.width
         self.styles.height = self.height
 
+    @classmethod
+    def lines_for(cls, size: Tuple[int, int] | None) -> int:
+        if not size or not size[0]:
+            return cls.ESTIMATED_HEIGHT
+        return thumbnail_lines(*size, cls.WIDTH)
+
+    def set_strips(self, strips: List[Strip]):
+        self.strips = strips
+        if len(strips) != self.height:
+            self.height = self.styles.height = len(strips)
+        self.refresh()
+
+    @metrics.timed("render_line_seconds", "ImagePreview")
     def render_line(self, y: int) -> Strip:
-        full_block = "█"
-        return Strip(
-            Segment(
-                full_block,
-                Style(
-                    color=Color.from_triplet(ColorTriplet(*self.image.getpixel((x, y))))
-                ),
+        if self.strips is None:
+            if not self.decode_requested:
+                thumbnail_decoder.request(self)
+            return Strip.blank(self.width)
+        if 0 <= y < len(self.strips):
+            return self.strips[y]
+        return Strip.blank(self.width)
+
+
+class ThumbnailDecoder:
+    """
+    Decodes previews on a thread pool, most recent requests first.
+
+    At most `max_pending` requests wait in the queue, older ones are dropped
+    and previews that were unmounted in the meantime are skipped, so fast
+    scrolling does not pile up work for items that are no longer shown.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: Deque[ImagePreview] = deque()
+        self._running = 0
+
+    def request(self, preview: ImagePreview):
+        preview.decode_requested = True
+        self._pending.append(preview)
+        while len(self._pending) > self.max_pending:
+            # a dropped preview asks again the next time it is painted
+            self._pending.popleft().decode_requested = False
+        self._pump()
+
+    def _pump(self):
+        while self._running < self.workers and self._pending:
+            preview = self._pending.pop()
+            if not preview.is_attached:
+                preview.decode_requested = False
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="thumbnails"
+                )
+            self._running += 1
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                render_thumbnail,
+                preview.data,
+                preview.width,
+                preview.half_blocks,
             )
-            for x in range(self.width)
+            future.add_done_callback(partial(self._done, preview))
+
+    def _done(self, preview: ImagePreview, future: asyncio.Future):
+        self._running -= 1
+        if future.cancelled():
+            preview.decode_requested = False
+        elif future.exception() is not None:
+            # a corrupt thumbnail stays blank rather than being decoded on
+            # every repaint, other previews of it find the blank in the cache
+            preview.log(thumbnail_error=future.exception())
+            strips = [Strip.blank(preview.width)] * preview.height
+            key = thumbnail_key(preview.data, preview.width, preview.half_blocks)
+            thumbnail_cache.set(key, strips)
+            preview.set_strips(strips)
+        elif preview.is_attached:
+            preview.set_strips(future.result())
+        self._pump()
+
+
+thumbnail_decoder = ThumbnailDecoder()
+
+FULL_BLOCK = "█"
+UPPER_HALF_BLOCK = "▀"
+
+thumbnail_cache: LRUCache[List[Strip]] = LRUCache(maxsize=512)
+
+
+def thumbnail_key(data: bytes, width: int, half_blocks: bool) -> tuple:
+    return (hashlib.blake2b(data, digest_size=16).digest(), width, half_blocks)
+
+
+def thumbnail_lines(image_width: int, image_height: int, width: int) -> int:
+    # terminal cells are about twice as tall as wide
+    return max(int(image_height / (image_width / width)) // 2, 1)
+
+
+def render_thumbnail(data: bytes, width: int, half_blocks: bool) -> List[Strip]:
+    """
+    Decode a base64 thumbnail into one Strip per terminal line.
+
+    Results are shared by content hash and width, so a picture that shows up
+    in many messages or chats is decoded and resized only once.
+    """
+    key = thumbnail_key(data, width, half_blocks)
+    strips = thumbnail_cache.get(key)
+    if strips is None:
+        with metrics.timer("render_seconds", "thumbnail"):
+            strips = _render_thumbnail(data, width, half_blocks)
+        thumbnail_cache.set(key, strips)
+    return strips
+
+
+def _render_thumbnail(data: bytes, width: int, half_blocks: bool) -> List[Strip]:
+    # imported on the decoder thread by the first thumbnail, not at startup
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(base64.decodebytes(data))).convert("RGB")
+    lines = thumbnail_lines(image.width, image.height, width)
+    pixel_rows = lines * 2 if half_blocks else lines
+    pixels = image.resize((width, pixel_rows)).tobytes()
+
+    row_size = width * 3
+    rows = [
+        [tuple(pixels[i : i + 3]) for i in range(y * row_size, (y + 1) * row_size, 3)]
+        for y in range(pixel_rows)
+    ]
+    if half_blocks:
+        # the upper half block shows the top pixel, its background the bottom one
+        cells = [list(zip(rows[y], rows[y + 1])) for y in range(0, pixel_rows, 2)]
+        block = UPPER_HALF_BLOCK
+    else:
+        cells = [[(rgb, None) for rgb in row] for row in rows]
+        block = FULL_BLOCK
+
+    return [
+        Strip(
+            [
+                Segment(block * len(list(run)), _block_style(*colors))
+                for colors, run in itertools.groupby(line)
+            ],
+            width,
         )
+        for line in cells
+    ]
+
+
+@lru_cache(maxsize=4096)
+def _block_style(color: tuple, bgcolor: tuple | None) -> Style:
+    return Style(
+        color=Color.from_rgb(*color),
+        bgcolor=Color.from_rgb(*bgcolor) if bgcolor is not None else None,
+    )
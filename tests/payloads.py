@@ -0,0 +1,161 @@
+"""TDLib shaped payloads, as python-telegram hands them over."""
+
+import base64
+import io
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+
+def _minithumbnail() -> str:
+    # TDLib sends minithumbnails as base64 encoded JPEGs
+    data = io.BytesIO()
+    Image.new("RGB", (4, 4), (200, 30, 30)).save(data, "JPEG")
+    return base64.b64encode(data.getvalue()).decode()
+
+
+MINITHUMBNAIL = _minithumbnail()
+
+
+def user(user_id: int, first_name: str = "Ada", last_name: str = "") -> Dict[str, Any]:
+    return {
+        "@type": "user",
+        "id": user_id,
+        "first_name": first_name,
+        "last_name": last_name,
+    }
+
+
+def chat(chat_id: int, title: str, order: int = 0) -> Dict[str, Any]:
+    positions = []
+    if order:
+        positions.append(
+            {
+                "@type": "chatPosition",
+                "list": {"@type": "chatListMain"},
+                "order": str(order),
+                "is_pinned": False,
+            }
+        )
+    return {
+        "@type": "chat",
+        "id": chat_id,
+        "title": title,
+        "positions": positions,
+        "unread_count": 0,
+    }
+
+
+def formatted_text(text: str) -> Dict[str, Any]:
+    return {"@type": "formattedText", "text": text, "entities": []}
+
+
+def text_content(text: str) -> Dict[str, Any]:
+    return {"@type": "messageText", "text": formatted_text(text)}
+
+
+def file(file_id: int, size: int = 1024) -> Dict[str, Any]:
+    return {
+        "@type": "file",
+        "id": file_id,
+        "size": size,
+        "expected_size": size,
+        "local": {
+            "@type": "localFile",
+            "path": "",
+            "is_downloading_active": False,
+            "is_downloading_completed": False,
+            "downloaded_size": 0,
+        },
+    }
+
+
+def photo_content(caption: str = "", file_id: int = 1) -> Dict[str, Any]:
+    return {
+        "@type": "messagePhoto",
+        "photo": {
+            "@type": "photo",
+            "minithumbnail": {
+                "@type": "minithumbnail",
+                "width": 4,
+                "height": 4,
+                "data": MINITHUMBNAIL,
+            },
+            "sizes": [
+                {
+                    "@type": "photoSize",
+                    "type": "x",
+                    "photo": file(file_id),
+                    "width": 800,
+                    "height": 600,
+                    "progressive_sizes": [],
+                }
+            ],
+        },
+        "caption": formatted_text(caption),
+    }
+
+
+def document_content(caption: str = "", file_id: int = 2) -> Dict[str, Any]:
+    return {
+        "@type": "messageDocument",
+        "document": {
+            "@type": "document",
+            "file_name": "notes.txt",
+            "mime_type": "text/plain",
+            "minithumbnail": None,
+            "thumbnail": None,
+            "document": file(file_id),
+        },
+        "caption": formatted_text(caption),
+    }
+
+
+def sticker_content(emoji: str = "👍") -> Dict[str, Any]:
+    return {
+        "@type": "messageSticker",
+        "sticker": {
+            "@type": "sticker",
+            "set_id": 1,
+            "width": 512,
+            "height": 512,
+            "emoji": emoji,
+            "thumbnail": {"@type": "thumbnail", "width": 128, "height": 128},
+        },
+        "is_premium": False,
+    }
+
+
+def message(
+    message_id: int,
+    chat_id: int = 1,
+    user_id: int = 7,
+    content: Optional[Dict[str, Any]] = None,
+    **fields: Any,
+) -> Dict[str, Any]:
+    data = {
+        "@type": "message",
+        "id": message_id,
+        "chat_id": chat_id,
+        "sender_id": {"@type": "messageSenderUser", "user_id": user_id},
+        "is_outgoing": False,
+        "is_pinned": False,
+        "can_be_edited": False,
+        "can_be_forwarded": True,
+        "can_be_saved": True,
+        "can_be_deleted_only_for_self": True,
+        "can_be_deleted_for_all_users": False,
+        "can_get_statistics": False,
+        "can_get_message_thread": False,
+        "can_get_viewers": False,
+        "can_get_media_timestamp_links": False,
+        "has_timestamped_media": True,
+        "is_channel_post": False,
+        "contains_unread_mention": False,
+        "date": 1_600_000_000 + message_id,
+        "edit_date": 0,
+        "interaction_info": None,
+        "content": content or text_content(f"message {message_id}"),
+    }
+    data.update(fields)
+    return data
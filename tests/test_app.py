@@ -0,0 +1,153 @@
+"""The app driven through Textual's pilot against a recorded session."""
+
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+
+import pytest
+
+import client
+import payloads
+from app import TelegramClient
+from backends import ReplayBackend
+from metrics import metrics
+from models import UpdateNewMessage
+from outbox import LOCAL_ID_START, SENDING
+from widgets import MessageListView
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "session.jsonl")
+CHATS = 12
+# the first chat in the list, with a history of several pages
+LONG_CHAT = 100
+LONG_CHAT_MESSAGES = 120
+SENT_TEXT = "hello from the replay"
+
+# with the replay answering right away, in ms
+CHAT_SHOWN_BUDGET = 500
+MOUNT_BUDGET = 250
+FRAME_BUDGET = 50
+# from the key press, the pilot waits for the app to settle
+SEND_SHOWN_BUDGET = 500
+
+Test = Callable[[TelegramClient, object], Awaitable[None]]
+
+
+@pytest.fixture
+def replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        client,
+        "default_backend",
+        lambda: ReplayBackend(FIXTURE, files_directory=str(tmp_path)),
+    )
+
+
+def run(test: Test):
+    async def main():
+        app = TelegramClient()
+        try:
+            async with app.run_test(size=(120, 40)) as pilot:
+                await test(app, pilot)
+        finally:
+            app.tg.stop()
+
+    asyncio.run(main())
+
+
+async def until(pilot, condition: Callable[[], bool], timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await pilot.pause(0.01)
+
+
+async def open_long_chat(app: TelegramClient, pilot) -> MessageListView:
+    chat_pane = app.main_pane.chat_pane
+    await until(pilot, lambda: len(app.chat_list_view.chats) == CHATS)
+    await until(
+        pilot, lambda: chat_pane.chat_id == LONG_CHAT and bool(chat_pane.messages)
+    )
+    return chat_pane
+
+
+def test_chats_open(replay):
+    async def test(app: TelegramClient, pilot):
+        chat_pane = await open_long_chat(app, pilot)
+        assert len(chat_pane.messages) == chat_pane.PAGE_SIZE
+        assert chat_pane.has_older
+
+        await pilot.press("j")
+        next_chat = app.chat_list_view.chats[1].id
+        await until(pilot, lambda: chat_pane.chat_id == next_chat)
+        await until(pilot, lambda: len(app.navigation.shown_latencies) == 2)
+        assert not chat_pane.has_older
+
+        stats = app.navigation.stats()
+        assert stats["requests"] == 2
+        assert stats["shown_p99_ms"] < CHAT_SHOWN_BUDGET
+
+    run(test)
+
+
+def test_history_scrolls_to_the_first_message(replay, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "histograms", {})
+
+    async def test(app: TelegramClient, pilot):
+        chat_pane = await open_long_chat(app, pilot)
+        await pilot.press("l")
+        presses = 0
+        while chat_pane.has_older or chat_pane.cursor > 0:
+            assert presses < 2 * LONG_CHAT_MESSAGES
+            await pilot.press("k")
+            presses += 1
+
+        assert chat_pane.message_ids == list(range(1, LONG_CHAT_MESSAGES + 1))
+        assert chat_pane.highlighted_child.msg.id == 1
+        stats = metrics.stats()
+        assert stats["mount_seconds{MessageListView}"]["p99"] * 1000 < MOUNT_BUDGET
+        assert stats["frame_seconds{render}"]["p99"] * 1000 < FRAME_BUDGET
+
+    run(test)
+
+
+def test_sent_message_shows_pending(replay):
+    async def test(app: TelegramClient, pilot):
+        chat_pane = await open_long_chat(app, pilot)
+        await pilot.press("l", "i")
+        app.main_pane.message_input.value = SENT_TEXT
+        started = time.perf_counter()
+        await pilot.press("enter")
+        await until(
+            pilot, lambda: chat_pane.messages[-1].content.text.text == SENT_TEXT
+        )
+        elapsed = time.perf_counter() - started
+        assert elapsed * 1000 < SEND_SHOWN_BUDGET
+
+        # TDLib took it under a temporary id, the server has yet to confirm
+        await until(pilot, lambda: chat_pane.messages[-1].id < LOCAL_ID_START)
+        sent = chat_pane.messages[-1]
+        assert sent.id in chat_pane.items
+        assert app.async_tg.outbox.messages[LONG_CHAT, sent.id].state == SENDING
+
+    run(test)
+
+
+def test_new_messages_survive_an_unknown_author(replay):
+    async def test(app: TelegramClient, pilot):
+        chat_pane = await open_long_chat(app, pilot)
+        notified = []
+        app.notifier.notify_message = lambda *args: notified.append(args[2])
+        # user 2 is in the session, user 99 is not
+        await app.new_messages_handler(
+            [
+                UpdateNewMessage.from_tdlib(
+                    {"@type": "updateNewMessage", "message": payloads.message(*ids)}
+                )
+                for ids in [(500, LONG_CHAT, 99), (501, LONG_CHAT, 2)]
+            ]
+        )
+        assert notified == ["Unknown user", "Charles Babbage"]
+        assert chat_pane.message_ids[-1] == 501
+
+    run(test)
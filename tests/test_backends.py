@@ -0,0 +1,126 @@
+import json
+import queue
+import time
+from typing import Any, Dict, List, Optional
+
+import payloads
+from backends import RecordingBackend, ReplayBackend
+from client import Client
+
+CHAT_ID = 1
+HISTORY = [payloads.message(i, CHAT_ID) for i in range(1, 8)]
+
+
+class Server:
+    """TDLib answering history pages of at most `page_size` messages."""
+
+    def __init__(self, page_size: int = 3) -> None:
+        self.page_size = page_size
+        self.results: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.results.put({"@type": "updateNewChat", "chat": payloads.chat(1, "Ada")})
+
+    def send(self, query: Dict[Any, Any]) -> None:
+        result = self._answer(query)
+        result["@extra"] = query["@extra"]
+        self.results.put(result)
+
+    def receive(self) -> Optional[Dict[Any, Any]]:
+        try:
+            return self.results.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    def stop(self) -> None:
+        pass
+
+    def _answer(self, query: Dict[Any, Any]) -> Dict[Any, Any]:
+        if query["@type"] == "getChatHistory":
+            newest_first = HISTORY[::-1]
+            start = 0
+            if query["from_message_id"]:
+                # from the message itself, as TDLib does
+                start = next(
+                    i
+                    for i, m in enumerate(newest_first)
+                    if m["id"] <= query["from_message_id"]
+                )
+            limit = min(query["limit"], self.page_size)
+            return {"@type": "messages", "messages": newest_first[start:][:limit]}
+        if query["@type"] == "getMe":
+            return payloads.user(7)
+        return {"@type": "ok"}
+
+
+def record(path: str, queries: List[Dict[str, Any]]):
+    recording = RecordingBackend(Server(), str(path))
+    for n, query in enumerate(queries):
+        recording.send({**query, "@extra": {"request_id": str(n)}})
+    while recording.receive() is not None:
+        pass
+    recording.stop()
+
+
+def test_replay_answers_recorded_requests(tmp_path):
+    path = tmp_path / "session.jsonl"
+    record(
+        path,
+        [
+            {"@type": "setTdlibParameters", "api_hash": "secret"},
+            {"@type": "getMe"},
+        ],
+    )
+    lines = path.read_text()
+    assert "secret" not in lines
+    assert [sorted(json.loads(line)) for line in lines.splitlines()] == [
+        ["at", "update"],
+        ["request", "response"],
+    ]
+
+    replay = ReplayBackend(str(path), latency=0.05)
+    sent = time.monotonic()
+    replay.send({"@type": "getMe", "@extra": {"request_id": "a"}})
+    replay.send({"@type": "getUser", "user_id": 2, "@extra": {"request_id": "b"}})
+    results = [replay.receive() for _ in range(3)]
+    assert time.monotonic() - sent >= 0.05
+    assert results[0]["@type"] == "updateNewChat"
+    assert results[1] == {**payloads.user(7), "@extra": {"request_id": "a"}}
+    assert results[2]["@type"] == "error" and results[2]["code"] == 404
+
+
+def test_client_replays_without_credentials(tmp_path, monkeypatch):
+    monkeypatch.delenv("TELEGRAM_PHONE", raising=False)
+    path = tmp_path / "session.jsonl"
+    record(
+        path,
+        [
+            {"@type": "getMe"},
+            {
+                "@type": "getChatHistory",
+                "chat_id": CHAT_ID,
+                "limit": 5,
+                "from_message_id": 0,
+                "offset": 0,
+                "only_local": False,
+            },
+            {
+                "@type": "getChatHistory",
+                "chat_id": CHAT_ID,
+                "limit": 3,
+                "from_message_id": 5,
+                "offset": 0,
+                "only_local": False,
+            },
+        ],
+    )
+
+    client = Client(ReplayBackend(str(path), files_directory=str(tmp_path)))
+    try:
+        assert client.files_directory == str(tmp_path)
+        client.login()
+        assert client.me.id == 7
+        # the first short page is followed by one from its oldest message
+        history = client.get_chat_history(CHAT_ID, limit=5)
+        assert [m.id for m in history] == [3, 4, 5, 6, 7]
+        assert history.has_older
+    finally:
+        client.stop()
@@ -0,0 +1,407 @@
+"""Hot paths timed with pytest-benchmark on the recorded session."""
+
+import asyncio
+import base64
+import io
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Set, Tuple
+
+import pytest
+from PIL import Image
+from rich.color import Color
+from rich.segment import Segment
+from rich.style import Style
+from textual.strip import Strip
+
+import client
+import payloads
+from app import TelegramClient
+from backends import ReplayBackend
+from cache import HistoryCache
+from client import HISTORY_PAGE_SIZE, AsyncClient, Client
+from metrics import metrics
+from models import Message, UpdateNewMessage
+from search import SEARCH_LIMIT, MessageIndex
+from snapshot import Snapshot
+from test_app import (
+    CHATS,
+    FIXTURE,
+    FRAME_BUDGET,
+    LONG_CHAT,
+    open_long_chat,
+    replay,
+    run,
+    until,
+)
+from widgets import FULL_BLOCK, ImagePreview, render_thumbnail
+
+# mean time of a round, in ms
+PARSE_PAGE_BUDGET = 5
+HISTORY_CACHE_BUDGET = 5
+REPLAY_REQUEST_BUDGET = 5
+# every line of a preview
+RENDER_PREVIEW_BUDGET = 0.1
+# a prefix query over the indexed messages, to the results
+SEARCH_BUDGET = 20
+SEARCH_INDEXED = 10000
+# logged in, chats listed and the first page of the long chat read
+CLIENT_STARTUP_BUDGET = 100
+# logged in, the storm it lets out handled to the last update
+STORM_BUDGET = 500
+# every message of the session arrives again under a new id, this often
+STORM_REPEAT = 5
+# every chat of the list fetched, 100 of them, at most
+CHATS_MANY_BUDGET = 50
+# median from the app's start to the first chat shown, TDLib taking its time
+STARTUP_BUDGET = {"cold": 1500, "snapshot": 750}
+STARTUP_LATENCY = 0.1
+# of a getChat, each one on its own
+CHAT_LATENCY = 0.002
+# a history far longer than the mounted window, shown and scrolled up
+LONG_HISTORY = 10000
+LONG_HISTORY_STEPS = 50
+LONG_HISTORY_SHOWN_BUDGET = 500
+LONG_HISTORY_MEMORY_BUDGET = 8 * 1024 * 1024
+
+
+def history_request(from_message_id: int = 0) -> Dict[str, Any]:
+    with open(FIXTURE) as f:
+        for line in f:
+            entry = json.loads(line)
+            request = entry.get("request", {})
+            if (
+                request.get("@type") == "getChatHistory"
+                and request["chat_id"] == LONG_CHAT
+                and request["from_message_id"] == from_message_id
+            ):
+                return entry
+    raise LookupError(from_message_id)
+
+
+def recorded_messages() -> List[Dict[str, Any]]:
+    messages = {}
+    with open(FIXTURE) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("request", {}).get("@type") == "getChatHistory":
+                for m in entry["response"]["messages"]:
+                    messages[m["chat_id"], m["id"]] = m
+    return list(messages.values())
+
+
+def storm_session(tmp_path) -> str:
+    """The recorded session with a burst of new messages right at the start."""
+    path = os.path.join(str(tmp_path), "storm.jsonl")
+    messages = recorded_messages()
+    with open(FIXTURE) as f, open(path, "w") as out:
+        out.write(f.read())
+        for repeat in range(1, STORM_REPEAT + 1):
+            for m in messages:
+                m = {**m, "id": m["id"] + repeat * 1000}
+                updates = [
+                    {"@type": "updateNewMessage", "message": m},
+                    {
+                        "@type": "updateChatLastMessage",
+                        "chat_id": m["chat_id"],
+                        "last_message": m,
+                        "positions": [],
+                    },
+                ]
+                for update in updates:
+                    out.write(json.dumps({"at": 0.0, "update": update}) + "\n")
+    return path
+
+
+def chats_session(tmp_path, chats: int) -> str:
+    """A recording TDLib answers `chats` getChat requests in."""
+    path = os.path.join(str(tmp_path), f"chats-{chats}.jsonl")
+    with open(path, "w") as out:
+        for chat_id in range(1, chats + 1):
+            entry = {
+                "request": {"@type": "getChat", "chat_id": chat_id},
+                "response": payloads.chat(chat_id, f"Chat {chat_id}", order=chat_id),
+            }
+            out.write(json.dumps(entry) + "\n")
+    return path
+
+
+def sampled_lines(image: Any) -> List[Strip]:
+    """A preview's lines sampled pixel by pixel, as render_line once did."""
+    return [
+        Strip(
+            [
+                Segment(
+                    FULL_BLOCK, Style(color=Color.from_rgb(*image.getpixel((x, y))))
+                )
+                for x in range(image.width)
+            ],
+            image.width,
+        )
+        for y in range(image.height)
+    ]
+
+
+@pytest.fixture(scope="module")
+def page() -> List[Dict[str, Any]]:
+    return history_request()["response"]["messages"]
+
+
+def test_parse_history_page(benchmark, page):
+    messages = benchmark(lambda: [Message.from_tdlib(m) for m in page])
+    assert len(messages) == len(page)
+    assert benchmark.stats["mean"] * 1000 < PARSE_PAGE_BUDGET
+
+
+def test_history_cache_round_trip(benchmark, page):
+    messages = [Message.from_tdlib(m) for m in reversed(page)]
+    history = HistoryCache()
+
+    def round_trip():
+        history.set(LONG_CHAT, messages)
+        return history.get(LONG_CHAT)
+
+    assert benchmark(round_trip) == messages
+    assert benchmark.stats["mean"] * 1000 < HISTORY_CACHE_BUDGET
+
+
+@pytest.mark.parametrize("render", ["strips", "pixels"])
+def test_render_preview(benchmark, render):
+    data = payloads.MINITHUMBNAIL.encode()
+    preview = ImagePreview(data, (4, 4), half_blocks=False)
+    preview.strips = render_thumbnail(data, preview.width, half_blocks=False)
+
+    def strips():
+        return [preview.render_line(y) for y in range(preview.height)]
+
+    # both from a decoded image, only the way lines are made differs
+    image = Image.open(io.BytesIO(base64.decodebytes(data))).convert("RGB")
+    image = image.resize((preview.width, preview.height))
+
+    lines = benchmark(strips if render == "strips" else lambda: sampled_lines(image))
+    assert len(lines) == preview.height
+    assert all(line.cell_length == preview.width for line in lines)
+    if render == "strips":
+        assert benchmark.stats["mean"] * 1000 < RENDER_PREVIEW_BUDGET
+
+
+def test_search(benchmark, tmp_path, page):
+    index = MessageIndex(str(tmp_path / "index.sqlite3"))
+    index.add(
+        Message.from_tdlib({**page[i % len(page)], "id": i + 1})
+        for i in range(SEARCH_INDEXED)
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        # the writer thread has the messages in before the first search
+        index._writer.submit(lambda: None).result()
+        results = benchmark(lambda: loop.run_until_complete(index.search("engi not")))
+    finally:
+        loop.close()
+        index.close()
+    message_ids = [r.message_id for r in results]
+    assert len(message_ids) == SEARCH_LIMIT
+    assert message_ids == sorted(message_ids, reverse=True)
+    assert benchmark.stats["mean"] * 1000 < SEARCH_BUDGET
+
+
+def test_replay_request(benchmark, tmp_path):
+    replay = ReplayBackend(FIXTURE, latency=0, files_directory=str(tmp_path))
+    query = {**history_request()["request"], "@extra": {"request_id": "1"}}
+    # the session's updates come with the first request
+    replay.send(query)
+    while replay.receive()["@type"] != "messages":
+        pass
+
+    def request():
+        replay.send(query)
+        return replay.receive()
+
+    assert benchmark(request)["@extra"] == {"request_id": "1"}
+    assert benchmark.stats["mean"] * 1000 < REPLAY_REQUEST_BUDGET
+    replay.stop()
+
+
+@pytest.mark.parametrize("fetch", ["sequential", "many"])
+@pytest.mark.parametrize("chats", [10, 100])
+def test_get_chats(benchmark, tmp_path, chats, fetch):
+    path = chats_session(tmp_path, chats)
+    tg = Client(
+        ReplayBackend(path, latency=CHAT_LATENCY, files_directory=str(tmp_path))
+    )
+    chat_ids = list(range(1, chats + 1))
+
+    def sequential():
+        return [tg.get_chat(chat_id) for chat_id in chat_ids]
+
+    try:
+        fetched = benchmark(
+            sequential if fetch == "sequential" else lambda: tg.get_chats_many(chat_ids)
+        )
+    finally:
+        tg.stop()
+    assert [chat.id for chat in fetched] == chat_ids
+    if fetch == "many":
+        assert benchmark.stats["mean"] * 1000 < CHATS_MANY_BUDGET
+
+
+def test_long_history(benchmark, replay, monkeypatch, tmp_path, page):
+    monkeypatch.setattr(metrics, "enabled", True)
+    messages = [
+        Message.from_tdlib({**page[i % len(page)], "id": i + 1})
+        for i in range(LONG_HISTORY)
+    ]
+    shown: List[float] = []
+    peaks: List[int] = []
+    frames: List[float] = []
+
+    async def scroll(app: TelegramClient, pilot):
+        chat_pane = await open_long_chat(app, pilot)
+        # the long chat's own page is in, nothing else lands in the view
+        await until(pilot, lambda: bool(app.navigation.loaded_latencies))
+        monkeypatch.setattr(metrics, "histograms", {})
+        started = time.perf_counter()
+        await chat_pane._show(LONG_CHAT, messages, has_older=False)
+        await pilot.pause()
+        shown.append(time.perf_counter() - started)
+
+        window_start = chat_pane.window_start
+        for _ in range(LONG_HISTORY_STEPS):
+            await chat_pane.action_cursor_up()
+            await pilot.pause()
+        assert chat_pane.window_start < window_start
+        frames.append(metrics.stats()["frame_seconds{render}"]["p99"])
+
+        # once more from the end, traced
+        tracemalloc.start()
+        try:
+            await chat_pane._show(LONG_CHAT, messages, has_older=False)
+            await pilot.pause()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+    snapshot = os.path.join(str(tmp_path), "snapshot.bin")
+    # each round from a cold start, not from the snapshot the last one left
+    benchmark.pedantic(
+        lambda: run(scroll),
+        setup=lambda: Snapshot.delete(snapshot),
+        rounds=3,
+        warmup_rounds=1,
+    )
+    # the warmup round pays for imports and cold caches
+    del shown[0], peaks[0], frames[0]
+    benchmark.extra_info["shown_ms"] = statistics.median(shown) * 1000
+    benchmark.extra_info["peak_bytes"] = max(peaks)
+    assert statistics.median(shown) * 1000 < LONG_HISTORY_SHOWN_BUDGET
+    # only the window is mounted, whatever the length of the history
+    assert max(peaks) < LONG_HISTORY_MEMORY_BUDGET
+    assert max(frames) * 1000 < FRAME_BUDGET
+
+
+@pytest.mark.parametrize("start", ["cold", "snapshot"])
+def test_startup(benchmark, monkeypatch, tmp_path, start):
+    monkeypatch.setattr(
+        client,
+        "default_backend",
+        lambda: ReplayBackend(
+            FIXTURE, latency=STARTUP_LATENCY, files_directory=str(tmp_path)
+        ),
+    )
+    path = os.path.join(str(tmp_path), "snapshot.bin")
+    shown: List[float] = []
+
+    async def first_chat(app: TelegramClient, pilot):
+        await open_long_chat(app, pilot)
+        shown.append(time.perf_counter())
+
+    # a first launch leaves a snapshot behind on exit
+    run(first_chat)
+    assert os.path.exists(path)
+
+    startups: List[float] = []
+
+    def launch():
+        if start == "cold":
+            Snapshot.delete(path)
+        shown.clear()
+        started = time.perf_counter()
+        run(first_chat)
+        startups.append(shown[0] - started)
+
+    # a round also covers the exit, the time to the first chat is kept aside
+    benchmark.pedantic(launch, rounds=5)
+    startup = statistics.median(startups) * 1000
+    benchmark.extra_info["startup_ms"] = startup
+    assert startup < STARTUP_BUDGET[start]
+
+
+def replay_client(path: str, tmp_path) -> Tuple[Tuple[AsyncClient], Dict]:
+    tg = Client(ReplayBackend(path, latency=0, files_directory=str(tmp_path)))
+    return (AsyncClient(tg),), {}
+
+
+def stop(async_tg: AsyncClient):
+    async_tg.index.close()
+    async_tg.client.stop()
+
+
+def test_client_startup(benchmark, tmp_path):
+    async def start(async_tg: AsyncClient):
+        await async_tg.login()
+        chats = await async_tg.get_chats()
+        history = await async_tg.get_chat_history(LONG_CHAT)
+        return chats, history
+
+    chats, history = benchmark.pedantic(
+        lambda async_tg: asyncio.run(start(async_tg)),
+        setup=lambda: replay_client(FIXTURE, tmp_path),
+        teardown=stop,
+        rounds=5,
+    )
+    assert len(chats) == CHATS
+    assert len(history) == HISTORY_PAGE_SIZE
+    assert benchmark.stats["mean"] * 1000 < CLIENT_STARTUP_BUDGET
+
+
+def test_update_storm(benchmark, tmp_path):
+    path = storm_session(tmp_path)
+    storm = STORM_REPEAT * len(recorded_messages())
+
+    async def handle_storm(async_tg: AsyncClient):
+        new_messages: List[UpdateNewMessage] = []
+        chats: Set[int] = set()
+        done = threading.Event()
+
+        def on_new_messages(updates: List[UpdateNewMessage]):
+            new_messages.extend(updates)
+            if len(new_messages) == storm:
+                done.set()
+
+        updates = async_tg.updates
+        updates.add_handler("updateNewMessage", on_new_messages)
+        updates.add_handler(
+            "updateChatLastMessage", lambda u: chats.update(c.chat_id for c in u)
+        )
+        updates.start()
+        # the replay lets its updates out with the first request
+        await async_tg.login()
+        await asyncio.get_running_loop().run_in_executor(None, done.wait, 5)
+        updates.stop()
+        return new_messages, chats, updates.stats()
+
+    new_messages, chats, stats = benchmark.pedantic(
+        lambda async_tg: asyncio.run(handle_storm(async_tg)),
+        setup=lambda: replay_client(path, tmp_path),
+        teardown=stop,
+        rounds=5,
+    )
+    assert len(new_messages) == storm
+    assert chats == {u.message.chat_id for u in new_messages}
+    # a chat's last message is replaced by a newer one while queued
+    assert stats["merged"] > 0
+    assert benchmark.stats["mean"] * 1000 < STORM_BUDGET
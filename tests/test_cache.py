@@ -0,0 +1,164 @@
+import gc
+import tracemalloc
+from typing import Any, Callable
+
+import pytest
+
+import cache
+import payloads
+from cache import CompactMessage, HistoryCache, LRUCache, ThumbnailStore
+from models import Message, MessageSendingStateFailed
+from outbox import LOCAL_ID_START, _pending_message
+
+# messages measured at once, every tenth a photo
+FOOTPRINT_MESSAGES = 10000
+# of a CompactMessage, against the Message it was packed from
+FOOTPRINT_RATIO = 0.5
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def message(message_id: int, chat_id: int = 1, **fields) -> Message:
+    return Message.from_tdlib(payloads.message(message_id, chat_id, **fields))
+
+
+def retained(build: Callable[[], Any]) -> int:
+    """The bytes still allocated by `build` while its result is alive."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def test_lru_cache_evicts_least_recently_used():
+    users = LRUCache(maxsize=2)
+    users.set(1, "a")
+    users.set(2, "b")
+    assert users.get(1) == "a"
+    users.set(3, "c")
+    assert 2 not in users
+    assert users.get(1) == "a"
+    assert users.get(3) == "c"
+    assert len(users) == 2
+
+
+def test_lru_cache_expires_entries(clock):
+    users = LRUCache(ttl=10)
+    users.set(1, "a")
+    clock[0] += 5
+    assert users.get(1) == "a"
+    clock[0] += 6
+    assert users.get(1) is None
+    assert len(users) == 0
+    assert users.stats() == {"size": 0, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_lru_cache_set_refreshes_ttl(clock):
+    users = LRUCache(ttl=10)
+    users.set(1, "a")
+    clock[0] += 8
+    users.set(1, "b")
+    clock[0] += 8
+    assert users.get(1) == "b"
+
+
+def test_history_cache_round_trip():
+    messages = [
+        message(1),
+        message(2, content=payloads.photo_content("caption")),
+        message(3, content=payloads.document_content()),
+        message(4, content=payloads.sticker_content()),
+    ]
+    history = HistoryCache()
+    history.set(1, messages)
+    assert history.get(1) == messages
+    assert len(history.thumbnails) == 1
+
+
+def test_history_cache_keeps_sending_state():
+    pending = _pending_message(LOCAL_ID_START, 1, 7, "hi")
+    pending = pending.copy(update={"date": pending.date.replace(microsecond=0)})
+    failed = message(
+        5,
+        sending_state={
+            "@type": "messageSendingStateFailed",
+            "error_code": 500,
+            "error_message": "Internal error",
+            "can_retry": True,
+            "retry_after": 1.5,
+        },
+    )
+    history = HistoryCache()
+    history.set(1, [failed, pending])
+    restored_failed, restored_pending = history.get(1)
+    assert restored_pending == pending
+    assert restored_failed == failed
+    assert isinstance(restored_failed.sending_state, MessageSendingStateFailed)
+
+
+def test_history_cache_shares_and_releases_thumbnails():
+    history = HistoryCache()
+    content = payloads.photo_content()
+    history.set(1, [message(1, content=content), message(2, content=content)])
+    history.set(2, [message(3, chat_id=2, content=content)])
+    assert len(history.thumbnails) == 1
+    history.remove_messages(1, [1, 2])
+    assert len(history.thumbnails) == 1
+    history.set(2, [])
+    assert len(history.thumbnails) == 0
+
+
+def test_history_cache_adds_new_messages_in_order():
+    history = HistoryCache()
+    pending = _pending_message(LOCAL_ID_START, 1, 7, "hi")
+    history.set(1, [message(1), pending])
+    history.add_message(message(2))
+    history.add_message(message(2))
+    history.add_message(message(3, chat_id=2))
+    assert [m.id for m in history.get(1)] == [1, 2, LOCAL_ID_START]
+    assert 2 not in history
+    assert len(history) == 3
+
+
+def test_history_cache_replaces_sent_messages():
+    history = HistoryCache()
+    history.set(1, [message(1), message(5), message(9)])
+    history.replace_message(1, 5, message(12))
+    history.update_message(1, 9, edit_date=1)
+    assert [(m.id, m.edit_date) for m in history.get(1)] == [(1, 0), (9, 1), (12, 0)]
+
+
+def test_history_cache_evicts_whole_chats():
+    history = HistoryCache(max_messages=4)
+    history.set(1, [message(1), message(2)])
+    history.set(2, [message(3, chat_id=2), message(4, chat_id=2)])
+    history.get(1)
+    history.set(3, [message(5, chat_id=3)])
+    assert 2 not in history
+    assert 1 in history and 3 in history
+    assert len(history) == 3
+
+
+def test_compact_messages_take_less_memory():
+    photo = payloads.photo_content("hi")
+    data = [
+        payloads.message(i, content=photo) if i % 10 == 0 else payloads.message(i)
+        for i in range(1, FOOTPRINT_MESSAGES + 1)
+    ]
+    thumbnails = ThumbnailStore()
+    full = retained(lambda: [Message.from_tdlib(m) for m in data])
+    packed = retained(
+        lambda: [CompactMessage(Message.from_tdlib(m), thumbnails) for m in data]
+    )
+    assert len(thumbnails) == 1
+    assert packed < full * FOOTPRINT_RATIO
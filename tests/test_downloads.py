@@ -0,0 +1,51 @@
+import asyncio
+from typing import Any, Callable, Dict, List
+
+import payloads
+from downloads import PRIORITY_PREFETCH, DownloadManager
+
+
+class Client:
+    """Takes download requests and hands `updateFile` to the manager."""
+
+    def __init__(self) -> None:
+        self.handlers: Dict[str, Callable] = {}
+        self.requested: List[int] = []
+
+    def add_update_handler(self, update_type: str, handler: Callable):
+        self.handlers[update_type] = handler
+
+    def request_download(self, file_id: int, priority: int) -> Any:
+        self.requested.append(file_id)
+        return file_id
+
+    def add_done_callback(self, r: Any, callback: Callable):
+        pass
+
+    def update_file(self, file_id: int, active: bool):
+        file = payloads.file(file_id)
+        file["local"]["is_downloading_active"] = active
+        self.handlers["updateFile"]({"@type": "updateFile", "file": file})
+
+
+def test_only_started_downloads_are_interrupted():
+    async def main():
+        client = Client()
+        downloads = DownloadManager(client, max_parallel=1)
+        started = downloads.start(1)
+        queued = downloads.start(2, PRIORITY_PREFETCH)
+        assert client.requested == [1]
+
+        client.update_file(2, active=False)
+        client.update_file(1, active=True)
+        await asyncio.sleep(0)
+        assert not queued.done and not started.done
+
+        client.update_file(1, active=False)
+        await asyncio.sleep(0)
+        assert started.failed
+        assert not queued.failed
+        # the interrupted one made room for the queued one
+        assert client.requested == [1, 2]
+
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+import json
+import random
+
+import pytest
+
+from metrics import _NO_TIMER, Histogram, Metrics
+
+
+def test_histogram_is_exact_for_small_values():
+    histogram = Histogram()
+    for micros in range(32):
+        histogram.record(micros / 1_000_000)
+    assert histogram.count == 32
+    assert histogram.percentile(0.5) == pytest.approx(15 / 1_000_000)
+    assert histogram.max == pytest.approx(31 / 1_000_000)
+
+
+@pytest.mark.parametrize("seconds", [0.000_1, 0.003_7, 0.25, 12.0])
+def test_histogram_buckets_are_within_3_percent(seconds):
+    histogram = Histogram()
+    histogram.record(seconds)
+    histogram.record(seconds * 10)
+    assert histogram.percentile(0.5) == pytest.approx(seconds, rel=0.03)
+
+
+def test_histogram_percentiles():
+    rng = random.Random(1)
+    values = [rng.uniform(0.001, 0.1) for _ in range(10_000)]
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+    ordered = sorted(values)
+    for q in (0.5, 0.9, 0.99):
+        assert histogram.percentile(q) == pytest.approx(
+            ordered[int(q * len(ordered)) - 1], rel=0.03
+        )
+    assert histogram.percentile(1.0) == max(values)
+    assert histogram.sum == pytest.approx(sum(values))
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    assert metrics.timer("render_seconds") is _NO_TIMER
+    metrics.observe("render_seconds", 1.0)
+    assert metrics.stats() == {}
+
+
+def test_metrics_dump(tmp_path):
+    metrics = Metrics(enabled=True)
+    metrics.set_label_name("tdlib_request_seconds", "method")
+    metrics.observe("tdlib_request_seconds", 0.02, "getChat")
+    with metrics.timer("frame_seconds"):
+        pass
+
+    metrics.dump(str(tmp_path / "metrics.json"), {"outbox": {"queued": 2}})
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["histograms"]["tdlib_request_seconds{getChat}"]["count"] == 1
+    assert data["outbox"] == {"queued": 2}
+
+    metrics.dump(str(tmp_path / "metrics.prom"), {"outbox": {"queued": 2}})
+    text = (tmp_path / "metrics.prom").read_text()
+    assert 'telegram_tdlib_request_seconds_count{method="getChat"} 1' in text
+    assert "telegram_frame_seconds_count 1" in text
+    assert "telegram_outbox_queued 2" in text
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith(".metrics-")]
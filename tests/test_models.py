@@ -0,0 +1,73 @@
+import pytest
+from pydantic import ValidationError
+
+import payloads
+from models import Chat, Message, MessagePhoto, UpdateChatPosition
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        payloads.text_content("hello"),
+        payloads.photo_content("a caption"),
+        payloads.document_content("notes"),
+        payloads.sticker_content(),
+    ],
+    ids=["text", "photo", "document", "sticker"],
+)
+def test_from_tdlib_matches_validation(content):
+    data = payloads.message(
+        10,
+        content=content,
+        interaction_info={
+            "@type": "messageInteractionInfo",
+            "view_count": 3,
+            "forward_count": 0,
+            "reactions": [{"@type": "reaction", "reaction": "👍", "total_count": 2}],
+        },
+    )
+    built = Message.from_tdlib(data)
+    assert built == Message(**data)
+    assert built.__fields_set__ == Message(**data).__fields_set__
+
+
+def test_from_tdlib_converts_leaves():
+    data = payloads.message(10, sending_state={"@type": "messageSendingStatePending"})
+    message = Message.from_tdlib(data)
+    assert message.date.timestamp() == data["date"]
+    assert message.sending_state == Message(**data).sending_state
+
+
+def test_from_tdlib_rejects_unknown_content():
+    data = payloads.message(10, content={"@type": "messagePoll"})
+    with pytest.raises(ValidationError):
+        Message.from_tdlib(data)
+
+
+def test_chat_order_reads_the_main_list():
+    chat = Chat.from_tdlib(payloads.chat(1, "Chat", order=42))
+    assert chat.order == 42
+    assert chat.list_key == (-42, -1)
+    assert Chat.from_tdlib(payloads.chat(2, "Archived")).order == 0
+
+
+def test_update_chat_position_parses_order():
+    update = UpdateChatPosition.from_tdlib(
+        {
+            "@type": "updateChatPosition",
+            "chat_id": 1,
+            "position": payloads.chat(1, "Chat", order=5)["positions"][0],
+        }
+    )
+    assert update.position.order == 5
+    assert update.position.is_main
+
+
+def test_photo_caption_is_searchable():
+    photo = Message.from_tdlib(payloads.message(1, content=payloads.photo_content()))
+    captioned = Message.from_tdlib(
+        payloads.message(2, content=payloads.photo_content("beach at dusk"))
+    )
+    assert isinstance(photo.content, MessagePhoto)
+    assert photo.content.searchable_text == "Photo"
+    assert captioned.content.searchable_text == "beach at dusk"
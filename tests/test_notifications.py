@@ -0,0 +1,123 @@
+import shutil
+import subprocess
+import threading
+import time
+from typing import Any, Iterator, List, Tuple
+
+import pytest
+
+from notifications import DBusBackend, Notifier
+
+jeepney = pytest.importorskip("jeepney")
+blocking = pytest.importorskip("jeepney.io.blocking")
+
+NOTIFY_SIGNATURE = "susssasa{sv}i"
+
+
+class NotificationServer:
+    """`org.freedesktop.Notifications` on a bus of its own, answering calls."""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.connection = blocking.open_dbus_connection(bus=address)
+        self.connection.send_and_get_reply(
+            jeepney.message_bus.RequestName("org.freedesktop.Notifications")
+        )
+        # method, signature, body
+        self.calls: List[Tuple[str, str, Tuple[Any, ...]]] = []
+        self._next_id = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        self.connection.close()
+
+    def wait_for(self, calls: int, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while len(self.calls) < calls:
+            assert time.monotonic() < deadline, "timed out"
+            time.sleep(0.01)
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                message = self.connection.receive(timeout=0.05)
+            except TimeoutError:
+                continue
+            if message.header.message_type != jeepney.MessageType.method_call:
+                continue
+            fields = message.header.fields
+            method = fields[jeepney.HeaderFields.member]
+            signature = fields.get(jeepney.HeaderFields.signature, "")
+            self.calls.append((method, signature, message.body))
+            if method == "Notify":
+                replaces_id = message.body[1]
+                if not replaces_id:
+                    self._next_id += 1
+                    replaces_id = self._next_id
+                reply = jeepney.new_method_return(message, "u", (replaces_id,))
+            else:
+                reply = jeepney.new_method_return(message)
+            self.connection.send_message(reply)
+
+
+@pytest.fixture
+def server() -> Iterator[NotificationServer]:
+    if shutil.which("dbus-daemon") is None:
+        pytest.skip("no dbus-daemon")
+    daemon = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert daemon.stdout is not None
+    server = NotificationServer(daemon.stdout.readline().strip())
+    try:
+        yield server
+    finally:
+        server.stop()
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_dbus_notifications_replace_each_other(server):
+    backend = DBusBackend(bus=server.address)
+    first = backend.notify("From: Charles Babbage", "hello")
+    assert backend.notify("Analytical Engine (2 new messages)", "…", first) == first
+    backend.close_notification(first)
+    backend.close()
+
+    method, signature, body = server.calls[0]
+    assert (method, signature) == ("Notify", NOTIFY_SIGNATURE)
+    assert body[1] == 0 and body[3:5] == ("From: Charles Babbage", "hello")
+    assert server.calls[1][2][1] == first
+    assert server.calls[2] == ("CloseNotification", "u", (first,))
+
+
+def test_notifier_coalesces_a_burst(server):
+    notifier = Notifier([DBusBackend(bus=server.address)], interval=0.2)
+    try:
+        notifier.notify_message(100, "Analytical Engine", "Charles Babbage", "one")
+        server.wait_for(1)
+        for text in ["two", "three", "four"]:
+            notifier.notify_message(100, "Analytical Engine", "Mary Somerville", text)
+        server.wait_for(2)
+        time.sleep(0.3)
+    finally:
+        notifier.close()
+
+    assert len(server.calls) == 2
+    (_, _, first), (_, _, summary) = server.calls
+    assert first[3] == "From: Charles Babbage"
+    # the summary replaces the first notification
+    assert summary[1] == 1
+    assert summary[3] == "Analytical Engine (4 new messages)"
+    assert summary[4].splitlines() == [
+        "Mary Somerville: two",
+        "Mary Somerville: three",
+        "Mary Somerville: four",
+    ]
+    assert notifier.stats() == {"sent": 2, "coalesced": 2, "failed": 0}
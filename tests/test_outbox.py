@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Callable, Dict
+
+import payloads
+from outbox import FAILED, SENDING, Outbox
+
+
+class Updates:
+    def __init__(self) -> None:
+        self.handlers: Dict[str, Callable] = {}
+
+    def add_handler(self, update_type: str, handler: Callable):
+        self.handlers[update_type] = handler
+
+
+class AsyncClient:
+    """TDLib takes every message and never says whether it was sent."""
+
+    def __init__(self) -> None:
+        self.updates = Updates()
+        self.client = SimpleNamespace(me=None)
+        self.next_id = 100
+
+    async def send_message(self, chat_id: int, text: str) -> Any:
+        self.next_id += 1
+        pending = {"@type": "messageSendingStatePending"}
+        message = payloads.message(self.next_id, chat_id, sending_state=pending)
+        return SimpleNamespace(error=False, update=message, error_info=None)
+
+
+def test_unanswered_messages_time_out_and_free_their_slot():
+    async def main():
+        outbox = Outbox(AsyncClient(), max_in_flight=1, send_timeout=0.05)
+        first = outbox.send(1, "first")
+        second = outbox.send(2, "second")
+        await asyncio.sleep(0.01)
+        assert first.state == SENDING and first.holds_slot
+        assert outbox.stats()["queued"] == 1
+
+        await asyncio.sleep(0.06)
+        assert first.state == FAILED and not first.holds_slot
+        assert second.state == SENDING and second.holds_slot
+
+        await asyncio.sleep(0.06)
+        assert second.state == FAILED
+        assert outbox.stats() == {"queued": 0, "sending": 0, "in_flight": 0}
+
+    asyncio.run(main())
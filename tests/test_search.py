@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any, List, Optional
+
+import pytest
+
+import payloads
+from models import Message
+from search import MATCH_END, MATCH_START, MessageIndex, SearchResult, fts_query
+
+
+def message(message_id: int, text: str, chat_id: int = 1, **kwargs: Any) -> Message:
+    content = kwargs.pop("content", None) or payloads.text_content(text)
+    return Message.from_tdlib(
+        payloads.message(message_id, chat_id, content=content, **kwargs)
+    )
+
+
+def written(index: MessageIndex):
+    """Wait for the writes queued so far."""
+    index._writer.submit(lambda: None).result()
+
+
+def search(
+    index: MessageIndex, query: str, chat_id: Optional[int] = None
+) -> List[SearchResult]:
+    written(index)
+    return asyncio.run(index.search(query, chat_id))
+
+
+def ids(results: List[SearchResult]) -> List[int]:
+    return [r.message_id for r in results]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = MessageIndex(str(tmp_path / "index" / "index.sqlite3"))
+    yield index
+    index.close()
+
+
+def test_fts_query_matches_words_as_prefixes():
+    assert fts_query('say "hi" ') == '"say"* """hi"""*'
+    assert fts_query("  ") == ""
+
+
+def test_index_finds_words_by_prefix_newest_first(index):
+    index.add(
+        [
+            message(1, "The Analytical Engine weaves algebraic patterns"),
+            message(2, "Difference engine, part two", chat_id=2),
+            message(3, "Nothing to see here"),
+        ]
+    )
+    results = search(index, "eng")
+    assert ids(results) == [2, 1]
+    assert results[0].chat_id == 2 and results[0].sender_id == 7
+    assert f"{MATCH_START}Engine{MATCH_END}" in results[1].snippet
+    # every word has to match
+    assert ids(search(index, "analytical eng")) == [1]
+    assert ids(search(index, "eng", chat_id=1)) == [1]
+    assert search(index, "") == []
+
+
+def test_index_follows_edits_and_deletes(index):
+    index.add([message(1, "first draft"), message(2, "another draft")])
+    index.update_text(1, 1, "final version")
+    assert ids(search(index, "draft")) == [2]
+    assert ids(search(index, "final")) == [1]
+
+    # the same message again only rewrites a changed text
+    index.add([message(2, "another draft"), message(3, "draft three")])
+    assert ids(search(index, "draft")) == [3, 2]
+
+    index.remove(1, [2, 3])
+    assert search(index, "draft") == []
+    assert ids(search(index, "final")) == [1]
+
+
+def test_index_matches_captions(index):
+    index.add(
+        [
+            message(1, "", content=payloads.photo_content("Babbage at the lathe")),
+            message(2, "", content=payloads.photo_content()),
+        ]
+    )
+    assert ids(search(index, "lathe")) == [1]
+    # a photo without a caption is found as one
+    assert ids(search(index, "photo")) == [2]
@@ -0,0 +1,85 @@
+import marshal
+import sys
+from types import SimpleNamespace
+
+import payloads
+from cache import HistoryCache, LRUCache
+from models import Chat, Message, User
+from outbox import LOCAL_ID_START
+from snapshot import Snapshot
+
+
+def snapshot() -> Snapshot:
+    me = User.from_tdlib(payloads.user(7, "Ada", "Lovelace"))
+    chats = [
+        Chat.from_tdlib(payloads.chat(1, "Family", order=20)),
+        Chat.from_tdlib(payloads.chat(2, "Work", order=10)),
+    ]
+    history = [
+        (
+            1,
+            [
+                Message.from_tdlib(payloads.message(1)),
+                Message.from_tdlib(
+                    payloads.message(2, content=payloads.photo_content("hi"))
+                ),
+            ],
+        )
+    ]
+    return Snapshot(me, chats, [me], history)
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    saved = snapshot()
+    saved.save(path)
+    loaded = Snapshot.load(path)
+    assert loaded is not None
+    assert loaded.me == saved.me
+    assert loaded.chats == saved.chats
+    assert loaded.users == saved.users
+    assert loaded.history == saved.history
+
+
+def test_snapshot_ignores_other_versions(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(marshal.dumps({"version": 0}))
+    assert Snapshot.load(str(path)) is None
+
+
+def test_snapshot_leaves_out_unsent_messages():
+    me = User.from_tdlib(payloads.user(7, "Ada", "Lovelace"))
+    pending = {"@type": "messageSendingStatePending"}
+    messages = [
+        payloads.message(1),
+        # TDLib took it under a temporary id, the outbox put it up before that
+        payloads.message(2, sending_state=pending),
+        payloads.message(LOCAL_ID_START, sending_state=pending),
+    ]
+    history = HistoryCache()
+    history.set(1, [Message.from_tdlib(m) for m in messages])
+    client = SimpleNamespace(me=me, history_cache=history, users=LRUCache())
+    captured = Snapshot.capture(client, [])
+    assert captured is not None
+    assert [[m.id for m in messages] for _, messages in captured.history] == [[1]]
+
+
+def test_snapshot_ignores_other_python_versions(tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    snapshot().save(path)
+    with open(path, "rb") as f:
+        data = marshal.loads(f.read())
+    data["python"] = (sys.version_info[0], sys.version_info[1] - 1)
+    with open(path, "wb") as f:
+        f.write(marshal.dumps(data))
+    assert Snapshot.load(path) is None
+
+
+def test_snapshot_ignores_unreadable_files(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    assert Snapshot.load(str(path)) is None
+    path.write_bytes(b"\x00garbage")
+    assert Snapshot.load(str(path)) is None
+    Snapshot.delete(str(path))
+    Snapshot.delete(str(path))
+    assert not path.exists()
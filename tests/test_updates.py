@@ -0,0 +1,150 @@
+import asyncio
+from typing import Any, Callable, Dict, List
+
+import payloads
+from models import UpdateMessageInteractionInfo, UpdateNewMessage
+from updates import UpdateDispatcher
+
+
+class Client:
+    """Hands updates to the handlers python-telegram would call."""
+
+    def __init__(self) -> None:
+        self.handlers: Dict[str, List[Callable]] = {}
+
+    def add_update_handler(self, update_type: str, handler: Callable):
+        self.handlers.setdefault(update_type, []).append(handler)
+
+    def remove_update_handler(self, update_type: str, handler: Callable):
+        self.handlers[update_type].remove(handler)
+
+    def push(self, update: Dict[str, Any]):
+        for handler in self.handlers.get(update["@type"], []):
+            handler(update)
+
+
+def interaction_info(message_id: int, views: int) -> Dict[str, Any]:
+    return {
+        "@type": "updateMessageInteractionInfo",
+        "chat_id": 1,
+        "message_id": message_id,
+        "interaction_info": {
+            "@type": "messageInteractionInfo",
+            "view_count": views,
+            "forward_count": 0,
+            "reactions": [],
+        },
+    }
+
+
+def new_message(message_id: int) -> Dict[str, Any]:
+    return {"@type": "updateNewMessage", "message": payloads.message(message_id)}
+
+
+def dispatch(dispatcher: UpdateDispatcher, client: Client, updates: List[Dict]):
+    """Queue `updates` while the loop is busy, then let them through."""
+    batches: List[List[Any]] = []
+    done = asyncio.Event()
+
+    async def main():
+        dispatcher.start()
+        # the dispatcher waits for the loop, so everything queues up first
+        for update in updates:
+            client.push(update)
+        await asyncio.wait_for(done.wait(), 5)
+        dispatcher.stop()
+
+    def handler(batch: List[Any]):
+        batches.append(batch)
+        if dispatcher.depth == 0:
+            done.set()
+
+    for update_type in set(u["@type"] for u in updates):
+        dispatcher.add_handler(update_type, handler)
+    asyncio.run(main())
+    return batches
+
+
+def test_keyed_updates_are_merged():
+    client = Client()
+    dispatcher = UpdateDispatcher(client)
+    updates = [interaction_info(1, views) for views in range(5)]
+    updates += [interaction_info(2, 1)]
+    batches = dispatch(dispatcher, client, updates)
+
+    received = [u for batch in batches for u in batch]
+    assert all(isinstance(u, UpdateMessageInteractionInfo) for u in received)
+    latest = {u.message_id: u.interaction_info.view_count for u in received}
+    assert latest == {1: 4, 2: 1}
+    assert dispatcher.pushed == 6
+    assert dispatcher.merged + len(received) == 6
+
+
+def test_updates_are_batched_by_type_in_order():
+    client = Client()
+    dispatcher = UpdateDispatcher(client)
+    updates = [new_message(1), new_message(2), interaction_info(1, 1), new_message(3)]
+    batches = dispatch(dispatcher, client, updates)
+
+    received = [
+        u.message.id if isinstance(u, UpdateNewMessage) else ("info", u.message_id)
+        for batch in batches
+        for u in batch
+    ]
+    assert received == [1, 2, ("info", 1), 3]
+    assert all(len(set(type(u) for u in batch)) == 1 for batch in batches)
+
+
+def test_droppable_updates_are_dropped_when_full():
+    client = Client()
+    dispatcher = UpdateDispatcher(client, maxsize=2)
+    dispatcher.add_handler("updateMessageInteractionInfo", lambda batch: None)
+    dispatcher.add_handler("updateNewMessage", lambda batch: None)
+    # not started, nothing takes from the queue
+    dispatcher.loop = asyncio.new_event_loop()
+    for update_type in dispatcher.handlers:
+        dispatcher._subscribe(update_type)
+    client.push(new_message(1))
+    client.push(new_message(2))
+    client.push(interaction_info(1, 1))
+    assert dispatcher.dropped == 1
+    assert dispatcher.depth == 2
+    dispatcher.stop()
+    dispatcher.loop.close()
+
+
+def test_invalid_updates_are_counted():
+    client = Client()
+    dispatcher = UpdateDispatcher(client)
+    broken = new_message(2)
+    broken["message"]["content"] = {"@type": "messagePoll"}
+    batches = dispatch(dispatcher, client, [broken, new_message(3)])
+    assert [u.message.id for batch in batches for u in batch] == [3]
+    assert dispatcher.invalid == 1
+
+
+def test_dispatcher_survives_a_cancelled_batch():
+    client = Client()
+    dispatcher = UpdateDispatcher(client)
+    received: List[int] = []
+    done = asyncio.Event()
+
+    def handler(batch: List[UpdateNewMessage]):
+        if not received:
+            received.append(0)
+            raise asyncio.CancelledError
+        received.extend(u.message.id for u in batch)
+        done.set()
+
+    async def main():
+        dispatcher.add_handler("updateNewMessage", handler)
+        dispatcher.start()
+        client.push(new_message(1))
+        while not received:
+            await asyncio.sleep(0.01)
+        client.push(new_message(2))
+        await asyncio.wait_for(done.wait(), 5)
+        dispatcher.stop()
+
+    asyncio.run(main())
+    assert received == [0, 2]
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, List
+
+import payloads
+from models import Message
+from widgets import MessageListView, ThumbnailDecoder, thumbnail_cache, thumbnail_key
+
+
+def message(message_id: int) -> Message:
+    return Message.from_tdlib(payloads.message(message_id))
+
+
+class Preview:
+    """What the decoder uses of an ImagePreview."""
+
+    is_attached = True
+    width = 8
+    height = 2
+    half_blocks = True
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.decode_requested = False
+        self.strips: List[Any] = []
+        self.logged: List[Any] = []
+
+    def set_strips(self, strips: List[Any]):
+        self.strips = strips
+
+    def log(self, **kwargs: Any):
+        self.logged.append(kwargs)
+
+
+def test_corrupt_thumbnail_is_decoded_once():
+    async def main():
+        decoder = ThumbnailDecoder(workers=1)
+        preview = Preview(b"not base64 JPEG")
+        decoder.request(preview)
+        while decoder._running:
+            await asyncio.sleep(0.01)
+        return preview
+
+    preview = asyncio.run(main())
+    assert preview.decode_requested
+    assert len(preview.strips) == preview.height
+    assert len(preview.logged) == 1
+    key = thumbnail_key(preview.data, preview.width, preview.half_blocks)
+    assert thumbnail_cache.get(key, count=False) is preview.strips
+
+
+def test_message_list_keeps_row_offsets_until_heights_change():
+    view = MessageListView(tg=None)
+    view.messages = [message(i) for i in range(1, 5)]
+    view.message_ids = [1, 2, 3, 4]
+    view.heights = [3, 3, 5, 3]
+
+    assert [view._row_to_message(row) for row in (0, 3, 10, 11)] == [0, 1, 2, 3]
+    offsets = view._row_offsets()
+    assert view._row_to_message(6) == 2
+    assert view._row_offsets() is offsets
+    assert view._rows_above(3) == 6
+
+    view._remove_from_store([2])
+    assert view._row_offsets() == [3, 8, 11]
+    assert view._rows_above(4) == 8